@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Batch Classifier
+
+Classify every image in a source tree without the GUI and
+store the most likely categories for each one, so that the
+archive can be pre-classified overnight and the editor only
+has to confirm the suggestions.
+
+    python3 batch_classify.py --src ./TestImages/ --output ./predictions.db
+
+Results are stored in an SQLite database, one batch per
+transaction. Rerunning the same command resumes where it
+stopped, and classifies images again if they or the model
+have changed since.
+
+Author: Ethan Dinnen
+"""
+import argparse
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from discovery import iter_images
+from engine import ClassifierEngine
+from imaging import normalize_image
+from predictions import PredictionStore, load_labels, model_identity, top_labels
+from timing import LatencyStats
+
+
+def chunks(iterable, size):
+    """
+    Split an iterable into lists of at most `size` items
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def prepare(path):
+    """
+    Stat, decode and normalize one image to 1024 x 768
+
+    Runs on a worker thread. Resizing to the model's input size
+    and scaling the pixels is left to one run for the whole batch.
+
+    Returns:
+        A (stat, pixels, error) tuple. pixels is None if the image could not be read.
+    """
+    try:
+        stat = os.stat(path)
+        return stat, normalize_image(path), None
+    except Exception as e:
+        return None, None, str(e)
+
+
+def classify_tree(args):
+    """
+    Classify every unprocessed image under args.src in batches
+    """
+    labels = load_labels(args.labels)
+    store = PredictionStore(args.output, model_identity(args.graph, args.labels))
+    if len(store):
+        print("Resuming, {} images already in {}".format(len(store), args.output))
+
+    engine = ClassifierEngine(args.graph)
+    engine.warm_up()
+    print("Model loaded in {:.2f} s, warm up took {:.2f} s".format(engine.load_time, engine.warmup_time))
+
+    # Absolute paths, so the GUI finds them whatever directory it is run from
+    pending = (os.path.abspath(path) for path in iter_images(args.src))
+    pending = (path for path in pending if store.current(path) is None)
+    batches = chunks(pending, args.batch_size)
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+
+    preprocessing = LatencyStats()
+    count = 0
+    errors = 0
+    start = time.time()
+    last_report = start
+    # Decode the next batch while the model is busy with the current one
+    batch = next(batches, None)
+    futures = [executor.submit(prepare, path) for path in batch] if batch else None
+    while batch:
+        prepared = [f.result() for f in futures]
+        next_batch = next(batches, None)
+        futures = [executor.submit(prepare, path) for path in next_batch] if next_batch else None
+
+        good = [i for i, (_, pixels, _) in enumerate(prepared) if pixels is not None]
+        scores = {}
+        if good:
+            # One preprocessing run and one run of the model for the whole batch
+            preprocess_start = time.time()
+            tensor = engine.preprocessor.from_batch(np.stack([prepared[i][1] for i in good]))
+            preprocessing.add(time.time() - preprocess_start, len(good))
+            for i, row in zip(good, engine.run(tensor)):
+                scores[i] = row
+
+        results = []
+        for i, path in enumerate(batch):
+            stat, _, error = prepared[i]
+            if i in scores:
+                top_k = [[label, round(score, 5)] for label, score in top_labels(scores[i], labels, args.top_k)]
+                results.append((path, stat, top_k, None))
+            else:
+                # Record the failure so a resumed run doesn't retry it forever
+                print("Could not classify {}: {}".format(path, error), file=sys.stderr)
+                results.append((path, stat, None, error))
+                errors += 1
+        store.record(results) # Checkpoints the batch
+
+        count += len(batch)
+        now = time.time()
+        if now - last_report >= args.report_every:
+            print("{} images, {:.1f} images/sec".format(count, count / (now - start)))
+            last_report = now
+        batch = next_batch
+
+    executor.shutdown()
+    elapsed = time.time() - start
+    print("Classified {} images ({} errors) in {:.1f} s, {:.1f} images/sec".format(
+        count, errors, elapsed, count / elapsed if elapsed else 0.0))
+    print(preprocessing.summary("Batched preprocessing per image"))
+    print(engine.report())
+    engine.close()
+    store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classify a whole source tree without the GUI")
+    parser.add_argument("--src", default="./TestImages/", help="directory of images to classify")
+    parser.add_argument("--output", default="./predictions.db", help="database to store the results in")
+    parser.add_argument("--graph", default="./output_graph.pb", help="graph/model to be executed")
+    parser.add_argument("--labels", default="./output_labels.txt", help="name of file containing labels")
+    parser.add_argument("--batch_size", type=int, default=32, help="how many images to run through the model at once")
+    parser.add_argument("--top_k", type=int, default=5, help="how many labels to store per image")
+    parser.add_argument("--workers", type=int, default=4, help="how many threads to decode images with")
+    parser.add_argument("--report_every", type=float, default=10.0, help="how many seconds between progress reports")
+    sys.exit(classify_tree(parser.parse_args()))
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks
+
+Command line benchmarks for the expensive parts of
+categorizing an image. Run them from the app directory:
+
+    python3 benchmark.py soak --iterations 10000
+
+Author: Ethan Dinnen
+"""
+import argparse
+import itertools
+import os
+import pathlib
+import resource
+import sys
+import time
+
+
+def rss_mb():
+    """
+    Get the current resident memory of this process
+
+    Returns:
+        The resident set size in megabytes
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0)
+    except (IOError, OSError):
+        # No procfs, fall back to the peak resident size
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            return peak / (1024.0 * 1024.0)
+        return peak / 1024.0
+
+
+def find_images(src, limit=None):
+    """
+    Find the JPEG images to benchmark with
+
+    Args:
+        src: The directory to search
+        limit: The maximum number of images to return
+
+    Returns:
+        A list of image paths
+    """
+    images = sorted(str(f) for f in pathlib.Path(src).glob('**/*.jpg') if f.is_file())
+    return images[:limit] if limit else images
+
+
+def soak(args):
+    """
+    Preprocess images over and over and check memory stays flat
+
+    Returns:
+        0 if memory growth stayed under the allowed limit, 1 otherwise
+    """
+    from label_image import get_preprocessor
+
+    images = find_images(args.src)
+    if not images:
+        print("No images found in {}".format(args.src))
+        return 1
+    data = {}
+    for image in images:
+        with open(image, 'rb') as f:
+            data[image] = f.read()
+
+    preprocessor = get_preprocessor()
+    # Let the allocator settle before taking our baseline
+    for image in images:
+        preprocessor.from_bytes(data[image])
+    baseline = rss_mb()
+    ops = len(preprocessor.graph.get_operations())
+
+    print("{:>10} {:>10} {:>10} {:>12}".format("images", "rss (MB)", "growth", "ms/image"))
+    start = time.time()
+    last = start
+    for i, image in enumerate(itertools.islice(itertools.cycle(images), args.iterations), 1):
+        preprocessor.from_bytes(data[image])
+        if i % args.report_every == 0 or i == args.iterations:
+            now = time.time()
+            rss = rss_mb()
+            print("{:>10} {:>10.1f} {:>+10.1f} {:>12.2f}".format(
+                i, rss, rss - baseline, (now - last) * 1000 / args.report_every))
+            last = now
+
+    growth = rss_mb() - baseline
+    grew_ops = len(preprocessor.graph.get_operations()) - ops
+    print("{} images in {:.1f} s, memory growth {:+.1f} MB, graph growth {} ops".format(
+        args.iterations, time.time() - start, growth, grew_ops))
+    if growth > args.max_growth or grew_ops:
+        print("FAIL: memory is not flat")
+        return 1
+    print("OK")
+    return 0
+
+
+def thumbnail(args):
+    """
+    Compare full decoding, draft mode decoding and cache hits for thumbnails
+
+    Returns:
+        0
+    """
+    import shutil
+    import tempfile
+    from PIL import Image
+    from thumbnails import THUMBNAIL_SIZE, ThumbnailCache, make_thumbnail
+
+    images = find_images(args.src, args.limit)
+    if not images:
+        print("No images found in {}".format(args.src))
+        return 1
+
+    def full_decode(path):
+        im = Image.open(path)
+        im.load()
+        im.thumbnail(THUMBNAIL_SIZE, Image.ANTIALIAS)
+        return im
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = ThumbnailCache(cache_dir)
+        results = []
+        for name, make in (("full decode", full_decode),
+                           ("draft decode", make_thumbnail),
+                           ("cache miss", cache.get),
+                           ("cache hit", cache.get)):
+            start = time.time()
+            for image in images:
+                make(image)
+            results.append((name, (time.time() - start) * 1000 / len(images)))
+    finally:
+        shutil.rmtree(cache_dir)
+
+    for name, ms in results:
+        print("{:>14}: {:8.2f} ms/image ({:.0%} of full decode)".format(name, ms, ms / results[0][1]))
+    return 0
+
+
+def decode(args):
+    """
+    Compare decoding an image separately for the display, the resize and
+    the classifier against decoding it once and sharing the pixels
+
+    Returns:
+        0
+    """
+    import cv2
+    from PIL import Image
+    from imaging import DecodedFrame
+    from label_image import get_preprocessor
+    from thumbnails import THUMBNAIL_SIZE
+
+    images = find_images(args.src, args.limit)
+    if not images:
+        print("No images found in {}".format(args.src))
+        return 1
+    preprocessor = get_preprocessor()
+
+    def separate(path):
+        im = Image.open(path) # Decode for the display
+        im.load()
+        im.thumbnail(THUMBNAIL_SIZE, Image.ANTIALIAS)
+        pixels = cv2.resize(cv2.imread(path), (1024, 768)) # Decode again to normalize
+        encoded = cv2.imencode('.jpg', pixels)[1].tobytes()
+        preprocessor.from_bytes(encoded) # And again in the Tensorflow graph
+        return 3
+
+    def shared(path):
+        before = DecodedFrame.decodes
+        frame = DecodedFrame(path)
+        frame.thumbnail(THUMBNAIL_SIZE)
+        preprocessor.from_array(frame.normalized())
+        return DecodedFrame.decodes - before
+
+    results = []
+    for name, run in (("separate", separate), ("shared", shared)):
+        start = time.time()
+        decodes = sum(run(image) for image in images)
+        results.append((name, (time.time() - start) * 1000 / len(images), float(decodes) / len(images)))
+
+    for name, ms, decodes in results:
+        print("{:>10}: {:8.2f} ms/image, {:.1f} decodes/image ({:.0%} of separate)".format(
+            name, ms, decodes, ms / results[0][1]))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the image categorizer")
+    subparsers = parser.add_subparsers(dest="benchmark")
+
+    soak_parser = subparsers.add_parser("soak", help="check preprocessing memory stays flat over a long session")
+    soak_parser.add_argument("--src", default="./TestImages/", help="directory of images to cycle through")
+    soak_parser.add_argument("--iterations", type=int, default=10000, help="how many images to preprocess")
+    soak_parser.add_argument("--report_every", type=int, default=1000, help="how often to print memory usage")
+    soak_parser.add_argument("--max_growth", type=float, default=50.0, help="allowed memory growth in MB")
+    soak_parser.set_defaults(run=soak)
+
+    thumbnail_parser = subparsers.add_parser("thumbnail", help="time making the display thumbnails")
+    thumbnail_parser.add_argument("--src", default="./TestImages/", help="directory of images to use")
+    thumbnail_parser.add_argument("--limit", type=int, default=None, help="how many images to use")
+    thumbnail_parser.set_defaults(run=thumbnail)
+
+    decode_parser = subparsers.add_parser("decode", help="time decoding once for both display and classification")
+    decode_parser.add_argument("--src", default="./TestImages/", help="directory of images to use")
+    decode_parser.add_argument("--limit", type=int, default=None, help="how many images to use")
+    decode_parser.set_defaults(run=decode)
+
+    args = parser.parse_args()
+    if not args.benchmark:
+        parser.print_help()
+        sys.exit(1)
+    sys.exit(args.run(args))
@@ -0,0 +1,552 @@
+# -*- coding: utf-8 -*-
+"""
+Copy Engine
+
+Places categorized shoots in the background so the editor
+can move on to the next image while large raw files are
+still being transferred. Files can be copied, hardlinked,
+reflinked or moved, and every shoot goes through a
+write-ahead journal so it is never left half placed.
+
+Author: Ethan Dinnen
+"""
+import errno
+import hashlib
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+BUFFER_SIZE = 16 * 1024 * 1024 # Copy in 16MB chunks
+STRATEGIES = ('copy', 'hardlink', 'reflink', 'move') # The ways a file can be placed
+FICLONE = 0x40049409 # Linux ioctl asking the filesystem for a copy-on-write clone
+
+
+def rename_new(src, dst):
+    """
+    Rename a file, never replacing an existing file
+
+    Where the filesystem supports hardlinks the new name is linked
+    first, which fails atomically if the name is taken.
+
+    Args:
+        src: The file to rename
+        dst: Its new name
+
+    Raises:
+        FileExistsError: If something already exists at dst
+    """
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        raise
+    except OSError as e:
+        if e.errno == errno.EXDEV:
+            raise
+        # No hardlinks on this filesystem, check before renaming instead
+        if os.path.lexists(dst):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+        os.rename(src, dst)
+        return
+    os.remove(src)
+
+
+def unique_path(path, taken=(), keep_extension=True):
+    """
+    Find a path for a new file or directory that won't replace anything
+
+    Args:
+        path: The preferred path
+        taken: Paths already promised to other files
+        keep_extension: Whether to number the name before its extension
+
+    Returns:
+        The path, or the path with -2, -3, ... added to its name
+    """
+    root, ext = os.path.splitext(path) if keep_extension else (path, '')
+    candidate = path
+    number = 1
+    while os.path.lexists(candidate) or candidate in taken:
+        number += 1
+        candidate = "{}-{}{}".format(root, number, ext)
+    return candidate
+
+
+def copy_file(src, dst, progress=None, buffer_size=BUFFER_SIZE):
+    """
+    Copy a file's contents
+
+    The copy is written next to the destination and renamed into
+    place once complete, so a half copied file never appears under
+    the destination name. The kernel does the copy with sendfile
+    where it can, otherwise we copy through one large buffer.
+
+    Args:
+        src: The file to copy
+        dst: Where to copy it to
+        progress: Optional function called with the number of bytes
+            copied after every chunk
+        buffer_size: How much to copy at a time
+
+    Raises:
+        FileExistsError: If something already exists at dst
+    """
+    partial = dst + '.partial'
+    try:
+        write_copy(src, partial, progress, buffer_size)
+        rename_new(partial, dst)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+
+def write_copy(src, partial, progress, buffer_size):
+    """
+    Write a copy of a file's contents for copy_file()
+    """
+    with open(src, 'rb') as fsrc, open(partial, 'wb') as fdst:
+        copied = False
+        if hasattr(os, 'sendfile'):
+            try:
+                offset = 0
+                while True:
+                    sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, buffer_size)
+                    if sent == 0:
+                        break
+                    offset += sent
+                    if progress is not None:
+                        progress(sent)
+                copied = True
+            except OSError:
+                # Not supported between these files, start over the slow way
+                if offset:
+                    if progress is not None:
+                        progress(-offset)
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+        if not copied:
+            buffer = bytearray(buffer_size)
+            view = memoryview(buffer)
+            while True:
+                read = fsrc.readinto(buffer)
+                if not read:
+                    break
+                fdst.write(view[:read])
+                if progress is not None:
+                    progress(read)
+        fdst.flush()
+        os.fsync(fdst.fileno())
+
+
+def reflink_file(src, dst):
+    """
+    Clone a file on a copy-on-write filesystem (btrfs, XFS, ...)
+
+    The clone shares the original's blocks until either is modified,
+    so it takes no time and no extra space.
+
+    Args:
+        src: The file to clone
+        dst: Where to put the clone
+
+    Raises:
+        FileExistsError: If something already exists at dst
+        OSError: If the filesystem (or platform) can't clone files
+    """
+    import fcntl # Not available on Windows
+    partial = dst + '.partial'
+    try:
+        with open(src, 'rb') as fsrc, open(partial, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        rename_new(partial, dst)
+    except (OSError, IOError):
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+
+def place_file(src, dst, strategy='copy', progress=None, buffer_size=BUFFER_SIZE):
+    """
+    Place a file at its destination
+
+    Hardlinks, reflinks and moves need the source and destination
+    to be on the same filesystem. When they aren't (or the filesystem
+    doesn't support reflinks) we fall back to copying, and a move
+    removes the original once the copy is complete.
+
+    An existing file is never replaced.
+
+    Args:
+        src: The file to place
+        dst: Where to place it
+        strategy: One of STRATEGIES
+        progress: Optional function called with the number of bytes placed
+        buffer_size: How much to copy at a time when copying
+
+    Raises:
+        FileExistsError: If something already exists at dst
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError("Unknown placement strategy {}".format(strategy))
+    if os.path.lexists(dst):
+        if strategy == 'move' and os.path.exists(src) and os.path.samefile(src, dst):
+            os.remove(src) # A move interrupted between linking and unlinking
+            return
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+    if strategy == 'copy':
+        copy_file(src, dst, progress, buffer_size)
+        return
+
+    size = os.path.getsize(src)
+    try:
+        if strategy == 'hardlink':
+            os.link(src, dst) # Atomic, and fails if dst exists
+        elif strategy == 'reflink':
+            reflink_file(src, dst)
+        else:
+            rename_new(src, dst)
+        if progress is not None:
+            progress(size)
+        return
+    except FileExistsError:
+        raise
+    except (OSError, IOError) as e:
+        if strategy == 'move' and e.errno != errno.EXDEV:
+            raise
+    copy_file(src, dst, progress, buffer_size)
+    if strategy == 'move':
+        os.remove(src)
+
+
+def is_placed(src, dst, strategy):
+    """
+    Check whether a file was already placed before a crash
+
+    Args:
+        src: The file being placed
+        dst: Where it was being placed
+        strategy: One of STRATEGIES
+
+    Returns:
+        True if there is nothing left to do for the file
+    """
+    if not os.path.exists(dst):
+        return False
+    if strategy == 'move':
+        return not os.path.exists(src)
+    if strategy == 'hardlink':
+        return os.path.samefile(src, dst)
+    # Copies are renamed into place once complete, so a destination
+    # of the right size is a finished copy
+    return os.path.exists(src) and os.path.getsize(src) == os.path.getsize(dst)
+
+
+def unplace_file(src, dst, strategy):
+    """
+    Undo placing a file
+
+    Moved files are moved back, anything else is removed from
+    the destination. Only call this for files this placement put
+    at dst, a file that was there before would be removed.
+
+    Args:
+        src: The file that was placed
+        dst: Where it was placed
+        strategy: One of STRATEGIES
+    """
+    if os.path.exists(dst + '.partial'):
+        os.remove(dst + '.partial')
+    if not os.path.exists(dst):
+        return
+    if strategy == 'move' and not os.path.exists(src):
+        place_file(dst, src, 'move')
+    else:
+        os.remove(dst)
+
+
+def file_checksum(path, buffer_size=BUFFER_SIZE):
+    """
+    Args:
+        path: The file to hash
+
+    Returns:
+        The SHA-256 hex digest of the file
+    """
+    digest = hashlib.sha256()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, 'rb') as f:
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            digest.update(view[:read])
+    return digest.hexdigest()
+
+
+class CopyJob(object):
+    """
+    The copies for one shoot and their progress
+    """
+
+    def __init__(self, name, files, context=None, directory=None):
+        """
+        Args:
+            name: The name to show for the job
+            files: A list of (src, dst) path pairs
+            context: Anything the caller wants to keep with the job
+            directory: The shoot's destination directory
+        """
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.directory = directory
+        self.files = files
+        self.context = context
+        self.total = 0 # Total bytes to copy
+        for src, _ in files:
+            try:
+                self.total += os.path.getsize(src)
+            except OSError:
+                pass
+        self.copied = 0 # Bytes copied so far
+        self.placed = set() # Indexes of the files that have been placed
+        self.errors = []
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def add_progress(self, copied):
+        with self.lock:
+            self.copied += copied
+
+    def add_placed(self, index):
+        with self.lock:
+            self.placed.add(index)
+
+    def add_error(self, error):
+        with self.lock:
+            self.errors.append(error)
+
+    def progress(self):
+        """
+        Returns:
+            How much of the job is done, from 0 to 1
+        """
+        if not self.total:
+            return 1.0 if self.done() else 0.0
+        with self.lock:
+            return min(1.0, float(self.copied) / self.total)
+
+    def done(self):
+        """
+        Returns:
+            True once every file has been copied (or failed)
+        """
+        return all(future.done() for future in self.futures)
+
+
+class CopyEngine(object):
+    """
+    Place shoots on a bounded pool of worker threads
+
+    Files from every submitted shoot share the pool, so a
+    shoot with a few huge raw files doesn't hold up the rest.
+
+    Every shoot is logged to the journal before its files are
+    touched. Once the caller has recorded a finished shoot it
+    calls commit(), a failed shoot is undone with rollback().
+    """
+
+    def __init__(self, journal, strategy='copy', workers=4, verify=False, buffer_size=BUFFER_SIZE):
+        """
+        Args:
+            journal: The PlacementJournal to log placements to
+            strategy: How to place files, one of STRATEGIES
+            workers: How many files to place at the same time
+            verify: Whether to compare checksums of every copy with its
+                original. Only copies are verified, the other strategies
+                don't duplicate the data.
+            buffer_size: How much to copy at a time
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError("Unknown placement strategy {}".format(strategy))
+        self.journal = journal
+        self.strategy = strategy
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.verify = verify and strategy == 'copy'
+        self.buffer_size = buffer_size
+        self.jobs = []
+        self.lock = threading.Lock()
+
+    def submit(self, name, files, directory, context=None):
+        """
+        Start placing a shoot
+
+        Args:
+            name: The name to show for the job
+            files: A list of (src, dst) path pairs
+            directory: The shoot's destination directory
+            context: Anything JSON serializable the caller wants to keep
+                with the job. It is also given back by recover().
+
+        Returns:
+            The CopyJob. If any destination already exists the job fails
+            without touching any file.
+        """
+        job = CopyJob(name, files, context, directory)
+        destinations = [dst for _, dst in files]
+        existing = [dst for dst in destinations if os.path.lexists(dst)]
+        if existing or len(set(destinations)) != len(destinations):
+            # Never replace a file, and never roll back one that isn't ours
+            job.add_error("{} already exists".format(existing[0]) if existing else "Two files would be placed at the same path")
+            with self.lock:
+                self.jobs.append(job)
+            return job
+        self.journal.begin(job.id, self.strategy, files, directory, context)
+        job.futures = [self.executor.submit(self.copy, job, index, src, dst) for index, (src, dst) in enumerate(files)]
+        with self.lock:
+            self.jobs.append(job)
+        return job
+
+    def copy(self, job, index, src, dst):
+        """
+        Place (and optionally verify) one file of a job
+
+        Runs on a worker thread.
+        """
+        try:
+            place_file(src, dst, self.strategy, job.add_progress, self.buffer_size)
+            if self.verify and file_checksum(src, self.buffer_size) != file_checksum(dst, self.buffer_size):
+                os.remove(dst)
+                raise IOError("Checksum mismatch copying {} to {}".format(src, dst))
+            job.add_placed(index)
+            self.journal.done(job.id, index)
+        except Exception as e:
+            job.add_error("{}: {}".format(src, e))
+
+    def commit(self, job):
+        """
+        Mark a finished shoot as complete in the journal
+
+        Args:
+            job: The finished CopyJob
+        """
+        self.journal.commit(job.id)
+
+    def rollback(self, job):
+        """
+        Undo a shoot that failed part way through
+
+        Only the files the job placed are undone.
+
+        Args:
+            job: The finished CopyJob
+        """
+        if not job.futures:
+            undo([], self.strategy, job.directory) # Refused by submit(), nothing was placed or journaled
+            return
+        undo([pair for index, pair in enumerate(job.files) if index in job.placed], self.strategy, job.directory)
+        self.journal.abort(job.id)
+
+    def recover(self, mode='forward'):
+        """
+        Finish or undo the shoots that were being placed when we last stopped
+
+        Rolling back undoes every file found at its destination. Nothing
+        existed there when the shoot was journaled (see submit()), so
+        those files are all ours, even the ones placed just before a
+        crash without being logged as done.
+
+        Args:
+            mode: 'forward' to place the rest of each shoot's files,
+                'back' to undo the files that were placed
+
+        Returns:
+            An (id, context, files) tuple for every shoot that was rolled
+            forward. The caller should record these shoots and then mark
+            them complete with commit_recovered().
+        """
+        recovered = []
+        for job_id, placement in self.journal.pending().items():
+            files = [tuple(pair) for pair in placement['files']]
+            strategy = placement['strategy']
+            if mode == 'forward':
+                try:
+                    for index, (src, dst) in enumerate(files):
+                        if index not in placement['placed'] and not is_placed(src, dst, strategy):
+                            place_file(src, dst, strategy, buffer_size=self.buffer_size)
+                        self.journal.done(job_id, index)
+                    recovered.append((job_id, placement['context'], files))
+                    continue
+                except (OSError, IOError) as e:
+                    print("Could not finish placing {}, rolling it back: {}".format(placement['dir'], e))
+            undo(files, strategy, placement['dir'])
+            self.journal.abort(job_id)
+        return recovered
+
+    def commit_recovered(self, job_id):
+        """
+        Mark a shoot rolled forward by recover() as complete
+
+        Args:
+            job_id: The id recover() returned for the shoot
+        """
+        self.journal.commit(job_id)
+
+    def active(self):
+        """
+        Returns:
+            The jobs that are still copying
+        """
+        with self.lock:
+            return [job for job in self.jobs if not job.done()]
+
+    def finished(self):
+        """
+        Take the jobs that have finished since the last call
+
+        Returns:
+            The finished CopyJobs
+        """
+        done = []
+        with self.lock:
+            running = []
+            for job in self.jobs:
+                (done if job.done() else running).append(job)
+            self.jobs = running
+        return done
+
+    def shutdown(self, wait=True):
+        """
+        Stop the worker threads
+
+        Args:
+            wait: Whether to wait for the copies in progress to finish
+        """
+        self.executor.shutdown(wait=wait)
+        if wait:
+            self.journal.compact()
+
+
+def undo(files, strategy, directory):
+    """
+    Undo a shoot's placement and remove its directory if that leaves it empty
+
+    Args:
+        files: The (src, dst) path pairs of the shoot's placed files
+        strategy: The strategy the files were placed with
+        directory: The shoot's destination directory
+    """
+    for src, dst in files:
+        unplace_file(src, dst, strategy)
+    if directory and os.path.isdir(directory):
+        if set(os.listdir(directory)) - {'metadata.json'}:
+            return # Something else is in there, leave it alone
+        metadata = os.path.join(directory, 'metadata.json')
+        if os.path.exists(metadata):
+            os.remove(metadata)
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass # Something turned up in the meantime
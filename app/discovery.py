@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Image Discovery
+
+Walks the source tree for images lazily, so the editor
+can start working as soon as the first images are found
+instead of waiting for the whole archive to be listed.
+
+Author: Ethan Dinnen
+"""
+import os
+import queue
+import threading
+
+
+def iter_images(src, suffix='.jpg', on_directory=None):
+    """
+    Walk a source tree for images with os.scandir
+
+    Directories are walked depth first in name order, so the
+    order is stable between runs. Nothing but the directories
+    still to be visited is held in memory.
+
+    Args:
+        src: The directory to search
+        suffix: The file name ending of the images we want
+        on_directory: Optional function called with each directory's
+            path and its list of os.DirEntry objects as it is scanned
+
+    Yields:
+        The path of every matching file
+    """
+    stack = [src]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+        except OSError as e:
+            print("Could not scan {}: {}".format(directory, e))
+            continue
+        if on_directory is not None:
+            on_directory(directory, entries)
+        subdirectories = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.name.endswith(suffix) and entry.is_file():
+                yield os.path.normpath(entry.path)
+        stack.extend(reversed(subdirectories)) # Visit them in name order
+
+
+class ImageDiscovery(object):
+    """
+    Find images on a background thread and queue them up
+
+    The queue is bounded, so the walk only ever runs a little
+    ahead of whoever is consuming the images.
+    """
+
+    def __init__(self, src, accept=None, maxsize=256, on_directory=None):
+        """
+        Start walking the source tree
+
+        Args:
+            src: The directory to search
+            accept: Optional function returning False for images to leave out
+            maxsize: How many images to queue up ahead of the consumer
+            on_directory: Passed on to iter_images()
+        """
+        self.src = src
+        self.accept = accept
+        self.on_directory = on_directory
+        self.queue = queue.Queue(maxsize)
+        self.found = 0 # How many images have been queued so far
+        self.done = False # Whether the whole tree has been walked
+        self.finished = False # Whether the consumer has taken every image
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="ImageDiscovery")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """
+        Walk the tree and queue up the images we find
+        """
+        try:
+            for path in iter_images(self.src, on_directory=self.on_directory):
+                if self.stopped.is_set():
+                    return
+                if self.accept is not None and not self.accept(path):
+                    continue
+                if not self.put(path):
+                    return
+                self.found += 1
+        finally:
+            self.done = True
+            self.put(None) # Let the consumer know we're finished
+
+    def put(self, item):
+        """
+        Queue an item, giving up if we are stopped while the queue is full
+
+        Returns:
+            True if the item was queued
+        """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def poll(self):
+        """
+        Take the next image without waiting
+
+        Returns:
+            The path of the next image, or None if none is ready yet
+
+        Raises:
+            StopIteration: Once every image has been taken
+        """
+        if self.finished:
+            raise StopIteration
+        try:
+            path = self.queue.get_nowait()
+        except queue.Empty:
+            return None
+        if path is None:
+            self.finished = True
+            raise StopIteration
+        return path
+
+    def __iter__(self):
+        """
+        Yields:
+            Every image, waiting for the walk as needed
+        """
+        while not self.finished:
+            path = self.queue.get()
+            if path is None:
+                self.finished = True
+                return
+            yield path
+
+    def stop(self):
+        """
+        Stop walking the tree
+        """
+        self.stopped.set()
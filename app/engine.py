@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Classifier Engine
+
+Keeps a single copy of our cross-trained Tensorflow model
+loaded for the lifetime of the process so that the GUI and
+any batch tooling can classify images without parsing and
+importing the frozen graph again for every image.
+
+Author: Ethan Dinnen
+"""
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from label_image import get_preprocessor, load_graph
+from predictions import load_labels, top_labels
+from timing import LatencyStats
+
+
+class ClassifierEngine(object):
+    """
+    Own one graph, one session and the resolved input/output operations
+
+    The engine is safe to share between threads, Tensorflow sessions
+    may be run concurrently.
+    """
+
+    def __init__(self, model_file="./output_graph.pb", input_layer="Placeholder", output_layer="model",
+                 input_height=299, input_width=299, input_mean=0, input_std=255):
+        """
+        Load the frozen model and open a session on it
+
+        Args:
+            model_file: The frozen model (.pb)
+            input_layer: The name of our input layer
+            output_layer: The name of our output layer
+            input_height: The height the model expects images to be
+            input_width: The width the model expects images to be
+            input_mean: The mean to subtract from the pixel values
+            input_std: The standard deviation to divide the pixel values by
+        """
+        self.input_height = input_height
+        self.input_width = input_width
+        self.input_mean = input_mean
+        self.input_std = input_std
+
+        start = time.time()
+        self.graph = load_graph(model_file)
+        self.input_operation = self.graph.get_operation_by_name("import/" + input_layer)
+        self.output_operation = self.graph.get_operation_by_name("import/" + output_layer)
+        self.graph.finalize() # Nothing should ever be added to the model graph after loading
+        self.sess = tf.Session(graph=self.graph)
+        self.load_time = time.time() - start
+        self.warmup_time = None
+
+        self.preprocessor = get_preprocessor(input_height, input_width, input_mean, input_std)
+        self.latency = LatencyStats()
+
+    def warm_up(self):
+        """
+        Run a blank image through the model
+
+        The first run of a session allocates memory and picks kernels,
+        so we do it up front instead of on the editor's first image.
+
+        Returns:
+            How long the warm up took in seconds
+        """
+        blank = np.zeros((1, self.input_height, self.input_width, 3), dtype=np.float32)
+        start = time.time()
+        self.sess.run(self.output_operation.outputs[0], {self.input_operation.outputs[0]: blank})
+        self.warmup_time = time.time() - start
+        return self.warmup_time
+
+    def run(self, tensor):
+        """
+        Run the model on a batch of preprocessed images
+
+        Args:
+            tensor: A [batch, height, width, 3] array of normalized pixels
+
+        Returns:
+            A [batch, classes] array of scores
+        """
+        start = time.time()
+        results = self.sess.run(self.output_operation.outputs[0], {
+            self.input_operation.outputs[0]: tensor
+        })
+        self.latency.add(time.time() - start, len(tensor))
+        return results
+
+    def classify(self, tensor):
+        """
+        Classify a single preprocessed image
+
+        Args:
+            tensor: A [1, height, width, 3] array of normalized pixels
+
+        Returns:
+            A 1-D array of scores, one per label
+        """
+        return np.squeeze(self.run(tensor))
+
+    def classify_file(self, file_name):
+        """
+        Classify a single image file
+
+        Args:
+            file_name: Path to the image
+
+        Returns:
+            A 1-D array of scores, one per label
+        """
+        return self.classify(self.preprocessor.from_file(file_name))
+
+    def classify_array(self, pixels):
+        """
+        Classify an image that has already been decoded
+
+        Args:
+            pixels: A [height, width, 3] array of RGB pixels
+
+        Returns:
+            A 1-D array of scores, one per label
+        """
+        return self.classify(self.preprocessor.from_array(pixels))
+
+    def report(self):
+        """
+        Returns:
+            A human readable summary of the load, warm up and per image times
+        """
+        lines = ["Model loaded in {:.2f} s".format(self.load_time)]
+        if self.warmup_time is not None:
+            lines.append("Warm up took {:.2f} s".format(self.warmup_time))
+        lines.append(self.latency.summary("Steady-state inference per image"))
+        return "\n".join(lines)
+
+    def close(self):
+        """
+        Release the session
+        """
+        self.sess.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure warm up and steady-state classification latency")
+    parser.add_argument("images", nargs="+", help="images to classify")
+    parser.add_argument("--graph", default="./output_graph.pb", help="graph/model to be executed")
+    parser.add_argument("--labels", default="./output_labels.txt", help="name of file containing labels")
+    parser.add_argument("--repeat", type=int, default=1, help="how many times to classify each image")
+    args = parser.parse_args()
+
+    engine = ClassifierEngine(args.graph)
+    engine.warm_up()
+    labels = load_labels(args.labels)
+    for _ in range(args.repeat):
+        for image in args.images:
+            label, score = top_labels(engine.classify_file(image), labels, k=1)[0]
+            print(image, label, score)
+    print(engine.report())
+    engine.close()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Image helpers
+
+Decoding and resizing shared by the GUI and the batch
+tools. Nothing in here needs Tensorflow.
+
+Author: Ethan Dinnen
+"""
+import threading
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+NORMALIZED_SIZE = (1024, 768) # The (width, height) our training data was resized to
+
+
+class DecodedFrame(object):
+    """
+    An image decoded once and shared by everything that needs its pixels
+
+    The image is decoded the first time its pixels are needed,
+    straight into a NumPy buffer. The display thumbnail and the
+    normalized model input are both resized from that buffer.
+    """
+
+    decodes = 0 # How many images have been decoded, for benchmarking
+    decodes_lock = threading.Lock()
+
+    def __init__(self, path, size=NORMALIZED_SIZE):
+        """
+        Args:
+            path: The path to the image
+            size: The smallest (width, height) we need the pixels at. JPEGs
+                larger than this are scaled down while decoding.
+        """
+        self.path = str(path)
+        self.size = size
+        self._pixels = None
+        self.lock = threading.Lock()
+
+    @property
+    def pixels(self):
+        """
+        The decoded image as a [height, width, 3] RGB uint8 array,
+        turned upright according to its EXIF orientation like
+        cv2.imread() does
+
+        Raises:
+            IOError: If the image could not be read
+        """
+        with self.lock:
+            if self._pixels is None:
+                im = Image.open(self.path)
+                im.draft('RGB', self.size) # Let libjpeg skip detail we'd throw away
+                im = ImageOps.exif_transpose(im) # Camera JPEGs are often stored sideways
+                self._pixels = np.asarray(im.convert('RGB'))
+                with DecodedFrame.decodes_lock:
+                    DecodedFrame.decodes += 1
+            return self._pixels
+
+    def thumbnail(self, box):
+        """
+        Make a thumbnail that fits in a box, keeping the aspect ratio
+
+        Like PIL's thumbnail(), images are never scaled up.
+
+        Args:
+            box: The (width, height) to fit the thumbnail in
+
+        Returns:
+            The thumbnail as a PIL Image
+        """
+        pixels = self.pixels
+        height, width = pixels.shape[:2]
+        scale = min(float(box[0]) / width, float(box[1]) / height, 1.0)
+        size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+        if size != (width, height):
+            pixels = cv2.resize(pixels, size, interpolation=cv2.INTER_AREA)
+        return Image.fromarray(pixels)
+
+    def normalized(self):
+        """
+        Normalize the image for the classifier to 1024 x 768
+
+        This is the same resize our training data went through
+        in preprocess.py, done in memory.
+
+        Returns:
+            The normalized image as an RGB numpy array
+        """
+        return cv2.resize(self.pixels, self.size)
+
+
+def normalize_image(path, width=1024, height=768):
+    """
+    Normalize an image for the classifier to 1024 x 768
+
+    Args:
+        path: The path to the image
+        width: The normalized width
+        height: The normalized height
+
+    Returns:
+        The normalized image as an RGB numpy array
+
+    Raises:
+        IOError: If the image could not be read
+    """
+    return DecodedFrame(path, (width, height)).normalized()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Placement Journal
+
+A write-ahead log of the shoots being placed into
+./categorized. Every shoot is logged before any of its
+files are touched, so a crash part way through can be
+rolled forward or back when the application restarts.
+
+Author: Ethan Dinnen
+"""
+import json
+import os
+import threading
+
+
+class PlacementJournal(object):
+    """
+    An append-only journal of shoot placements
+
+    Each line is a JSON record:
+        begin  - a shoot is about to be placed, with all its files
+        done   - one of the shoot's files has been placed
+        commit - the whole shoot was placed and recorded
+        abort  - the shoot was rolled back
+    """
+
+    def __init__(self, journal_file="./placement.journal"):
+        """
+        Args:
+            journal_file: The path to the journal
+        """
+        self.journal_file = journal_file
+        self.lock = threading.Lock()
+        if os.path.exists(journal_file):
+            # Drop a record cut off by a crash so new records start on a fresh line
+            with open(journal_file, 'rb+') as journal:
+                data = journal.read()
+                journal.truncate(data.rfind(b'\n') + 1)
+        self.journal = open(journal_file, 'a')
+
+    def write(self, record):
+        """
+        Append a record and make sure it is on disk before returning
+        """
+        with self.lock:
+            self.journal.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def begin(self, job_id, strategy, files, directory, context=None):
+        """
+        Log a shoot before any of its files are placed
+
+        Args:
+            job_id: A unique id for the placement
+            strategy: How the files are placed (see copier.STRATEGIES)
+            files: A list of (src, dst) path pairs
+            directory: The shoot's destination directory
+            context: Anything JSON serializable to get back on recovery
+        """
+        self.write({'op': 'begin', 'id': job_id, 'strategy': strategy, 'files': files,
+                    'dir': directory, 'context': context})
+
+    def done(self, job_id, index):
+        """
+        Log that one file of a shoot has been placed
+
+        Args:
+            job_id: The placement's id
+            index: The index of the file in the begin record
+        """
+        self.write({'op': 'done', 'id': job_id, 'index': index})
+
+    def commit(self, job_id):
+        self.write({'op': 'commit', 'id': job_id})
+
+    def abort(self, job_id):
+        self.write({'op': 'abort', 'id': job_id})
+
+    def pending(self):
+        """
+        Find the placements that were never committed or aborted
+
+        Returns:
+            A dictionary of id -> begin record, with a 'placed' set of
+            the indexes of the files that were placed
+        """
+        placements = {}
+        with self.lock, open(self.journal_file) as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break # A record cut off by the crash, nothing after it was written
+                if record['op'] == 'begin':
+                    record['placed'] = set()
+                    placements[record['id']] = record
+                elif record['op'] == 'done' and record['id'] in placements:
+                    placements[record['id']]['placed'].add(record['index'])
+                elif record['op'] in ('commit', 'abort'):
+                    placements.pop(record['id'], None)
+        return placements
+
+    def compact(self):
+        """
+        Empty the journal if nothing in it is still pending
+        """
+        if self.pending():
+            return
+        with self.lock:
+            self.journal.close()
+            self.journal = open(self.journal_file, 'w')
+
+    def close(self):
+        with self.lock:
+            self.journal.close()
@@ -18,6 +18,7 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import threading
 
 import numpy as np
 import tensorflow as tf
@@ -35,33 +36,102 @@ def load_graph(model_file):
   return graph
 
 
+class ImagePreprocessor(object):
+  """Decodes, resizes and normalizes images with a graph built only once.
+
+  The preprocessing ops live in their own finalized graph with a single
+  long-lived session, so feeding it any number of images never adds ops
+  to a graph. Images can be fed as raw encoded bytes, as decoded
+  [height, width, 3] RGB arrays, or as batches of decoded images of the
+  same size, which are resized and normalized in a single run.
+  """
+
+  def __init__(self,
+               input_height=299,
+               input_width=299,
+               input_mean=0,
+               input_std=255):
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      self.bytes_input = tf.placeholder(tf.string, name="image_bytes")
+      # decode_image handles jpeg, png, bmp and gif. Gifs decode to
+      # [frames, height, width, 3], so only keep the first frame.
+      image_reader = tf.image.decode_image(self.bytes_input, channels=3)
+      image_reader = tf.reshape(
+          image_reader, tf.concat([[-1], tf.shape(image_reader)[-3:]], 0))[0]
+      image_reader.set_shape([None, None, 3])
+      self.bytes_output = self._normalize(image_reader, input_height,
+                                          input_width, input_mean, input_std)
+
+      self.array_input = tf.placeholder(
+          tf.float32, [None, None, 3], name="image_array")
+      self.array_output = self._normalize(self.array_input, input_height,
+                                          input_width, input_mean, input_std)
+
+      self.batch_input = tf.placeholder(
+          tf.uint8, [None, None, None, 3], name="image_batch")
+      self.batch_output = self._normalize_batch(self.batch_input,
+                                                input_height, input_width,
+                                                input_mean, input_std)
+    self.graph.finalize()
+    self.sess = tf.Session(graph=self.graph)
+
+  @staticmethod
+  def _normalize(image, input_height, input_width, input_mean, input_std):
+    dims_expander = tf.expand_dims(image, 0)
+    return ImagePreprocessor._normalize_batch(dims_expander, input_height,
+                                              input_width, input_mean,
+                                              input_std)
+
+  @staticmethod
+  def _normalize_batch(images, input_height, input_width, input_mean,
+                       input_std):
+    float_caster = tf.cast(images, tf.float32)
+    resized = tf.image.resize_bilinear(float_caster,
+                                       [input_height, input_width])
+    return tf.divide(tf.subtract(resized, [input_mean]), [input_std])
+
+  def from_bytes(self, image_data):
+    return self.sess.run(self.bytes_output, {self.bytes_input: image_data})
+
+  def from_file(self, file_name):
+    with open(file_name, "rb") as f:
+      return self.from_bytes(f.read())
+
+  def from_array(self, image):
+    return self.sess.run(self.array_output, {self.array_input: image})
+
+  def from_batch(self, images):
+    """Normalizes a [batch, height, width, 3] uint8 array of RGB images."""
+    return self.sess.run(self.batch_output, {self.batch_input: images})
+
+  def close(self):
+    self.sess.close()
+
+
+_preprocessors = {}
+_preprocessors_lock = threading.Lock()
+
+
+def get_preprocessor(input_height=299,
+                     input_width=299,
+                     input_mean=0,
+                     input_std=255):
+  key = (input_height, input_width, input_mean, input_std)
+  with _preprocessors_lock:
+    if key not in _preprocessors:
+      _preprocessors[key] = ImagePreprocessor(*key)
+    return _preprocessors[key]
+
+
 def read_tensor_from_image_file(file_name,
                                 input_height=299,
                                 input_width=299,
                                 input_mean=0,
                                 input_std=255):
-  input_name = "file_reader"
-  output_name = "normalized"
-  file_reader = tf.read_file(file_name, input_name)
-  if file_name.endswith(".png"):
-    image_reader = tf.image.decode_png(
-        file_reader, channels=3, name="png_reader")
-  elif file_name.endswith(".gif"):
-    image_reader = tf.squeeze(
-        tf.image.decode_gif(file_reader, name="gif_reader"))
-  elif file_name.endswith(".bmp"):
-    image_reader = tf.image.decode_bmp(file_reader, name="bmp_reader")
-  else:
-    image_reader = tf.image.decode_jpeg(
-        file_reader, channels=3, name="jpeg_reader")
-  float_caster = tf.cast(image_reader, tf.float32)
-  dims_expander = tf.expand_dims(float_caster, 0)
-  resized = tf.image.resize_bilinear(dims_expander, [input_height, input_width])
-  normalized = tf.divide(tf.subtract(resized, [input_mean]), [input_std])
-  sess = tf.Session()
-  result = sess.run(normalized)
-
-  return result
+  preprocessor = get_preprocessor(input_height, input_width, input_mean,
+                                  input_std)
+  return preprocessor.from_file(file_name)
 
 
 def load_labels(label_file):
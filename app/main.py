@@ -10,18 +10,42 @@ image.
 
 Author: Ethan Dinnen
 """
+import argparse
 import tkinter as tk
-from PIL import Image, ImageTk
+from PIL import ImageTk
 import os
-import numpy as np
-import cv2
 import re
 import pathlib
 import unidecode
-import json
+import time
+import threading
+import queue
 from shutil import copyfile
 
-from label_image import *
+from copier import STRATEGIES, CopyEngine, unique_path
+from imaging import DecodedFrame
+from predictions import PredictionStore, load_labels, model_identity, top_labels
+from discovery import ImageDiscovery
+from journal import PlacementJournal
+from metadata import MetadataStore, write_metadata_file
+from prefetch import Prefetcher
+from progress import ProgressIndex
+from shoots import ShootIndex
+from thumbnails import ThumbnailCache
+from timing import LatencyStats
+
+PREDICTIONS_FILE = "./predictions.db" # Written by batch_classify.py
+PROGRESS_FILE = "./progress.db" # Index of the images we have already categorized
+COPY_WORKERS = 4 # How many files to copy into ./categorized at the same time
+VERIFY_COPIES = False # Whether to checksum every copy against its original
+JOURNAL_FILE = "./placement.journal" # Write-ahead log of the shoots being placed
+METADATA_FILE = "./metadata.db" # Indexed metadata of every categorized shoot
+WRITE_METADATA_JSON = True # Whether to also write metadata.json into every shoot (see metadata.py export)
+THUMBNAIL_DIR = "./.thumbnails" # Cache of the thumbnails we have displayed
+THUMBNAIL_CACHE_SIZE = 512 * 1024 * 1024 # How large the thumbnail cache may grow in bytes
+
+PREFETCH_DEPTH = 8 # How many images to decode and classify ahead of the editor
+PREFETCH_WORKERS = 2 # How many threads to prepare images with
 
 class ImageClassifier(tk.Frame):
     """
@@ -31,12 +55,14 @@ class ImageClassifier(tk.Frame):
     images with our cross-trained Tensorflow model
     """
 
-    def __init__(self, parent, *args, **kwargs):
+    def __init__(self, parent, *args, placement='copy', recovery='forward', **kwargs):
         """
         Initialize the GUI and start classification
 
         Args:
             parent: The Tkinter window
+            placement: How to put categorized files in place: copy, hardlink, reflink or move
+            recovery: Whether to roll shoots interrupted by a crash 'forward' or 'back'
 
         Returns:
             null
@@ -44,8 +70,23 @@ class ImageClassifier(tk.Frame):
         # Initialize some variables we will need
         self.category = '' # The selected category for the image
         self.shoot_name = '' # The name of the current image's parent directory
+        self.shoot_dir = '' # The path of the current image's parent directory
+        self.notice = '' # A warning to show the editor in the status line
         self.labels = load_labels("./output_labels.txt")
 
+        # Use the predictions batch_classify.py made ahead of time if we have them
+        self.predictions = None
+        if pathlib.Path(PREDICTIONS_FILE).exists(): # Only opened, each image's prediction is read as it is needed
+            self.predictions = PredictionStore(PREDICTIONS_FILE, model_identity("./output_graph.pb", "./output_labels.txt"))
+            print("Using precomputed predictions from {}".format(PREDICTIONS_FILE))
+
+        # Our model is loaded once and reused for every image. With precomputed
+        # predictions it is only loaded if an image needs to be classified live.
+        self.engine = None
+        self.engine_lock = threading.Lock()
+        if self.predictions is None:
+            self.get_engine()
+
         # Load categories
         if not pathlib.Path("./categories.txt").exists(): # Create our category file if it does not exist
             if pathlib.Path("./categorized").exists(): # If the editor has already categorized some images, they could have added new categories. So we want to load them
@@ -64,14 +105,37 @@ class ImageClassifier(tk.Frame):
 
         self.root = parent
         self.root.wm_title("Classify Image")
-
-        # Create the list of images to process
+        self.closing = False
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+
+        self.progress = ProgressIndex(PROGRESS_FILE) # The images we have already processed
+        migrated = self.progress.migrate("./categorized") # Only walks ./categorized the first time
+        if migrated:
+            print("Indexed {} previously categorized images".format(migrated))
+        self.metadata_store = MetadataStore(METADATA_FILE) # The metadata of the shoots we have categorized
+        migrated = self.metadata_store.migrate("./categorized") # Only reads the metadata.json files the first time
+        if migrated:
+            print("Indexed the metadata of {} previously categorized shoots".format(migrated))
+
+        # Shoots are placed into ./categorized in the background. Finish off
+        # any shoot we were in the middle of placing when we last stopped.
+        self.placement = placement
+        self.copier = CopyEngine(PlacementJournal(JOURNAL_FILE), strategy=placement, workers=COPY_WORKERS, verify=VERIFY_COPIES)
+        for job_id, context, files in self.copier.recover(recovery):
+            print("Finished placing {} in {}".format(context[1], context[2]))
+            self.record_shoot(context, files)
+            self.copier.commit_recovered(job_id)
+
+        # Start finding the images to process
         src = "./TestImages/"
-        path = pathlib.Path(src)
-        completed = "./categorized"
-        completedPath = pathlib.Path(completed)
-        self.list_completed = [re.match(r'.*/(.*)/(.*)$', str(f))[2] for f in completedPath.glob('**/*.jpg') if f.is_file()] # Find the images we have already processed
-        self.list_images = [f for f in path.glob('**/*.jpg') if f.is_file() and re.match(r'.*/(.*)/(.*)$', str(f))[2] not in self.list_completed] # Find all the unprocessed images
+        self.src = src
+        # Find all the unprocessed images in the background, we start on them as soon as they turn up
+        # and index every shoot's files as we go
+        self.shoots = ShootIndex()
+        self.confirmedShoots = set() # Shoot directories placed this session
+        self.newShoots = queue.Queue() # Shoot directories found with images to categorize, for the shoot list
+        self.queuedShoots = set() # The shoot directories already put on newShoots, only used by the discovery thread
+        self.discovery = ImageDiscovery(src, accept=self.accept_image, on_directory=self.shoots.add_directory)
 
         self.frame1 = tk.Frame(self.root, width=500, height=400, bd=2)
         self.frame1.grid(row=1, column=0)
@@ -83,245 +147,405 @@ class ImageClassifier(tk.Frame):
         self.frame2 = tk.Frame(self.canvas2, width=700, height=400, bd=2)
         self.canvas2.create_window(0,0,window=self.frame2,anchor='nw')
 
-        claButton = tk.Button(self.root, text='Confirm', height=2, width=10, command=self.copy_to_category)
-        claButton.grid(row=0, column=1, padx=2, pady=2)
+        self.confirmButton = tk.Button(self.root, text='Confirm', height=2, width=10, command=self.copy_to_category)
+        self.confirmButton.grid(row=0, column=1, padx=2, pady=2)
         nextButton = tk.Button(self.root, text='Skip', height=2, width=8, command=self.next_image)
         nextButton.grid(row=0, column=0, padx=2, pady=2)
+        self.statusVar = tk.StringVar()
+        status = tk.Label(self.root, textvariable=self.statusVar, anchor='w')
+        status.grid(row=2, column=0, columnspan=2, sticky='w', padx=2)
+        self.placeholders = [] # Every text field's StringVar and placeholder text
+        self.form_latency = LatencyStats() # How long resetting the fields takes per image
+        self.create_fields()
         # GUI Initialized
 
-        # Begin classifying images
+        # Begin preparing and classifying images in the background
+        self.thumbnails = ThumbnailCache(THUMBNAIL_DIR, THUMBNAIL_CACHE_SIZE)
         self.counter = 0
-        self.max_counter = len(self.list_images)-1
+        self.waiting = False # Whether we are waiting on the next image to be prepared
+        self.poll_id = None # The pending Tk callback checking if the next image is ready
+        self.requested = time.time() # When the editor asked for the next image
+        self.display_latency = LatencyStats()
+        self.prefetcher = Prefetcher(self.discovery, self.prepare_image, depth=PREFETCH_DEPTH, workers=PREFETCH_WORKERS)
         self.next_image()
+        self.update_status()
 
     def next_image(self):
         """
         Open the next image
 
         This function clears the canvases and
-        opens the next image in our list_images
-        array
+        displays the next image prepared from the
+        images we have discovered
+        """
+        if self.waiting:
+            # The editor skipped an image that was not even ready yet
+            self.prefetcher.skip()
+            self.counter += 1
+        if self.poll_id is not None:
+            self.after_cancel(self.poll_id)
+        self.requested = time.time()
+        self.show_next()
+
+    def show_next(self):
+        """
+        Display the next image once it has been prepared
+
+        If the image is still being prepared we check back
+        shortly instead of blocking the GUI.
         """
-        # Clear the frame
-        for widget in self.frame2.winfo_children():
-            widget.destroy()
-        if self.counter > self.max_counter:
+        self.poll_id = None
+        if self.prefetcher.empty():
             # Wow, no more images! Clear the canvases and notify editor
+            self.waiting = False
             self.canvas1.delete("all")
             self.canvas2.delete("all")
             self.canvas1.create_text(125, 65, fill="darkblue", font="Roboto 15", text="No more images!")
-        else:
-            self.im = Image.open(str(self.list_images[self.counter]))
-            self.shoot_name = re.match(r'.*/(.*)/(.*)$', str(self.list_images[self.counter]), re.IGNORECASE)[1]
-            # Calculate how large to make the thumbnail
-            if (480-self.im.size[0])<(360-self.im.size[1]):
-                width = 480
-                height = width*self.im.size[1]/self.im.size[0]
-                self.next_step(height, width)
+            self.confirmButton.config(state='disabled')
+            return
+
+        if not self.prefetcher.ready():
+            if not self.waiting:
+                self.waiting = True
+                self.confirmButton.config(state='disabled')
+                self.canvas1.delete("all")
+                self.canvas1.create_text(125, 65, fill="darkblue", font="Roboto 15", text="Loading..." if self.prefetcher.pending else "Searching for images...")
+            if self.poll_id is None:
+                self.poll_id = self.after(10, self.show_next)
+            return
+
+        self.waiting = False
+        self.confirmButton.config(state='normal')
+        try:
+            path, prepared = self.prefetcher.next()
+        except Exception as e:
+            # Don't let one unreadable image stop the editor
+            print("Could not prepare image: {}".format(e))
+            self.counter += 1
+            self.show_next()
+            return
+
+        if prepared['shoot_dir'] in self.confirmedShoots:
+            # Found before its shoot was confirmed, it has already been placed
+            self.show_next()
+            return
+
+        self.im = prepared['thumbnail']
+        self.shoot_name = prepared['shoot_name']
+        self.shoot_dir = prepared['shoot_dir']
+        self.category = prepared['category']
+        self.next_step()
+        self.display_latency.add(time.time() - self.requested)
+
+    def update_status(self):
+        """
+        Show how many images we have found so far and how the copies are going
+        """
+        self.finish_copies()
+        self.update_shoot_list()
+        status = "Found {} images to categorize".format(self.discovery.found)
+        if not self.discovery.done:
+            status += ", still searching..."
+        copying = self.copier.active()
+        if copying:
+            status += "  Copying " + ", ".join("{} {:.0f}%".format(job.name, job.progress() * 100) for job in copying)
+        if self.notice:
+            status += "  " + self.notice
+        self.statusVar.set(status)
+        self.after(200, self.update_status)
+
+    def accept_image(self, path):
+        """
+        Decide whether a discovered image still needs categorizing
+
+        This runs on the discovery thread, so new shoots are
+        handed to the GUI through a queue.
+
+        Args:
+            path: The path to the image
+
+        Returns:
+            True if the image should be shown to the editor
+        """
+        shoot_dir = os.path.dirname(path)
+        if shoot_dir in self.confirmedShoots or self.progress.is_completed(path):
+            return False
+        if shoot_dir not in self.queuedShoots: # The shoot's first image
+            self.queuedShoots.add(shoot_dir)
+            self.shoots.keep(shoot_dir) # We'll want its files when it is confirmed
+            self.newShoots.put(shoot_dir)
+        return True
+
+    def update_shoot_list(self):
+        """
+        Add the shoots found since we last looked to the shoot list
+        """
+        while True:
+            try:
+                shoot_dir = self.newShoots.get_nowait()
+            except queue.Empty:
+                break
+            if shoot_dir not in self.confirmedShoots and shoot_dir not in self.shootSet:
+                self.shootList.append(shoot_dir)
+                self.shootSet.add(shoot_dir)
+                self.shootListbox.insert('end', shoot_dir)
+
+    def finish_copies(self):
+        """
+        Record the shoots whose copies have finished
+        """
+        for job in self.copier.finished():
+            if job.errors:
+                # Undo the rest of the shoot so it comes up again next time
+                self.notice = "Copying {} failed: {}".format(job.name, job.errors[0])
+                print("\n".join(job.errors))
+                self.copier.rollback(job)
             else:
-                height = 360
-                width = height*self.im.size[0]/self.im.size[1]
-                self.next_step(height, width)
+                # Remember the shoot is done so we skip it next time
+                self.record_shoot(job.context, job.files)
+                self.copier.commit(job)
+
+    def record_shoot(self, context, files):
+        """
+        Record a shoot whose files have all been placed
 
-    def next_step(self, height, width):
+        Args:
+            context: The (names, shoot name, category, destination, metadata)
+                the shoot's placement was submitted with. Shoots journaled
+                before the metadata store existed only have the first three.
+            files: The (src, dst) path pairs the shoot was placed with
+        """
+        shoot_name, category = context[1:3]
+        self.progress.mark_completed([src for src, _ in files], shoot_name, category)
+        if len(context) > 3:
+            dst, metadata = context[3:]
+            self.metadata_store.record(dst, shoot_name, category, metadata, [placed for _, placed in files])
+
+    def close(self, waiting=False):
+        """
+        Close the window once the copies in progress have finished
+
+        Args:
+            waiting: True when we are already waiting to close
+        """
+        if self.closing and not waiting:
+            return # Already waiting for the copies
+        self.closing = True
+        self.finish_copies()
+        if self.copier.active():
+            self.confirmButton.config(state='disabled')
+            self.notice = "Waiting for copies to finish before closing..."
+            self.after(200, self.close, True)
+            return
+        self.root.destroy()
+
+    def prepare_image(self, path):
+        """
+        Decode, thumbnail and classify an image
+
+        This runs on a prefetch worker thread, so it
+        must not touch any of the Tk widgets.
+
+        Args:
+            path: The path to the image
+
+        Returns:
+            A dictionary with the image's thumbnail, shoot name and suggested category
+        """
+        frame = DecodedFrame(path) # Decoded at most once, by whichever step needs the pixels first
+        im = self.thumbnails.get(path, make=frame.thumbnail) # Straight from the cache if we've seen it before
+
+        top_k = self.predictions.lookup(path) if self.predictions is not None else None
+        if top_k:
+            category = top_k[0][0] # Already classified by batch_classify.py
+        else:
+            pixels = self.normalize(frame) # Normalize the image for the classifier
+            category = self.classify_obj(pixels) # Classify the normalized image
+        return {
+            'thumbnail': im,
+            'shoot_name': os.path.basename(os.path.dirname(str(path))),
+            'shoot_dir': os.path.dirname(str(path)),
+            'category': category,
+        }
+
+    def next_step(self):
         # Display the image!
-        self.im.thumbnail((width, height), Image.ANTIALIAS)
         self.root.photo = ImageTk.PhotoImage(self.im)
         self.photo = ImageTk.PhotoImage(self.im)
 
-        # If this is the first image just display it
-        if self.counter == 0:
-            self.canvas1.create_image(0, 0, anchor = 'nw', image = self.photo)
+        # Clear the canvas (the previous image or our loading message) and then display
+        self.canvas1.delete("all")
+        self.canvas1.create_image(0, 0, anchor = 'nw', image = self.photo)
 
-        # Otherwise clear the canvas first and then display
-        else:
-            self.im.thumbnail((width, height), Image.ANTIALIAS)
-            self.canvas1.delete("all")
-            self.canvas1.create_image(0, 0, anchor = 'nw', image = self.photo)
-
-        self.normalize() # Normalize the image for the classifier
-        self.classify_obj() # Classify the normalized image
-        self.create_fields() # Create the metadata editing fields for the editor
+        self.reset_fields() # Reset the metadata editing fields for the editor
 
         self.counter += 1 # Move on to the next image
 
-    def classify_obj(self):
+    def classify_obj(self, pixels):
         """
         Classify the image with our Tensorflow model
 
-        This function takes in the frozen model file (.pb) and the
-        label file in order to automatically classify our images
-        into the categories we cross trained into our model.
-        It then deletes the normalized file and creates the dropdown
-        selector for the editor.
-        """
-        model_file = "./output_graph.pb" # The frozen model
-        input_height = 299
-        input_width = 299
-        input_mean = 0
-        input_std = 255
-        input_layer = "Placeholder" # The name of our input layer
-        output_layer = "model" # The name of our output layer
-        # Load the normalized image
-        image = str(re.sub(r'\.jpg', '', str(self.list_images[self.counter]), flags=re.IGNORECASE) + '.norm.jpg')
-
-        # Load the graph
-        graph = load_graph(model_file)
-        # Create our tensor from the image
-        t = read_tensor_from_image_file(
-            image,
-            input_height,
-            input_width,
-            input_mean,
-            input_std)
-
-        # Initialize our operations
-        input_name = "import/" + input_layer
-        output_name = "import/" + output_layer
-        input_operation = graph.get_operation_by_name(input_name)
-        output_operation = graph.get_operation_by_name(output_name)
+        This function runs the normalized image through our
+        already loaded model in order to automatically classify
+        our images into the categories we cross trained into it.
 
+        Args:
+            pixels: The normalized image from normalize()
+
+        Returns:
+            The most likely category, used as the default for the editor
+        """
         # Run our model on the image
-        with tf.Session(graph=graph) as sess:
-            results = sess.run(output_operation.outputs[0], {
-                input_operation.outputs[0]: t
-            })
-        results = np.squeeze(results)
+        results = self.get_engine().classify_array(pixels)
 
-        # Get the last five reverse-ordered sorted indices of our results
-        # Results in highest to least likely 'winning' categories
-        top_k = results.argsort()[-5:][::-1]
-        labels = self.labels # Load in our labels
+        # Results are ordered from highest to least likely 'winning' categories
+        return top_labels(results, self.labels)[0][0]
 
-        # Set the category as the top result by default.
-        self.category = labels[top_k[0]]
+    def get_engine(self):
+        """
+        Get our model, loading it the first time it is needed
 
-        # Remove the normalized image
-        if os.path.exists(image):
-            os.remove(image)
+        Tensorflow is only imported here, so when every image has
+        a precomputed prediction we never pay for importing it.
 
-    def normalize(self):
+        Returns:
+            The ClassifierEngine
         """
-        Normalize the loaded image for the classifier to 1024 x 768
+        with self.engine_lock:
+            if self.engine is None:
+                from engine import ClassifierEngine
+                self.engine = ClassifierEngine("./output_graph.pb")
+                self.engine.warm_up()
+                print("Model loaded in {:.2f} s, warm up took {:.2f} s".format(self.engine.load_time, self.engine.warmup_time))
+            return self.engine
+
+    def normalize(self, frame):
         """
-        height = 1024
-        width = 768
-        im=cv2.imread(str(self.list_images[self.counter]))
-        im=cv2.resize(im,(height,width))
-        cv2.imwrite(re.sub(r'\.jpg', '', str(self.list_images[self.counter]), flags=re.IGNORECASE) + '.norm.jpg', im)
+        Normalize an image for the classifier to 1024 x 768
+
+        The pixels stay in memory, nothing is written next to the
+        original image.
+
+        Args:
+            frame: The image's DecodedFrame
+
+        Returns:
+            The normalized image as an RGB numpy array
+        """
+        return frame.normalized()
 
     def create_fields(self):
         """
         Create the fields required for metadata entry
+
+        The fields are created once and reset in place for
+        every image, see reset_fields().
         """
         # Category selector
         self.selectedCategory = tk.StringVar() # String variable to hold our choice
-        labels = {l for l in self.categories} # Dictionary with our category options
-        labels = sorted(labels)
-        self.selectedCategory.set(self.category)
-        self.selectMenu = tk.OptionMenu(self.frame2, self.selectedCategory, *labels, command=self.change_category)
+        self.menuCategories = [] # The categories currently in the selector
+        self.categoriesMtime = None # When categories.txt was last changed
+        self.selectMenu = tk.OptionMenu(self.frame2, self.selectedCategory, '', command=self.change_category)
         self.selectMenu.config(width=35)
         self.selectMenu.grid(column=1, row=0)
 
         # New category creator
-        self.newCategoryVar = tk.StringVar()
-        self.newCategoryVar.set("None of the above. Enter new category name:")
-        self.newCategory = tk.Entry(self.frame2, textvariable=self.newCategoryVar)
-        self.newCategory.config(width=35)
-        self.newCategory.bind("<FocusIn>", lambda args: self.newCategory.delete('0', 'end'))
-        self.newCategory.grid(column=1, row=3)
+        self.newCategoryVar, self.newCategory = self.create_entry("None of the above. Enter new category name:", 1, 3)
 
         # License type selector
         self.selectedLicense = tk.StringVar()
         licenses = {'Small', 'Medium', 'Large'}
-        self.selectedLicense.set('Small') # Set the default license size
         self.licenseMenu = tk.OptionMenu(self.frame2, self.selectedLicense, *licenses, command=self.change_license)
         self.licenseMenu.config(width=35)
         self.licenseMenu.grid(column=1, row=6)
 
-        # Creative name field
-        self.creativeNameVar = tk.StringVar()
-        self.creativeNameVar.set("Creative Name:") # Set our placeholder
-        self.creativeName = tk.Entry(self.frame2, textvariable=self.creativeNameVar) # Create the text field
-        self.creativeName.config(width=35)
-        self.creativeName.bind("<FocusIn>", lambda args: self.creativeName.delete('0', 'end')) # Delete placeholder text upon focus
-        self.creativeName.grid(column=1, row=9)
-
-        # Photo credit field
-        self.creditVar = tk.StringVar()
-        self.creditVar.set("Photo Credit:") # Set our placeholder
-        self.credit = tk.Entry(self.frame2, textvariable=self.creditVar) # Create the text field
-        self.credit.config(width=35)
-        self.credit.bind("<FocusIn>", lambda args: self.credit.delete('0', 'end')) # Delete placeholder text upon focus
-        self.credit.grid(column=1, row=12)
-
-        # Collection field
-        self.collectionVar = tk.StringVar()
-        self.collectionVar.set("Collection:") # Set our placeholder
-        self.collection = tk.Entry(self.frame2, textvariable=self.collectionVar) # Create the text field
-        self.collection.config(width=35)
-        self.collection.bind("<FocusIn>", lambda args: self.collection.delete('0', 'end')) # Delete placeholder text upon focus
-        self.collection.grid(column=1, row=15)
-
-        # Tags field
-        self.tagsVar = tk.StringVar()
-        self.tagsVar.set("Tags. Comma separated. E.g., tag1, tag2, tag3")
-        self.tags = tk.Entry(self.frame2, textvariable=self.tagsVar)
-        self.tags.config(width=35)
-        self.tags.bind("<FocusIn>", lambda args: self.tags.delete('0', 'end'))
-        self.tags.grid(column=1, row=18)
-
-        # Date Collected field
-        self.dateVar = tk.StringVar()
-        self.dateVar.set("Date Collected: (Format like yyyy-mm-dd)")
-        self.date = tk.Entry(self.frame2, textvariable=self.dateVar) # Create the text field
-        self.date.config(width=35)
-        self.date.bind("<FocusIn>", lambda args: self.date.delete('0', 'end')) # Delete placeholder text upon focus
-        self.date.grid(column=1, row=21)
-
-        # Editorial Number field
-        self.editorialVar = tk.StringVar()
-        self.editorialVar.set("Editorial #")
-        self.editorial = tk.Entry(self.frame2, textvariable=self.editorialVar)
-        self.editorial.config(width=35)
-        self.editorial.bind("<FocusIn>", lambda args: self.editorial.delete('0', 'end'))
-        self.date.grid(column=1, row=24)
-
-        # Restrictions
-        self.restrictionsVar = tk.StringVar()
-        self.restrictionsVar.set("Restrictions")
-        self.restrictions = tk.Entry(self.frame2, textvariable=self.restrictionsVar)
-        self.restrictions.config(width=35)
-        self.restrictions.bind("<FocusIn>", lambda args: self.restrictions.delete('0', 'end'))
-        self.restrictions.grid(column=2, row=0)
-
-        # Release
-        self.releaseVar = tk.StringVar()
-        self.releaseVar.set("Release Info")
-        self.release = tk.Entry(self.frame2, textvariable=self.releaseVar)
-        self.release.config(width=35)
-        self.release.bind("<FocusIn>", lambda args: self.release.delete('0', 'end'))
-        self.release.grid(column=2, row=3)
-
-        # Location
-        self.locationVar = tk.StringVar()
-        self.locationVar.set("Location")
-        self.location = tk.Entry(self.frame2, textvariable=self.locationVar)
-        self.location.config(width=35)
-        self.location.bind("<FocusIn>", lambda args: self.location.delete('0', 'end'))
-        self.location.grid(column=2, row=6)
-
-        # Description
-        self.descriptionVar = tk.StringVar()
-        self.descriptionVar.set("Description")
-        self.description = tk.Entry(self.frame2, textvariable=self.descriptionVar)
-        self.description.config(width=35)
-        self.description.bind("<FocusIn>", lambda args: self.description.delete('0', 'end'))
-        self.description.grid(column=2, row=9)
-
-        # Update the frame
-        self.update()
-        self.frame2.update_idletasks()
+        self.creativeNameVar, self.creativeName = self.create_entry("Creative Name:", 1, 9)
+        self.creditVar, self.credit = self.create_entry("Photo Credit:", 1, 12)
+        self.collectionVar, self.collection = self.create_entry("Collection:", 1, 15)
+        self.tagsVar, self.tags = self.create_entry("Tags. Comma separated. E.g., tag1, tag2, tag3", 1, 18)
+        self.dateVar, self.date = self.create_entry("Date Collected: (Format like yyyy-mm-dd)", 1, 21)
+        self.editorialVar, self.editorial = self.create_entry("Editorial #", 1, 24)
+        self.restrictionsVar, self.restrictions = self.create_entry("Restrictions", 2, 0)
+        self.releaseVar, self.release = self.create_entry("Release Info", 2, 3)
+        self.locationVar, self.location = self.create_entry("Location", 2, 6)
+        self.descriptionVar, self.description = self.create_entry("Description", 2, 9)
+
+        # Keep the metadata for the next shoots (confirming already applies it to the whole shoot)
+        self.stickyVar = tk.BooleanVar()
+        self.sticky = tk.Checkbutton(self.frame2, text="Keep metadata for the next shoots", variable=self.stickyVar)
+        self.sticky.grid(column=2, row=12, sticky='w')
+
+        # Other shoots to apply the same category and metadata to
+        tk.Label(self.frame2, text="Also apply to these shoots:").grid(column=2, row=15, sticky='w')
+        self.shootList = [] # The shoot directories in the list box, in order
+        self.shootSet = set() # The same directories, to check for them quickly
+        self.shootListbox = tk.Listbox(self.frame2, selectmode='extended', height=8, width=35, exportselection=False)
+        self.shootListbox.grid(column=2, row=18, rowspan=7)
+
+    def create_entry(self, placeholder, column, row):
+        """
+        Create a text field showing a placeholder until it is focused
+
+        Args:
+            placeholder: The text to show in the empty field
+            column: The grid column to put the field in
+            row: The grid row to put the field in
+
+        Returns:
+            The field's StringVar and Entry
+        """
+        var = tk.StringVar()
+        var.set(placeholder) # Set our placeholder
+        entry = tk.Entry(self.frame2, textvariable=var) # Create the text field
+        entry.config(width=35)
+        entry.bind("<FocusIn>", lambda args: var.get() == placeholder and entry.delete('0', 'end')) # Delete placeholder text upon focus
+        entry.grid(column=column, row=row)
+        self.placeholders.append((var, placeholder))
+        return var, entry
+
+    def reset_fields(self):
+        """
+        Reset the metadata fields for a new image
+
+        Only the field values change, so this costs the same no
+        matter how many categories there are. The category
+        selector is only rebuilt when categories.txt changes.
+        In sticky mode the fields are left alone, so the same
+        category and metadata can be applied to shoot after shoot.
+        """
+        start = time.time()
+        self.update_category_menu()
+        if self.stickyVar.get() and self.selectedCategory.get():
+            # Carry the editor's choices forward to the next shoot
+            self.category = self.selectedCategory.get()
+        else:
+            self.selectedCategory.set(self.category)
+            self.selectedLicense.set('Small') # Set the default license size
+            for var, placeholder in self.placeholders:
+                var.set(placeholder)
+        self.root.focus_set() # So the next click on a field clears its placeholder again
+        self.form_latency.add(time.time() - start)
+
+    def update_category_menu(self):
+        """
+        Rebuild the category selector's options if the categories have changed
+        """
+        try:
+            mtime = os.stat("./categories.txt").st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self.categoriesMtime:
+            # Someone (maybe us, maybe by hand) changed the categories
+            self.categoriesMtime = mtime
+            self.categories = load_labels("./categories.txt")
+        labels = sorted(set(self.categories))
+        if labels == self.menuCategories:
+            return
+        menu = self.selectMenu['menu']
+        menu.delete(0, 'end')
+        for label in labels:
+            menu.add_command(label=label, command=tk._setit(self.selectedCategory, label, self.change_category))
+        self.menuCategories = labels
 
     def change_category(self, *args):
         """
@@ -346,33 +570,135 @@ class ImageClassifier(tk.Frame):
 
     def copy_to_category(self):
         """
-        Copies the classified image to the chosen category folder
+        Copies the classified image's shoot to the chosen category folder
 
-        Args:
-            category: The name of the category to move the images to
+        Every shoot selected in the shoot list is placed in the
+        same category with the same metadata. A shoot that can't
+        be placed is reported and left for later, and the others
+        are still placed.
         """
         # Check if user specified a new category
         if (self.newCategoryVar.get() != "None of the above. Enter new category name:" and self.newCategoryVar.get() != ""):
             newCat = re.sub('\W+', '', self.newCategoryVar.get().lower()) # Remove non word characters and convert to lowercase
             self.add_category(newCat)
             self.category = newCat
+            # The category exists now, select it like any other so sticky mode doesn't add it again
+            self.newCategoryVar.set("None of the above. Enter new category name:")
+            self.update_category_menu()
+            self.selectedCategory.set(newCat)
+
+        metadata = self.read_metadata()
+        selected = [self.shootList[i] for i in self.shootListbox.curselection()]
+        shoot_dirs = [self.shoot_dir] + [shoot_dir for shoot_dir in selected if shoot_dir != self.shoot_dir]
+        notices = []
+        placed = []
+        for shoot_dir in shoot_dirs:
+            try:
+                notice = self.place_shoot(shoot_dir, self.category, metadata)
+                placed.append(shoot_dir)
+            except OSError as e:
+                # The shoot vanished or can't be read or written, it stays in the list to try again
+                notice = "Could not place {}: {}".format(shoot_dir, e)
+                print(notice)
+            if notice:
+                notices.append(notice)
+        self.notice = "  ".join(notices)
+
+        # The whole shoot has been placed, don't show the editor the rest of its images
+        self.confirmedShoots.update(placed)
+        self.prefetcher.cancel(lambda path: os.path.dirname(path) in self.confirmedShoots)
+        for i in reversed(range(len(self.shootList))):
+            if self.shootList[i] in self.confirmedShoots:
+                self.shootSet.discard(self.shootList[i])
+                del self.shootList[i]
+                self.shootListbox.delete(i)
+
+        # Move on to the next image, unless its own shoot wasn't placed and the editor may want to try again
+        if self.shoot_dir in self.confirmedShoots:
+            self.next_image()
+
+    def place_shoot(self, shoot_dir, category, metadata):
+        """
+        Place a shoot's files and metadata in a category folder
+
+        Args:
+            shoot_dir: The path of the shoot's directory
+            category: The name of the category to place the shoot in
+            metadata: The metadata dictionary from read_metadata()
 
-        # Find all the files in the current image's directory
-        path = pathlib.Path("./TestImages/")
-        files = [f for f in path.glob('**/{}/[!.]*'.format(self.shoot_name))]
+        Returns:
+            A notice for the editor, or an empty string
 
-        # Move them to the appropriate folder
-        dst = "./categorized/{}/{}".format(self.category, self.shoot_name)
-        pathlib.Path(dst).mkdir(parents=True, exist_ok=True)
+        Raises:
+            OSError: If the shoot couldn't be listed or its folder created,
+                or the copy couldn't be started. Nothing has been placed then.
+        """
+        # Find all the files in the shoot's directory
+        files = self.shoots.files(shoot_dir)
+
+        # Never merge into a shoot that is already in the category
+        notice = ''
+        shoot_name = self.shoot_folder_name(shoot_dir)
+        dst = "./categorized/{}/{}".format(category, shoot_name)
+        if os.path.lexists(dst):
+            dst = unique_path(dst, keep_extension=False)
+            notice = "{} is already in {}, saved it as {}".format(shoot_name, category, os.path.basename(dst))
+            print(notice)
+            shoot_name = os.path.basename(dst)
+        pathlib.Path(dst).mkdir(parents=True)
+
+        # Move them to the appropriate folder in the background
+        pairs = []
+        taken = {"{}/metadata.json".format(dst)}
         for src in files:
-            new_filename = self.slugify(re.match(r'.*/(.*)/(.*)$', str(src))[2]) # Ensure all file names are readable by browser
-            copyfile(src, "{}/{}".format(dst, new_filename))
+            # Ensure all file names are readable by browser, and that names which slugify alike don't overwrite each other
+            placed = unique_path("{}/{}".format(dst, self.slugify(os.path.basename(src))), taken)
+            taken.add(placed)
+            pairs.append((src, placed))
+        names = [os.path.basename(src) for src in files]
+        try:
+            self.copier.submit(shoot_name, pairs, dst, context=(names, shoot_name, category, dst, metadata))
+        except OSError:
+            try:
+                os.rmdir(dst) # Still empty, so the next attempt gets the same folder
+            except OSError:
+                pass
+            raise
+        self.shoots.forget(shoot_dir)
+
+        # Write the metadata file, the metadata store is updated once the files are in place
+        if WRITE_METADATA_JSON:
+            try:
+                self.write_metadata(dst, metadata)
+            except OSError as e:
+                # The files are on their way, so the shoot is placed, the file can be written with metadata.py export
+                failed = "Could not write the metadata file of {}: {}".format(shoot_name, e)
+                print(failed)
+                notice = "  ".join(n for n in (notice, failed) if n)
+        return notice
+
+    def shoot_folder_name(self, shoot_dir):
+        """
+        Name a shoot's folder in its category
 
-        # Write the metadata file
-        self.write_metadata(dst)
+        Shoots at the top of the source folder keep their directory's
+        name. Deeper shoots get the names of the directories above them
+        added, outermost first, so 2019/Smith and 2020/Smith become
+        Smith-2019 and Smith-2020. The name only depends on where the
+        shoot is, so shoots with the same name always end up apart,
+        whichever is confirmed first.
 
-        # Move on to the next image
-        self.next_image()
+        Args:
+            shoot_dir: The path of the shoot's directory
+
+        Returns:
+            The name of the shoot's folder
+        """
+        parents = os.path.relpath(os.path.dirname(os.path.abspath(shoot_dir)), os.path.abspath(self.src))
+        name = os.path.basename(os.path.abspath(shoot_dir))
+        if parents == os.curdir or parents.startswith(os.pardir):
+            return name
+        return "-".join([name] + [self.slugify(parent) for parent in parents.split(os.sep)])
 
     def add_category(self, category):
         """
@@ -381,17 +707,21 @@ class ImageClassifier(tk.Frame):
         Args:
             category: The name (string) for our new category
         """
+        if category in self.categories:
+            return # Already there, don't list it twice
         with open("./categories.txt", 'a') as categories:
             categories.write("{}\n".format(category))
         self.categories = load_labels("./categories.txt")
         self.create_folders()
 
 
-    def write_metadata(self, dst):
-        """
-        Write the current image's metadata to 'metadata.json' with corresponding image files
+    def read_metadata(self):
         """
+        Read the metadata the editor entered for the current image
 
+        Returns:
+            The metadata dictionary, with empty strings for fields left blank
+        """
         metadata = {'name': '', 'date': '', 'credit': '', 'collection': '', 'tags': '', 'license': '', 'editorial': '', 'restrictions': '', 'releaseInfo': '', 'location': '', 'description': ''}
 
         if (self.creativeNameVar.get() != "Creative Name:" and self.creativeNameVar.get() != ""):
@@ -426,8 +756,17 @@ class ImageClassifier(tk.Frame):
         if (self.descriptionVar.get() != "Description" and self.descriptionVar.get() != ""):
             metadata['description'] = self.descriptionVar.get()
 
-        with open("{}/metadata.json".format(dst), 'w') as outfile:
-            json.dump(metadata, outfile)
+        return metadata
+
+    def write_metadata(self, dst, metadata):
+        """
+        Write a shoot's metadata to 'metadata.json' with corresponding image files
+
+        Args:
+            dst: The shoot's directory in ./categorized
+            metadata: The metadata dictionary from read_metadata()
+        """
+        write_metadata_file(dst, metadata)
 
     def slugify(self, string):
         """
@@ -443,6 +782,24 @@ class ImageClassifier(tk.Frame):
         return re.sub(r'[^\w\.]+', '-', string)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Categorize images")
+    parser.add_argument("--placement", choices=STRATEGIES, default='copy', help="how to put categorized files into ./categorized")
+    parser.add_argument("--recover", choices=('forward', 'back'), default='forward', help="whether to finish or undo shoots interrupted by a crash")
+    args = parser.parse_args()
+
     root = tk.Tk()
-    classifier = ImageClassifier(root)
+    classifier = ImageClassifier(root, placement=args.placement, recovery=args.recover)
     tk.mainloop()
+    classifier.discovery.stop()
+    classifier.prefetcher.shutdown()
+    classifier.copier.shutdown()
+    classifier.progress.close()
+    classifier.metadata_store.close()
+    if classifier.predictions is not None:
+        print(classifier.predictions.summary())
+        classifier.predictions.close()
+    if classifier.engine is not None:
+        print(classifier.engine.report())
+        classifier.engine.close()
+    print(classifier.display_latency.summary("Next image displayed"))
+    print(classifier.form_latency.summary("Metadata fields reset"))
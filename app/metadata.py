@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Metadata Store
+
+Keeps the metadata of every categorized shoot in one
+indexed SQLite database, so questions like "every image
+by this photographer" are answered without opening a
+metadata.json file per shoot. The per-shoot files can
+still be written from the database at any time.
+
+Query it from the app directory:
+
+    python3 metadata.py query --credit "Jane Doe"
+    python3 metadata.py export
+
+Author: Ethan Dinnen
+"""
+import argparse
+import json
+import os
+import pathlib
+import sqlite3
+import sys
+import threading
+import time
+
+# The metadata.json keys, in the order they are written, and their columns
+FIELDS = (('name', 'name'), ('date', 'date'), ('credit', 'credit'), ('collection', 'collection'),
+          ('tags', None), ('license', 'license'), ('editorial', 'editorial'),
+          ('restrictions', 'restrictions'), ('releaseInfo', 'release_info'),
+          ('location', 'location'), ('description', 'description'))
+COLUMNS = tuple(column for _, column in FIELDS if column)
+FILTERS = ('category', 'credit', 'collection', 'license', 'date', 'location') # Indexed columns we can query on
+
+
+class MetadataStore(object):
+    """
+    A persistent, indexed record of every categorized shoot's metadata
+
+    Shoots are keyed by their directory in ./categorized. Each
+    shoot's tags and images are kept in their own tables so they
+    can be queried too. The store may be shared between threads.
+    """
+
+    def __init__(self, db_file="./metadata.db"):
+        """
+        Open (and create if needed) the metadata database
+
+        Args:
+            db_file: The path to the SQLite database
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA foreign_keys = ON") # So a shoot's tags and images go with it
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS shoots ("
+                            "id INTEGER PRIMARY KEY, directory TEXT UNIQUE, shoot TEXT, category TEXT, "
+                            + ", ".join("{} TEXT".format(column) for column in COLUMNS) + ", updated_at REAL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS tags ("
+                            "shoot_id INTEGER REFERENCES shoots(id) ON DELETE CASCADE, tag TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS images ("
+                            "path TEXT PRIMARY KEY, shoot_id INTEGER REFERENCES shoots(id) ON DELETE CASCADE)")
+            for column in FILTERS:
+                self.db.execute("CREATE INDEX IF NOT EXISTS shoots_{0} ON shoots ({0})".format(column))
+            self.db.execute("CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS tags_shoot ON tags (shoot_id)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS images_shoot ON images (shoot_id)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def record(self, directory, shoot, category, metadata, images=()):
+        """
+        Record a categorized shoot's metadata
+
+        Everything about the shoot is written in a single transaction,
+        replacing what was recorded for the directory before.
+
+        Args:
+            directory: The shoot's directory in ./categorized
+            shoot: The name of the shoot
+            category: The category the shoot was put in
+            metadata: The shoot's metadata, as written to metadata.json
+            images: The paths of the shoot's images
+        """
+        directory = os.path.normpath(directory)
+        tags = metadata.get('tags') or []
+        if isinstance(tags, str):
+            tags = [tags]
+        values = [metadata.get(key) or '' for key, column in FIELDS if column]
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM shoots WHERE directory = ?", (directory,))
+            shoot_id = self.db.execute(
+                "INSERT INTO shoots (directory, shoot, category, {}, updated_at) VALUES (?, ?, ?, {}, ?)".format(
+                    ", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))),
+                [directory, shoot, category] + values + [time.time()]).lastrowid
+            self.db.executemany("INSERT INTO tags VALUES (?, ?)", [(shoot_id, tag) for tag in tags])
+            self.db.executemany("INSERT OR REPLACE INTO images VALUES (?, ?)",
+                                [(os.path.normpath(image), shoot_id) for image in images])
+
+    def migrate(self, completed="./categorized"):
+        """
+        Import the metadata.json files written before the store existed
+
+        This walks the categorized folder once. After that the
+        store is kept up to date by record().
+
+        Args:
+            completed: The folder categorized shoots were placed in
+
+        Returns:
+            The number of shoots imported
+        """
+        with self.lock:
+            if self.db.execute("SELECT value FROM meta WHERE key = 'migrated'").fetchone():
+                return 0
+        imported = 0
+        if os.path.isdir(completed):
+            for f in pathlib.Path(completed).glob('*/*/metadata.json'):
+                try:
+                    with f.open() as infile:
+                        metadata = json.load(infile)
+                except (IOError, OSError, ValueError) as e:
+                    print("Could not import {}: {}".format(f, e))
+                    continue
+                images = [str(image) for image in f.parent.iterdir() if image.name != 'metadata.json']
+                self.record(str(f.parent), f.parent.name, f.parent.parent.name, metadata, images)
+                imported += 1
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO meta VALUES ('migrated', ?)", (str(time.time()),))
+        return imported
+
+    def find(self, tag=None, **filters):
+        """
+        Find the shoots matching every given filter
+
+        Args:
+            tag: Only shoots with this tag
+            filters: Column values to match exactly, any of FILTERS
+
+        Returns:
+            A list of (directory, category, metadata) tuples
+        """
+        where, params = self.where(tag, filters)
+        with self.lock:
+            rows = self.db.execute("SELECT * FROM shoots" + where + " ORDER BY directory", params).fetchall()
+            tags = {}
+            for row in rows:
+                tags[row['id']] = [r[0] for r in self.db.execute("SELECT tag FROM tags WHERE shoot_id = ?", (row['id'],))]
+        return [(row['directory'], row['category'], self.metadata(row, tags[row['id']])) for row in rows]
+
+    def images(self, tag=None, **filters):
+        """
+        Find the images of the shoots matching every given filter
+
+        Args:
+            tag: Only images from shoots with this tag
+            filters: Column values to match exactly, any of FILTERS
+
+        Returns:
+            A list of image paths
+        """
+        where, params = self.where(tag, filters)
+        with self.lock:
+            return [row[0] for row in self.db.execute(
+                "SELECT images.path FROM images JOIN shoots ON images.shoot_id = shoots.id"
+                + where + " ORDER BY images.path", params)]
+
+    def where(self, tag, filters):
+        """
+        Build the WHERE clause for find() and images()
+
+        Returns:
+            The clause (or an empty string) and its parameters
+        """
+        clauses = []
+        params = []
+        for column, value in sorted(filters.items()):
+            if value is None:
+                continue
+            if column not in FILTERS:
+                raise ValueError("Can not filter on {}".format(column))
+            clauses.append("shoots.{} = ?".format(column))
+            params.append(value)
+        if tag is not None:
+            clauses.append("shoots.id IN (SELECT shoot_id FROM tags WHERE tag = ?)")
+            params.append(tag)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def metadata(self, row, tags):
+        """
+        Turn a shoots row back into a metadata.json dictionary
+
+        Returns:
+            The metadata dictionary
+        """
+        metadata = {}
+        for key, column in FIELDS:
+            metadata[key] = row[column] if column else (tags or '')
+        return metadata
+
+    def export(self, **filters):
+        """
+        Write every (matching) shoot's metadata.json from the store
+
+        Returns:
+            The number of files written
+        """
+        written = 0
+        for directory, _, metadata in self.find(**filters):
+            if not os.path.isdir(directory):
+                continue # The shoot has been moved or removed since
+            write_metadata_file(directory, metadata)
+            written += 1
+        return written
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM shoots").fetchone()[0]
+
+    def close(self):
+        """
+        Close the database
+        """
+        with self.lock:
+            self.db.close()
+
+
+def write_metadata_file(directory, metadata):
+    """
+    Write a shoot's metadata to 'metadata.json' in its directory
+
+    The file is replaced atomically, so readers never see half of it.
+
+    Args:
+        directory: The shoot's directory
+        metadata: The metadata dictionary
+    """
+    path = os.path.join(directory, "metadata.json")
+    with open(path + ".partial", 'w') as outfile:
+        json.dump(metadata, outfile)
+    os.replace(path + ".partial", path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query and export categorized shoots' metadata")
+    parser.add_argument("--db", default="./metadata.db", help="the metadata database")
+    subparsers = parser.add_subparsers(dest="command")
+
+    query_parser = subparsers.add_parser("query", help="print the shoots (or images) matching every filter as JSON lines")
+    export_parser = subparsers.add_parser("export", help="write metadata.json into every matching shoot directory")
+    for subparser in (query_parser, export_parser):
+        for column in FILTERS:
+            subparser.add_argument("--" + column, help="only shoots with this " + column)
+        subparser.add_argument("--tag", help="only shoots with this tag")
+    query_parser.add_argument("--images", action="store_true", help="print the matching images instead of shoots")
+    subparsers.add_parser("import", help="import the metadata.json files in ./categorized")
+
+    args = parser.parse_args()
+    if not args.command:
+        parser.print_help()
+        sys.exit(1)
+
+    store = MetadataStore(args.db)
+    filters = {column: getattr(args, column, None) for column in FILTERS}
+    start = time.time()
+    if args.command == "query":
+        if args.images:
+            results = store.images(tag=args.tag, **filters)
+            for path in results:
+                print(path)
+        else:
+            results = store.find(tag=args.tag, **filters)
+            for directory, category, metadata in results:
+                print(json.dumps({'directory': directory, 'category': category, 'metadata': metadata}))
+        print("{} results in {:.1f} ms".format(len(results), (time.time() - start) * 1000), file=sys.stderr)
+    elif args.command == "export":
+        print("Wrote {} metadata.json files".format(store.export(tag=args.tag, **filters)))
+    elif args.command == "import":
+        store.db.execute("DELETE FROM meta WHERE key = 'migrated'") # Import again even if we did before
+        store.db.commit()
+        print("Imported {} shoots".format(store.migrate()))
+    store.close()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Predictions
+
+Look up the categories batch_classify.py already
+predicted for an image, so the GUI doesn't need to
+run (or even import) Tensorflow for it. Predictions
+are kept in an SQLite database keyed by image path,
+so the GUI only reads the ones it needs.
+
+Author: Ethan Dinnen
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+
+def model_identity(model_file, label_file):
+    """
+    Identify a model and its labels
+
+    The model is identified by its size and modification time,
+    which change whenever it is retrained, so the GUI doesn't
+    have to read the whole graph. The labels are identified by
+    their contents.
+
+    Args:
+        model_file: The path to the graph
+        label_file: The path to the labels file
+
+    Returns:
+        A string that changes whenever the model or labels do
+    """
+    stat = os.stat(model_file)
+    with open(label_file, 'rb') as labels:
+        labels_hash = hashlib.sha1(labels.read()).hexdigest()
+    return "{}|{}|{}".format(stat.st_size, stat.st_mtime_ns, labels_hash)
+
+
+def load_labels(label_file):
+    """
+    Read a labels file, one label per line
+
+    Args:
+        label_file: The path to the labels file
+
+    Returns:
+        A list of labels
+    """
+    with open(label_file) as f:
+        return [l.rstrip() for l in f]
+
+
+def top_labels(results, labels, k=5):
+    """
+    Get the most likely labels for a set of scores
+
+    Args:
+        results: A 1-D array of scores
+        labels: The list of labels the scores refer to
+        k: How many labels to return
+
+    Returns:
+        A list of (label, score) tuples from most to least likely
+    """
+    # Get the last k reverse-ordered sorted indices of our results
+    top_k = results.argsort()[-k:][::-1]
+    return [(labels[i], float(results[i])) for i in top_k]
+
+
+class PredictionStore(object):
+    """
+    Precomputed top-k predictions keyed by absolute image path
+
+    Each prediction remembers the size and modification time
+    of the image it was computed from, and the model it was
+    computed with. If the image or the model has changed since,
+    the prediction is stale and is not returned. The store may
+    be shared between threads.
+    """
+
+    def __init__(self, db_file="./predictions.db", model=None):
+        """
+        Open (and create if needed) the predictions database
+
+        Args:
+            db_file: The path to the SQLite database
+            model: The model_identity() of the model in use
+        """
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        with self.db:
+            # top_k is NULL and error is set for images that could not be classified
+            self.db.execute("CREATE TABLE IF NOT EXISTS predictions ("
+                            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, model TEXT, top_k TEXT, error TEXT)")
+
+    def current(self, path):
+        """
+        Get an image's record, if it is still current
+
+        Args:
+            path: The path to the image
+
+        Returns:
+            A (top_k, error) tuple, or None if there is no record for the
+            image or it was made from another version of the image or model
+        """
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, model, top_k, error FROM predictions WHERE path = ?",
+                                  (os.path.abspath(str(path)),)).fetchone()
+        if row is None or row[2] != self.model:
+            return None
+        size, mtime_ns, _, top_k, error = row
+        if size is not None:
+            try:
+                stat = os.stat(str(path))
+            except OSError:
+                return None
+            if stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+                return None
+        return (json.loads(top_k) if top_k else None), error
+
+    def lookup(self, path):
+        """
+        Get the stored predictions for an image
+
+        Args:
+            path: The path to the image
+
+        Returns:
+            A list of [label, score] pairs from most to least likely,
+            or None if there is no prediction or it is stale
+        """
+        record = self.current(path)
+        if record is not None and record[0]:
+            self.hits += 1
+            return record[0]
+        self.misses += 1
+        return None
+
+    def record(self, results):
+        """
+        Store the results of a batch of images
+
+        All the results are written in a single transaction, so a
+        batch is either entirely recorded or not at all.
+
+        Args:
+            results: (path, stat, top_k, error) tuples. stat is None if the
+                image could not be read, top_k is None if it could not be
+                classified.
+        """
+        rows = [(os.path.abspath(str(path)),
+                 stat.st_size if stat else None, stat.st_mtime_ns if stat else None, self.model,
+                 json.dumps(top_k, separators=(',', ':')) if top_k is not None else None, error)
+                for path, stat, top_k, error in results]
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+    def summary(self):
+        """
+        Returns:
+            A one line summary of how often predictions were reused
+        """
+        return "Precomputed predictions: {} used, {} classified live".format(self.hits, self.misses)
+
+    def close(self):
+        """
+        Close the database
+        """
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Prefetcher
+
+Prepares the images the editor is about to see on
+background threads so the GUI never waits on decoding
+or classification.
+
+Author: Ethan Dinnen
+"""
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher(object):
+    """
+    Run a preparation function over upcoming items ahead of time
+
+    At most `depth` items are queued or being prepared at any time.
+    Items are handed out in the order they came from the source.
+    """
+
+    def __init__(self, items, prepare, depth=4, workers=2):
+        """
+        Args:
+            items: An iterable of the items to prepare. If it has a
+                poll() method (like ImageDiscovery) that is used instead,
+                so we never block waiting for the next item to turn up.
+            prepare: The function to run on each item in a worker thread
+            depth: How many items to prepare ahead of the editor
+            workers: How many worker threads to use
+        """
+        if hasattr(items, 'poll'):
+            self.poll = items.poll
+        else:
+            iterator = iter(items)
+            self.poll = lambda: next(iterator)
+        self.prepare = prepare
+        self.depth = depth
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = collections.deque() # (item, future) pairs in display order
+        self.exhausted = False
+        self.fill()
+
+    def fill(self):
+        """
+        Queue up items until we are `depth` items ahead
+        """
+        while not self.exhausted and len(self.pending) < self.depth:
+            try:
+                item = self.poll()
+            except StopIteration:
+                self.exhausted = True
+                break
+            if item is None:
+                break # Nothing available yet, we'll try again next time
+            self.pending.append((item, self.executor.submit(self.prepare, item)))
+
+    def empty(self):
+        """
+        Returns:
+            True once every item has been handed out
+        """
+        self.fill()
+        return self.exhausted and not self.pending
+
+    def ready(self):
+        """
+        Returns:
+            True if the next item has finished preparing
+        """
+        self.fill()
+        return bool(self.pending) and self.pending[0][1].done()
+
+    def next(self):
+        """
+        Take the next prepared item
+
+        Blocks if the item is still being prepared.
+
+        Returns:
+            An (item, prepared) tuple. prepared is whatever the
+            preparation function returned.
+
+        Raises:
+            Any exception raised while preparing the item
+        """
+        item, future = self.pending.popleft()
+        self.fill()
+        return item, future.result()
+
+    def skip(self):
+        """
+        Drop the next item without waiting for it
+
+        Its preparation is cancelled if it has not started yet,
+        otherwise the result is thrown away.
+
+        Returns:
+            The skipped item, or None if nothing was queued
+        """
+        if not self.pending:
+            return None
+        item, future = self.pending.popleft()
+        future.cancel()
+        self.fill()
+        return item
+
+    def cancel(self, predicate):
+        """
+        Drop every queued item that matches a predicate
+
+        Args:
+            predicate: A function taking an item and returning True
+                if it should be dropped
+        """
+        keep = collections.deque()
+        for item, future in self.pending:
+            if predicate(item):
+                future.cancel()
+            else:
+                keep.append((item, future))
+        self.pending = keep
+        self.fill()
+
+    def shutdown(self):
+        """
+        Cancel everything queued and stop the worker threads
+        """
+        for _, future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
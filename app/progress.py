@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Progress Index
+
+Remembers which images have already been categorized
+in a small SQLite database, so that startup is a keyed
+lookup per image instead of a scan of ./categorized.
+
+Author: Ethan Dinnen
+"""
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+
+class ProgressIndex(object):
+    """
+    A persistent record of the images that have been categorized
+
+    Images are keyed by their absolute source path, so two shoots
+    with an IMG_0001.jpg each are tracked separately. Images imported
+    from ./categorized by migrate() only have a file name, and are
+    matched by name the way the categorized folder used to be.
+    The index may be shared between threads.
+    """
+
+    def __init__(self, db_file="./progress.db"):
+        """
+        Open (and create if needed) the progress database
+
+        Args:
+            db_file: The path to the SQLite database
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        with self.db:
+            # Images with a known source path
+            self.db.execute("CREATE TABLE IF NOT EXISTS placed ("
+                            "path TEXT PRIMARY KEY, shoot TEXT, category TEXT, completed_at REAL)")
+            # Images only known by name, from migrate() (or versions that only kept names)
+            self.db.execute("CREATE TABLE IF NOT EXISTS completed ("
+                            "name TEXT PRIMARY KEY, shoot TEXT, category TEXT, completed_at REAL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def migrate(self, completed="./categorized"):
+        """
+        Import images categorized before the index existed
+
+        This walks the categorized folder once. After that the
+        index is kept up to date by mark_completed().
+
+        Args:
+            completed: The folder categorized images were copied to
+
+        Returns:
+            The number of images imported
+        """
+        with self.lock:
+            if self.db.execute("SELECT value FROM meta WHERE key = 'migrated'").fetchone():
+                return 0
+            rows = []
+            if os.path.isdir(completed):
+                for f in pathlib.Path(completed).glob('**/*.jpg'):
+                    if f.is_file():
+                        rows.append((f.name, f.parent.name, f.parent.parent.name, f.stat().st_mtime))
+            with self.db:
+                self.db.executemany("INSERT OR IGNORE INTO completed VALUES (?, ?, ?, ?)", rows)
+                self.db.execute("INSERT INTO meta VALUES ('migrated', ?)", (str(time.time()),))
+            return len(rows)
+
+    def is_completed(self, path):
+        """
+        Args:
+            path: The path to the source image
+
+        Returns:
+            True if the image has already been categorized
+        """
+        with self.lock:
+            if self.db.execute("SELECT 1 FROM placed WHERE path = ?", (os.path.abspath(str(path)),)).fetchone():
+                return True
+            return self.db.execute("SELECT 1 FROM completed WHERE name = ?", (os.path.basename(str(path)),)).fetchone() is not None
+
+    def mark_completed(self, paths, shoot, category):
+        """
+        Record a categorized shoot
+
+        All the paths are written in a single transaction, so a
+        shoot is either entirely recorded or not at all.
+
+        Args:
+            paths: The source paths of the shoot's images
+            shoot: The name of the shoot
+            category: The category the shoot was put in
+        """
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO placed VALUES (?, ?, ?, ?)",
+                                [(os.path.abspath(str(path)), shoot, category, now) for path in paths])
+
+    def __len__(self):
+        with self.lock:
+            return sum(self.db.execute("SELECT COUNT(*) FROM " + table).fetchone()[0] for table in ('placed', 'completed'))
+
+    def close(self):
+        """
+        Close the database
+        """
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Shoot Index
+
+Keeps track of the files in each shoot directory as the
+source tree is discovered, so that confirming a shoot
+only has to look at that shoot's own files.
+
+Author: Ethan Dinnen
+"""
+import os
+import threading
+
+
+class ShootIndex(object):
+    """
+    Map shoot directories to their files
+
+    Shoots are keyed by their directory, so two directories with
+    the same name in different parts of the archive are kept apart.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listings = {} # directory -> (mtime_ns, file names), only for shoots with images to categorize
+        self.scanned = None # The (directory, mtime_ns, file names) the walk scanned last
+
+    def add_directory(self, directory, entries):
+        """
+        Record a directory as it is discovered
+
+        This has the signature of iter_images()' on_directory
+        hook, so the index is built during the same walk that
+        finds the images. Its listing is only kept if keep() is
+        called for it before the walk moves on.
+        That way the listings of shoots that are already done
+        don't pile up as the walk goes through them.
+
+        Args:
+            directory: The path of the directory
+            entries: The os.DirEntry objects in the directory
+        """
+        directory = os.path.normpath(directory)
+        listing = self.list_directory(directory, entries)
+        with self.lock:
+            self.scanned = None
+            if listing is not None:
+                self.scanned = (directory,) + listing
+
+    def list_directory(self, directory, entries):
+        """
+        Returns:
+            The directory's (mtime_ns, file names), or None if it has no files
+        """
+        names = [entry.name for entry in entries if not entry.name.startswith('.') and entry.is_file()]
+        if not names:
+            return None
+        try:
+            return os.stat(directory).st_mtime_ns, names
+        except OSError:
+            return None
+
+    def keep(self, directory):
+        """
+        Keep the listing of the directory the walk just scanned
+
+        Call this when one of its images is accepted, so
+        confirming the shoot doesn't have to list it again.
+
+        Args:
+            directory: The path of the directory
+        """
+        directory = os.path.normpath(directory)
+        with self.lock:
+            if self.scanned is not None and self.scanned[0] == directory:
+                self.listings[directory] = self.scanned[1:]
+
+    def files(self, directory):
+        """
+        Get the files of a shoot
+
+        If the directory has changed since we listed it (or its
+        listing wasn't kept), it is listed again so the index
+        stays up to date.
+
+        Args:
+            directory: The path of the shoot's directory
+
+        Returns:
+            The paths of the shoot's (non hidden) files
+        """
+        directory = os.path.normpath(directory)
+        with self.lock:
+            listing = self.listings.get(directory)
+        if listing is None or os.stat(directory).st_mtime_ns != listing[0]:
+            listing = self.list_directory(directory, list(os.scandir(directory))) or (None, [])
+            with self.lock:
+                self.listings[directory] = listing
+        return [os.path.join(directory, name) for name in listing[1]]
+
+    def forget(self, directory):
+        """
+        Drop a directory's file list once its shoot is done with
+
+        Args:
+            directory: The path of the shoot's directory
+        """
+        directory = os.path.normpath(directory)
+        with self.lock:
+            self.listings.pop(directory, None)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the copy engine and its placement journal
+
+Run them from the app directory:
+
+    python3 -m pytest test_copier.py
+
+Author: Ethan Dinnen
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from copier import CopyEngine, place_file, undo, unique_path
+from journal import PlacementJournal
+
+
+class CopierTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, 'src')
+        self.dst = os.path.join(self.dir, 'dst')
+        os.mkdir(self.src)
+        os.mkdir(self.dst)
+        self.journal_file = os.path.join(self.dir, 'placement.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, path, data):
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def engine(self, strategy):
+        return CopyEngine(PlacementJournal(self.journal_file), strategy=strategy, workers=2)
+
+    def run_job(self, engine, files, directory=None):
+        job = engine.submit('shoot', files, directory or self.dst)
+        for future in job.futures:
+            future.result()
+        return job
+
+
+class PlaceFileTest(CopierTestCase):
+
+    def test_never_replaces_existing_file(self):
+        for strategy in ('copy', 'hardlink', 'move'):
+            src = self.write(os.path.join(self.src, strategy), 'new')
+            dst = self.write(os.path.join(self.dst, strategy), 'old')
+            with self.assertRaises(FileExistsError):
+                place_file(src, dst, strategy)
+            self.assertEqual(self.read(src), 'new')
+            self.assertEqual(self.read(dst), 'old')
+            self.assertFalse(os.path.exists(dst + '.partial'))
+
+    def test_finishes_interrupted_move(self):
+        src = self.write(os.path.join(self.src, 'a.jpg'), 'a')
+        dst = os.path.join(self.dst, 'a.jpg')
+        os.link(src, dst) # Crashed between linking and unlinking
+        place_file(src, dst, 'move')
+        self.assertFalse(os.path.exists(src))
+        self.assertEqual(self.read(dst), 'a')
+
+    def test_unique_path(self):
+        taken = {os.path.join(self.dst, 'img-1-2.cr2')}
+        self.write(os.path.join(self.dst, 'img-1.cr2'), '')
+        self.assertEqual(unique_path(os.path.join(self.dst, 'img-1.cr2'), taken), os.path.join(self.dst, 'img-1-3.cr2'))
+        self.assertEqual(unique_path(os.path.join(self.dst, 'new.cr2'), taken), os.path.join(self.dst, 'new.cr2'))
+        self.assertEqual(unique_path(self.dst, keep_extension=False), self.dst + '-2')
+
+
+class CopyEngineTest(CopierTestCase):
+
+    def test_colliding_destinations_lose_nothing(self):
+        engine = self.engine('move')
+        first = self.write(os.path.join(self.src, 'IMG 1.cr2'), '1')
+        second = self.write(os.path.join(self.src, 'img-1.cr2'), '2')
+        dst = os.path.join(self.dst, 'img-1.cr2')
+        job = self.run_job(engine, [(first, dst), (second, dst)])
+        self.assertTrue(job.errors)
+        self.assertEqual(self.read(first), '1')
+        self.assertEqual(self.read(second), '2')
+        engine.shutdown()
+
+    def test_rollback_keeps_files_that_were_already_there(self):
+        engine = self.engine('move')
+        first = self.write(os.path.join(self.src, 'a.jpg'), 'a')
+        second = self.write(os.path.join(self.src, 'b.jpg'), 'b')
+        existing = self.write(os.path.join(self.dst, 'a.jpg'), 'existing')
+        job = self.run_job(engine, [(first, existing), (second, os.path.join(self.dst, 'b.jpg'))])
+        self.assertTrue(job.errors)
+        self.assertEqual(job.futures, []) # Refused before anything was touched
+        engine.rollback(job)
+        self.assertEqual(self.read(existing), 'existing')
+        self.assertEqual(self.read(first), 'a')
+        self.assertEqual(self.read(second), 'b')
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'b.jpg')))
+        engine.shutdown()
+
+    def test_rollback_only_undoes_placed_files(self):
+        engine = self.engine('copy')
+        first = self.write(os.path.join(self.src, 'a.jpg'), 'a')
+        missing = os.path.join(self.src, 'missing.jpg')
+        later = os.path.join(self.dst, 'missing.jpg')
+        job = self.run_job(engine, [(first, os.path.join(self.dst, 'a.jpg')), (missing, later)])
+        self.assertEqual(len(job.errors), 1)
+        self.write(later, 'not ours') # Written by someone else before we roll back
+        engine.rollback(job)
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'a.jpg')))
+        self.assertEqual(self.read(later), 'not ours')
+        engine.shutdown()
+
+    def test_undo_leaves_other_files_and_metadata_alone(self):
+        self.write(os.path.join(self.dst, 'metadata.json'), '{}')
+        self.write(os.path.join(self.dst, 'other.jpg'), 'other')
+        undo([], 'copy', self.dst)
+        self.assertTrue(os.path.exists(os.path.join(self.dst, 'metadata.json')))
+        os.remove(os.path.join(self.dst, 'other.jpg'))
+        undo([], 'copy', self.dst)
+        self.assertFalse(os.path.exists(self.dst))
+
+    def test_commit(self):
+        engine = self.engine('copy')
+        src = self.write(os.path.join(self.src, 'a.jpg'), 'a')
+        job = self.run_job(engine, [(src, os.path.join(self.dst, 'a.jpg'))])
+        self.assertEqual(job.errors, [])
+        engine.commit(job)
+        self.assertEqual(engine.journal.pending(), {})
+        self.assertEqual(self.read(os.path.join(self.dst, 'a.jpg')), 'a')
+        engine.shutdown()
+
+
+class RecoveryTest(CopierTestCase):
+
+    def crash(self, strategy, placed):
+        """
+        Journal a two file shoot as if we crashed after placing some of it
+        """
+        files = []
+        for name in ('a.jpg', 'b.jpg'):
+            src = self.write(os.path.join(self.src, name), name)
+            files.append((src, os.path.join(self.dst, name)))
+        journal = PlacementJournal(self.journal_file)
+        journal.begin('job', strategy, files, self.dst, ['context'])
+        for index in placed:
+            place_file(files[index][0], files[index][1], strategy)
+            journal.done('job', index)
+        place_file(files[1][0], files[1][1], strategy) # Placed, but the crash came before it was logged
+        journal.close()
+        with open(self.journal_file, 'a') as f:
+            f.write('{"op":"done","id":"jo') # A record cut off by the crash
+        return files
+
+    def test_recover_forward(self):
+        files = self.crash('move', [0])
+        engine = self.engine('move')
+        recovered = engine.recover('forward')
+        self.assertEqual(recovered, [('job', ['context'], files)])
+        for src, dst in files:
+            self.assertFalse(os.path.exists(src))
+            self.assertTrue(os.path.exists(dst))
+        engine.commit_recovered('job')
+        self.assertEqual(engine.journal.pending(), {})
+        engine.shutdown()
+
+    def test_recover_back(self):
+        files = self.crash('move', [0])
+        engine = self.engine('move')
+        self.assertEqual(engine.recover('back'), [])
+        for src, dst in files:
+            self.assertEqual(self.read(src), os.path.basename(src))
+            self.assertFalse(os.path.exists(dst))
+        self.assertFalse(os.path.exists(self.dst))
+        self.assertEqual(engine.journal.pending(), {})
+        engine.shutdown()
+
+    def test_truncated_record_is_dropped(self):
+        self.crash('copy', [])
+        journal = PlacementJournal(self.journal_file)
+        journal.commit('job')
+        with open(self.journal_file) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([record['op'] for record in records], ['begin', 'commit'])
+        self.assertEqual(journal.pending(), {})
+        journal.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the image helpers
+
+Run them from the app directory:
+
+    python3 -m pytest test_imaging.py
+
+Author: Ethan Dinnen
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from imaging import DecodedFrame, normalize_image
+
+ORIENTATION = 0x0112 # The EXIF orientation tag
+
+
+class OrientationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_jpeg(self, orientation):
+        """
+        Write a 64 x 32 JPEG, red on the left and blue on the right,
+        tagged with an EXIF orientation
+        """
+        pixels = np.zeros((32, 64, 3), dtype=np.uint8)
+        pixels[:, :32] = (255, 0, 0)
+        pixels[:, 32:] = (0, 0, 255)
+        exif = Image.Exif()
+        exif[ORIENTATION] = orientation
+        path = os.path.join(self.dir, 'oriented_{}.jpg'.format(orientation))
+        Image.fromarray(pixels).save(path, quality=95, exif=exif.tobytes())
+        return path
+
+    def old_pixels(self, path):
+        """
+        What the app decoded before, with cv2.imread, as RGB
+        """
+        return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+
+    def assertSameImage(self, pixels, expected):
+        self.assertEqual(pixels.shape, expected.shape)
+        difference = np.abs(pixels.astype(np.int16) - expected.astype(np.int16))
+        self.assertLess(difference.mean(), 4) # Decoders may round differently
+
+    def test_pixels_match_cv2_for_every_orientation(self):
+        for orientation in range(1, 9):
+            path = self.write_jpeg(orientation)
+            self.assertSameImage(DecodedFrame(path).pixels, self.old_pixels(path))
+
+    def test_rotated_image_is_upright(self):
+        path = self.write_jpeg(6) # Stored sideways, to be turned 90 degrees clockwise
+        pixels = DecodedFrame(path).pixels
+        self.assertEqual(pixels.shape, (64, 32, 3))
+        self.assertGreater(pixels[2, 16, 0], 200) # Red on top
+        self.assertGreater(pixels[-3, 16, 2], 200) # Blue at the bottom
+
+    def test_normalized_image_matches_cv2(self):
+        path = self.write_jpeg(8)
+        expected = cv2.resize(self.old_pixels(path), (1024, 768))
+        self.assertSameImage(normalize_image(path), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
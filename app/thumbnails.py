@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Thumbnail Cache
+
+Decodes display thumbnails at reduced size and keeps
+them on disk, so images that have been seen before are
+displayed without decoding the original again.
+
+Author: Ethan Dinnen
+"""
+import hashlib
+import os
+import threading
+import time
+
+from PIL import Image, ImageOps
+
+THUMBNAIL_SIZE = (480, 360) # The size of the image canvas
+THUMBNAIL_VERSION = 2 # Bump when thumbnails are made differently, so old ones aren't reused
+
+
+def make_thumbnail(path, size=THUMBNAIL_SIZE):
+    """
+    Decode an image straight to thumbnail size
+
+    draft() lets libjpeg scale the image down by up to 8x while
+    decoding, so we never decode the full resolution image just
+    to throw most of it away.
+
+    Args:
+        path: The path to the image
+        size: The (width, height) box to fit the thumbnail in
+
+    Returns:
+        The thumbnail as a PIL Image
+    """
+    im = Image.open(str(path))
+    im.draft('RGB', size) # Only has an effect on JPEGs
+    im = ImageOps.exif_transpose(im) # Turn it upright, like DecodedFrame does
+    im.thumbnail(size, Image.ANTIALIAS)
+    return im
+
+
+class ThumbnailCache(object):
+    """
+    A size bounded, least recently used, on-disk thumbnail cache
+
+    Thumbnails are stored under a hash of the original's path,
+    size and modification time, so a changed original never gets
+    a stale thumbnail. The cache may be shared between threads.
+    """
+
+    def __init__(self, cache_dir="./.thumbnails", max_bytes=512 * 1024 * 1024):
+        """
+        Args:
+            cache_dir: Where to keep the thumbnails
+            max_bytes: How large the cache may grow before the least
+                recently used thumbnails are evicted
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total = sum(entry.stat().st_size for entry in self.entries())
+
+    def entries(self):
+        """
+        Returns:
+            The os.DirEntry of every finished thumbnail in the cache
+        """
+        return [entry for entry in os.scandir(self.cache_dir) if entry.is_file() and not entry.name.endswith('.partial')]
+
+    def key(self, path, size):
+        """
+        Args:
+            path: The path to the original image
+            size: The thumbnail size
+
+        Returns:
+            The cache file for the image's thumbnail
+        """
+        stat = os.stat(str(path))
+        identity = "{}|{}|{}|{}x{}|v{}".format(os.path.abspath(str(path)), stat.st_size, stat.st_mtime_ns, size[0], size[1], THUMBNAIL_VERSION)
+        return os.path.join(self.cache_dir, hashlib.sha1(identity.encode('utf-8')).hexdigest() + '.jpg')
+
+    def get(self, path, size=THUMBNAIL_SIZE, make=None):
+        """
+        Get an image's thumbnail, making and caching it if needed
+
+        Args:
+            path: The path to the image
+            size: The (width, height) box to fit the thumbnail in
+            make: Optional function taking the box size and returning the
+                thumbnail, for when the image is already decoded. By default
+                the image is decoded with make_thumbnail().
+
+        Returns:
+            The thumbnail as a PIL Image. The cache is only an optimization,
+            so the thumbnail is returned even if it could not be cached.
+        """
+        cached = self.key(path, size)
+        try:
+            im = Image.open(cached)
+            im.load()
+            os.utime(cached) # Mark it as recently used
+            return im
+        except (IOError, OSError):
+            pass # Not cached yet (or the cached file is damaged)
+        im = make(size) if make is not None else make_thumbnail(path, size)
+        try:
+            self.put(cached, im)
+        except OSError as e:
+            print("Could not cache the thumbnail of {}: {}".format(path, e)) # The disk is full or read only
+        return im
+
+    def put(self, cached, im):
+        """
+        Store a thumbnail, evicting old ones if the cache is full
+
+        Args:
+            cached: The cache file from key()
+            im: The thumbnail
+        """
+        partial = "{}.{}.partial".format(cached, threading.get_ident())
+        try:
+            im.convert('RGB').save(partial, 'JPEG', quality=90)
+            os.replace(partial, cached) # Other threads never see half a thumbnail
+        except OSError:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        with self.lock:
+            self.total += os.path.getsize(cached)
+            if self.total > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used thumbnails until the cache is
+        back down to 90% of its maximum size
+
+        Thumbnails other threads are still writing are left alone,
+        unless they were abandoned (by a crash) over an hour ago.
+        """
+        for entry in os.scandir(self.cache_dir):
+            try:
+                if entry.name.endswith('.partial') and entry.stat().st_mtime < time.time() - 3600:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+        entries = sorted(self.entries(), key=lambda entry: entry.stat().st_mtime)
+        self.total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.total <= self.max_bytes * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.total -= size
+            except OSError:
+                pass
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Timing helpers
+
+Small utilities for keeping track of how long the
+different stages of categorizing an image take.
+
+Author: Ethan Dinnen
+"""
+import collections
+import threading
+
+
+class LatencyStats(object):
+    """
+    Keep running latency statistics for a repeated operation
+
+    A bounded window of recent samples is kept so that
+    percentiles reflect the steady state rather than the
+    whole history of the process.
+    """
+
+    def __init__(self, window=1000):
+        """
+        Args:
+            window: How many recent samples to keep for percentiles
+        """
+        self.count = 0
+        self.total = 0.0
+        self.samples = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def add(self, seconds, count=1):
+        """
+        Record a measurement
+
+        Args:
+            seconds: The time the operation took
+            count: How many items the measurement covered. The time
+                is split evenly between them.
+        """
+        if count <= 0:
+            return
+        per_item = seconds / count
+        with self.lock:
+            self.count += count
+            self.total += seconds
+            self.samples.extend([per_item] * min(count, self.samples.maxlen))
+
+    def mean(self):
+        """
+        Returns:
+            The mean time per item in seconds, or None without samples
+        """
+        with self.lock:
+            if self.count == 0:
+                return None
+            return self.total / self.count
+
+    def percentile(self, pct):
+        """
+        Args:
+            pct: The percentile to compute (0-100)
+
+        Returns:
+            The percentile of the recent samples in seconds, or None
+        """
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100.0 * (len(samples) - 1))))
+        return samples[index]
+
+    def summary(self, name):
+        """
+        Format the statistics for printing
+
+        Args:
+            name: What the measured operation is called
+
+        Returns:
+            A one line summary string
+        """
+        if self.count == 0:
+            return "{}: no samples".format(name)
+        return "{}: {} samples, mean {:.1f} ms, p50 {:.1f} ms, p95 {:.1f} ms".format(
+            name,
+            self.count,
+            self.mean() * 1000,
+            self.percentile(50) * 1000,
+            self.percentile(95) * 1000)
@@ -123,10 +123,15 @@ import argparse
 import collections
 from datetime import datetime
 import hashlib
+import itertools
+import json
 import os.path
 import random
 import re
+import socket
+import subprocess
 import sys
+import time
 
 import numpy as np
 import tensorflow as tf
@@ -144,18 +149,135 @@ CHECKPOINT_NAME = './checkpoints'
 FAKE_QUANT_OPS = ('FakeQuantWithMinMaxVars',
                   'FakeQuantWithMinMaxVarsPerChannel')
 
+# The image sets every label's images are split into.
+CATEGORIES = ('training', 'testing', 'validation')
 
-def create_image_lists(image_dir, testing_percentage, validation_percentage):
+# Several bottlenecks cached per image, one for each randomly distorted
+# variant of it. The name identifies the set of variants and each suffix one
+# variant's bottleneck files.
+Variants = collections.namedtuple('Variants', ['name', 'suffixes'])
+
+# The bottlenecks of a set of images held in memory, with the rows grouped by
+# class: the rows of class i start at class_starts[i] and there are
+# class_counts[i] of them.
+BottleneckSet = collections.namedtuple(
+    'BottleneckSet', ['bottlenecks', 'ground_truth', 'filenames',
+                      'class_starts', 'class_counts'])
+
+
+def get_image_category(file_name, testing_percentage, validation_percentage):
+  """Decides which set an image belongs in, from its file name alone.
+
+  Args:
+    file_name: Path string of the image, as the image directory joined with
+    its label folder and base name.
+    testing_percentage: Integer percentage of the images to reserve for tests.
+    validation_percentage: Integer percentage of images reserved for validation.
+
+  Returns:
+    Name string of the set - training, testing, or validation.
+  """
+  # We want to ignore anything after '_nohash_' in the file name when
+  # deciding which set to put an image in, the data set creator has a way of
+  # grouping photos that are close variations of each other. For example
+  # this is used in the plant disease data set to group multiple pictures of
+  # the same leaf.
+  hash_name = re.sub(r'_nohash_.*$', '', file_name)
+  # This looks a bit magical, but we need to decide whether this file should
+  # go into the training, testing, or validation sets, and we want to keep
+  # existing files in the same set even if more files are subsequently
+  # added.
+  # To do that, we need a stable way of deciding based on just the file name
+  # itself, so we do a hash of that and then use that to generate a
+  # probability value that we use to assign it.
+  hash_name_hashed = hashlib.sha1(tf.compat.as_bytes(hash_name)).hexdigest()
+  percentage_hash = ((int(hash_name_hashed, 16) %
+                      (MAX_NUM_IMAGES_PER_CLASS + 1)) *
+                     (100.0 / MAX_NUM_IMAGES_PER_CLASS))
+  if percentage_hash < validation_percentage:
+    return 'validation'
+  elif percentage_hash < (testing_percentage + validation_percentage):
+    return 'testing'
+  return 'training'
+
+
+def scan_image_folder(image_dir, dir_name, testing_percentage,
+                      validation_percentage):
+  """Lists the images in a label folder in a single pass.
+
+  Args:
+    image_dir: String path to a folder containing subfolders of images.
+    dir_name: Name string of the label folder.
+    testing_percentage: Integer percentage of the images to reserve for tests.
+    validation_percentage: Integer percentage of images reserved for validation.
+
+  Returns:
+    List of [base name, set name, size, modification time in nanoseconds]
+    lists, one for every image, ordered by extension and then by name.
+  """
+  extensions = sorted(set(os.path.normcase(ext)  # Smash case on Windows.
+                          for ext in ['JPEG', 'JPG', 'jpeg', 'jpg']))
+  entries = []
+  for entry in os.scandir(os.path.join(image_dir, dir_name)):
+    extension = os.path.normcase(entry.name.rpartition('.')[2])
+    if '.' in entry.name and extension in extensions and entry.is_file():
+      entries.append((extensions.index(extension), entry.name, entry))
+  images = []
+  for unused_extension, unused_name, entry in sorted(entries):
+    stat = entry.stat()
+    file_name = os.path.join(image_dir, dir_name, entry.name)
+    images.append([entry.name,
+                   get_image_category(file_name, testing_percentage,
+                                      validation_percentage),
+                   stat.st_size, stat.st_mtime_ns])
+  return images
+
+
+def load_image_manifest(manifest_path, image_dir, testing_percentage,
+                        validation_percentage):
+  """Reads the label folders recorded by an earlier create_image_lists().
+
+  Args:
+    manifest_path: Path string of the manifest file.
+    image_dir: String path to a folder containing subfolders of images.
+    testing_percentage: Integer percentage of the images to reserve for tests.
+    validation_percentage: Integer percentage of images reserved for validation.
+
+  Returns:
+    Dictionary of the recorded folders by name, empty if there's no manifest
+    or it was made for another image directory or split.
+  """
+  try:
+    with open(manifest_path, 'r') as manifest_file:
+      manifest = json.load(manifest_file)
+  except (IOError, OSError, ValueError):
+    return {}
+  if (manifest.get('image_dir') != image_dir or
+      manifest.get('testing_percentage') != testing_percentage or
+      manifest.get('validation_percentage') != validation_percentage or
+      manifest.get('max_num_images_per_class') != MAX_NUM_IMAGES_PER_CLASS):
+    return {}
+  return manifest.get('dirs', {})
+
+
+def create_image_lists(image_dir, testing_percentage, validation_percentage,
+                       manifest_path=None):
   """Builds a list of training images from the file system.
 
   Analyzes the sub folders in the image directory, splits them into stable
   training, testing, and validation sets, and returns a data structure
   describing the lists of images for each label and their paths.
 
+  With a manifest, every image found is recorded along with its set, size and
+  modification time. Later runs only scan the folders that have been modified
+  since, which is much faster for large image directories.
+
   Args:
     image_dir: String path to a folder containing subfolders of images.
     testing_percentage: Integer percentage of the images to reserve for tests.
     validation_percentage: Integer percentage of images reserved for validation.
+    manifest_path: Path string of the manifest file to read and update, or
+    None to scan every folder.
 
   Returns:
     An OrderedDict containing an entry for each label subfolder, with images
@@ -165,69 +287,66 @@ def create_image_lists(image_dir, testing_percentage, validation_percentage):
   if not tf.gfile.Exists(image_dir):
     tf.logging.error("Image directory '" + image_dir + "' not found.")
     return None
+  scanned_dirs = {}
+  if manifest_path:
+    scanned_dirs = load_image_manifest(manifest_path, image_dir,
+                                       testing_percentage,
+                                       validation_percentage)
+  scan_time_ns = int(time.time() * 1e9)
+  dirs = {}
+  rescanned = 0
   result = collections.OrderedDict()
-  sub_dirs = sorted(x[0] for x in tf.gfile.Walk(image_dir))
-  # The root directory comes first, so skip it.
-  is_root_dir = True
-  for sub_dir in sub_dirs:
-    if is_root_dir:
-      is_root_dir = False
-      continue
-    extensions = sorted(set(os.path.normcase(ext)  # Smash case on Windows.
-                            for ext in ['JPEG', 'JPG', 'jpeg', 'jpg']))
-    file_list = []
-    dir_name = os.path.basename(sub_dir)
-    if dir_name == image_dir:
+  for entry in sorted(os.scandir(image_dir), key=lambda x: x.name):
+    if not entry.is_dir():
       continue
-    tf.logging.info("Looking for images in '" + dir_name + "'")
-    for extension in extensions:
-      file_glob = os.path.join(image_dir, dir_name, '*.' + extension)
-      file_list.extend(tf.gfile.Glob(file_glob))
-    if not file_list:
+    dir_name = entry.name
+    mtime = entry.stat().st_mtime_ns
+    scanned_dir = scanned_dirs.get(dir_name)
+    if scanned_dir and scanned_dir['mtime'] == mtime:
+      images = scanned_dir['images']
+    else:
+      tf.logging.info("Looking for images in '" + dir_name + "'")
+      images = scan_image_folder(image_dir, dir_name, testing_percentage,
+                                 validation_percentage)
+      rescanned += 1
+    # A folder modified in the last couple of seconds could be modified again
+    # without its time changing, so it's scanned again next time.
+    dirs[dir_name] = {
+        'mtime': mtime if mtime < scan_time_ns - 2 * 10**9 else None,
+        'images': images,
+    }
+    if not images:
       tf.logging.warning('No files found')
       continue
-    if len(file_list) < 20:
+    if len(images) < 20:
       tf.logging.warning(
           'WARNING: Folder has less than 20 images, which may cause issues.')
-    elif len(file_list) > MAX_NUM_IMAGES_PER_CLASS:
+    elif len(images) > MAX_NUM_IMAGES_PER_CLASS:
       tf.logging.warning(
           'WARNING: Folder {} has more than {} images. Some images will '
           'never be selected.'.format(dir_name, MAX_NUM_IMAGES_PER_CLASS))
     label_name = re.sub(r'[^a-z0-9]+', ' ', dir_name.lower())
-    training_images = []
-    testing_images = []
-    validation_images = []
-    for file_name in file_list:
-      base_name = os.path.basename(file_name)
-      # We want to ignore anything after '_nohash_' in the file name when
-      # deciding which set to put an image in, the data set creator has a way of
-      # grouping photos that are close variations of each other. For example
-      # this is used in the plant disease data set to group multiple pictures of
-      # the same leaf.
-      hash_name = re.sub(r'_nohash_.*$', '', file_name)
-      # This looks a bit magical, but we need to decide whether this file should
-      # go into the training, testing, or validation sets, and we want to keep
-      # existing files in the same set even if more files are subsequently
-      # added.
-      # To do that, we need a stable way of deciding based on just the file name
-      # itself, so we do a hash of that and then use that to generate a
-      # probability value that we use to assign it.
-      hash_name_hashed = hashlib.sha1(tf.compat.as_bytes(hash_name)).hexdigest()
-      percentage_hash = ((int(hash_name_hashed, 16) %
-                          (MAX_NUM_IMAGES_PER_CLASS + 1)) *
-                         (100.0 / MAX_NUM_IMAGES_PER_CLASS))
-      if percentage_hash < validation_percentage:
-        validation_images.append(base_name)
-      elif percentage_hash < (testing_percentage + validation_percentage):
-        testing_images.append(base_name)
-      else:
-        training_images.append(base_name)
     result[label_name] = {
         'dir': dir_name,
-        'training': training_images,
-        'testing': testing_images,
-        'validation': validation_images,
+        'training': [],
+        'testing': [],
+        'validation': [],
     }
+    for base_name, category, unused_size, unused_mtime in images:
+      result[label_name][category].append(base_name)
+  if manifest_path:
+    tf.logging.info('Scanned %d of %d image folders, the rest were unchanged' %
+                    (rescanned, len(dirs)))
+    if rescanned or len(dirs) != len(scanned_dirs):
+      tmp_path = '%s.%s-%d.tmp' % (manifest_path, socket.gethostname(),
+                                   os.getpid())
+      with open(tmp_path, 'w') as manifest_file:
+        json.dump({'image_dir': image_dir,
+                   'testing_percentage': testing_percentage,
+                   'validation_percentage': validation_percentage,
+                   'max_num_images_per_class': MAX_NUM_IMAGES_PER_CLASS,
+                   'dirs': dirs}, manifest_file)
+      tf.gfile.Rename(tmp_path, manifest_path, overwrite=True)
   return result
 
 
@@ -264,8 +383,22 @@ def get_image_path(image_lists, label_name, index, image_dir, category):
   return full_path
 
 
+def get_module_path_name(module_name):
+  """Returns a version of the module name that can be used in file names.
+
+  Args:
+    module_name: The name of the image module being used.
+
+  Returns:
+    String with the characters that can't be used in paths replaced.
+  """
+  return (module_name.replace('://', '~')  # URL scheme.
+          .replace('/', '~')  # URL and Unix paths.
+          .replace(':', '~').replace('\\', '~'))  # Windows paths.
+
+
 def get_bottleneck_path(image_lists, label_name, index, bottleneck_dir,
-                        category, module_name):
+                        category, module_name, variant=None):
   """Returns a path to a bottleneck file for a label at the given index.
 
   Args:
@@ -277,22 +410,101 @@ def get_bottleneck_path(image_lists, label_name, index, bottleneck_dir,
     category: Name string of set to pull images from - training, testing, or
     validation.
     module_name: The name of the image module being used.
+    variant: Suffix string of a distorted variant of the image, or None for
+    the image itself.
 
   Returns:
     File system path string to an image that meets the requested parameters.
   """
-  module_name = (module_name.replace('://', '~')  # URL scheme.
-                 .replace('/', '~')  # URL and Unix paths.
-                 .replace(':', '~').replace('\\', '~'))  # Windows paths.
   return get_image_path(image_lists, label_name, index, bottleneck_dir,
-                        category) + '_' + module_name + '.txt'
+                        category) + '_' + get_module_path_name(
+                            module_name) + ('_' + variant if variant else
+                                            '') + '.npy'
+
 
+def get_packed_bottleneck_path(bottleneck_dir, category, module_name,
+                               variants=None):
+  """Returns the path of the packed bottleneck array for a set of images.
 
-def create_module_graph(module_spec):
+  Args:
+    bottleneck_dir: Folder string holding cached files of bottleneck values.
+    category: Name string of the set - training, testing, or validation.
+    module_name: The name of the image module being used.
+    variants: The Variants packed for each image, or None.
+
+  Returns:
+    File system path string to the .npy array. Its index is stored next to it
+    at get_packed_index_path().
+  """
+  return os.path.join(bottleneck_dir, 'packed_%s_%s%s.npy' % (
+      category, get_module_path_name(module_name),
+      '_' + variants.name if variants else ''))
+
+
+def get_packed_index_path(packed_path):
+  """Returns the path of the index of a packed bottleneck array."""
+  return packed_path[:-len('.npy')] + '.index.json'
+
+
+def get_bottleneck_keys(image_lists, category, variants=None):
+  """Returns the keys of the images in a set, in the order they are packed.
+
+  Images are ordered by label (in class index order), then by their position
+  in the label's list, then by variant.
+
+  Args:
+    image_lists: OrderedDict of training images for each label.
+    category: Name string of the set - training, testing, or validation.
+    variants: The Variants packed for each image, or None.
+
+  Returns:
+    List of 'label_dir/file_name' strings, with '#variant' appended when
+    there are variants.
+  """
+  keys = []
+  for label_lists in image_lists.values():
+    for base_name in label_lists[category]:
+      key = label_lists['dir'] + '/' + base_name
+      if variants:
+        keys.extend(key + '#' + suffix for suffix in variants.suffixes)
+      else:
+        keys.append(key)
+  return keys
+
+
+def get_distortion_variants(flip_left_right, random_crop, random_scale,
+                            random_brightness, count):
+  """Names the distorted variants to cache for every training image.
+
+  The names include the distortion settings, so changing them never mixes
+  bottlenecks distorted with different settings.
+
+  Args:
+    flip_left_right: Boolean whether to randomly mirror images horizontally.
+    random_crop: Integer percentage setting the total margin used around the
+    crop box.
+    random_scale: Integer percentage of how much to vary the scale by.
+    random_brightness: Integer range to randomly multiply the pixel values by.
+    count: Integer number of variants per image.
+
+  Returns:
+    The Variants.
+  """
+  distortion = 'distort_flip%d_crop%d_scale%d_bright%d' % (
+      int(flip_left_right), random_crop, random_scale, random_brightness)
+  return Variants(name='%s_x%d' % (distortion, count),
+                  suffixes=['%s_v%d' % (distortion, variant)
+                            for variant in range(count)])
+
+
+def create_module_graph(module_spec, graph=None, default_images=None):
   """Creates a graph and loads Hub Module into it.
 
   Args:
     module_spec: the hub.ModuleSpec for the image module being used.
+    graph: the tf.Graph to load the module into, or None for a new one.
+    default_images: a tensor in the graph of the images the module reads when
+      none are fed to its input, or None to always feed them.
 
   Returns:
     graph: the tf.Graph that was created.
@@ -302,8 +514,15 @@ def create_module_graph(module_spec):
       with fake quantization ops.
   """
   height, width = hub.get_expected_image_size(module_spec)
-  with tf.Graph().as_default() as graph:
-    resized_input_tensor = tf.placeholder(tf.float32, [None, height, width, 3])
+  if graph is None:
+    graph = tf.Graph()
+  with graph.as_default():
+    if default_images is None:
+      resized_input_tensor = tf.placeholder(tf.float32,
+                                            [None, height, width, 3])
+    else:
+      resized_input_tensor = tf.placeholder_with_default(
+          default_images, [None, height, width, 3])
     m = hub.Module(module_spec)
     bottleneck_tensor = m(resized_input_tensor)
     wants_quantization = any(node.op in FAKE_QUANT_OPS
@@ -347,10 +566,53 @@ def ensure_dir_exists(dir_name):
     os.makedirs(dir_name)
 
 
+def save_bottleneck(bottleneck_path, bottleneck_values, bottleneck_dtype):
+  """Writes bottleneck values to a binary .npy file.
+
+  Args:
+    bottleneck_path: Path string of the file to write.
+    bottleneck_values: Numpy array of bottleneck values.
+    bottleneck_dtype: Name string of the type to store the values as, float16
+    or float32.
+  """
+  # Write to a file of our own and rename it into place, so other processes
+  # (maybe on other machines) never read a half-written bottleneck.
+  tmp_path = '%s.%s-%d.tmp' % (bottleneck_path, socket.gethostname(),
+                               os.getpid())
+  with open(tmp_path, 'wb') as bottleneck_file:
+    np.save(bottleneck_file, np.asarray(bottleneck_values,
+                                        dtype=bottleneck_dtype))
+  tf.gfile.Rename(tmp_path, bottleneck_path, overwrite=True)
+
+
+def load_bottleneck(bottleneck_path):
+  """Reads bottleneck values written by save_bottleneck.
+
+  Args:
+    bottleneck_path: Path string of the file to read.
+
+  Returns:
+    Numpy float32 array of bottleneck values.
+
+  Raises:
+    ValueError: If the file is truncated or does not hold a vector of finite
+    values.
+  """
+  try:
+    bottleneck_values = np.load(bottleneck_path)
+  except (IOError, OSError) as e:
+    raise ValueError(str(e))
+  if bottleneck_values.ndim != 1 or not bottleneck_values.size:
+    raise ValueError('Bottleneck has shape %s' % (bottleneck_values.shape,))
+  if not np.all(np.isfinite(bottleneck_values)):
+    raise ValueError('Bottleneck has non-finite values')
+  return bottleneck_values.astype(np.float32)
+
+
 def create_bottleneck_file(bottleneck_path, image_lists, label_name, index,
                            image_dir, category, sess, jpeg_data_tensor,
                            decoded_image_tensor, resized_input_tensor,
-                           bottleneck_tensor):
+                           bottleneck_tensor, bottleneck_dtype='float32'):
   """Create a single bottleneck file."""
   tf.logging.info('Creating bottleneck at ' + bottleneck_path)
   image_path = get_image_path(image_lists, label_name, index,
@@ -365,19 +627,19 @@ def create_bottleneck_file(bottleneck_path, image_lists, label_name, index,
   except Exception as e:
     raise RuntimeError('Error during processing file %s (%s)' % (image_path,
                                                                  str(e)))
-  bottleneck_string = ','.join(str(x) for x in bottleneck_values)
-  with open(bottleneck_path, 'w') as bottleneck_file:
-    bottleneck_file.write(bottleneck_string)
+  save_bottleneck(bottleneck_path, bottleneck_values, bottleneck_dtype)
 
 
 def get_or_create_bottleneck(sess, image_lists, label_name, index, image_dir,
                              category, bottleneck_dir, jpeg_data_tensor,
                              decoded_image_tensor, resized_input_tensor,
-                             bottleneck_tensor, module_name):
+                             bottleneck_tensor, module_name,
+                             bottleneck_dtype='float32'):
   """Retrieves or calculates bottleneck values for an image.
 
   If a cached version of the bottleneck data exists on-disk, return that,
-  otherwise calculate the data and save it to disk for future use.
+  otherwise calculate the data and save it to disk for future use. Bottlenecks
+  cached as text by earlier versions are converted instead of recalculated.
 
   Args:
     sess: The current active TensorFlow Session.
@@ -395,6 +657,7 @@ def get_or_create_bottleneck(sess, image_lists, label_name, index, image_dir,
     resized_input_tensor: The input node of the recognition graph.
     bottleneck_tensor: The output tensor for the bottleneck values.
     module_name: The name of the image module being used.
+    bottleneck_dtype: Name string of the type to store new bottlenecks as.
 
   Returns:
     Numpy array of values produced by the bottleneck layer for the image.
@@ -406,34 +669,353 @@ def get_or_create_bottleneck(sess, image_lists, label_name, index, image_dir,
   bottleneck_path = get_bottleneck_path(image_lists, label_name, index,
                                         bottleneck_dir, category, module_name)
   if not os.path.exists(bottleneck_path):
-    create_bottleneck_file(bottleneck_path, image_lists, label_name, index,
-                           image_dir, category, sess, jpeg_data_tensor,
-                           decoded_image_tensor, resized_input_tensor,
-                           bottleneck_tensor)
-  with open(bottleneck_path, 'r') as bottleneck_file:
-    bottleneck_string = bottleneck_file.read()
-  did_hit_error = False
+    text_path = bottleneck_path[:-len('.npy')] + '.txt'
+    try:
+      with open(text_path, 'r') as bottleneck_file:
+        bottleneck_string = bottleneck_file.read()
+      save_bottleneck(bottleneck_path,
+                      [float(x) for x in bottleneck_string.split(',')],
+                      bottleneck_dtype)
+    except (IOError, OSError, ValueError):
+      # No (valid) text bottleneck to convert either.
+      create_bottleneck_file(bottleneck_path, image_lists, label_name, index,
+                             image_dir, category, sess, jpeg_data_tensor,
+                             decoded_image_tensor, resized_input_tensor,
+                             bottleneck_tensor, bottleneck_dtype)
+    else:
+      try:
+        os.remove(text_path)
+      except OSError:
+        pass  # Another process converted it at the same time.
   try:
-    bottleneck_values = [float(x) for x in bottleneck_string.split(',')]
+    return load_bottleneck(bottleneck_path)
   except ValueError:
-    tf.logging.warning('Invalid float found, recreating bottleneck')
-    did_hit_error = True
-  if did_hit_error:
-    create_bottleneck_file(bottleneck_path, image_lists, label_name, index,
-                           image_dir, category, sess, jpeg_data_tensor,
-                           decoded_image_tensor, resized_input_tensor,
-                           bottleneck_tensor)
-    with open(bottleneck_path, 'r') as bottleneck_file:
-      bottleneck_string = bottleneck_file.read()
-    # Allow exceptions to propagate here, since they shouldn't happen after a
-    # fresh creation
-    bottleneck_values = [float(x) for x in bottleneck_string.split(',')]
-  return bottleneck_values
+    tf.logging.warning('Invalid bottleneck found, recreating bottleneck')
+  create_bottleneck_file(bottleneck_path, image_lists, label_name, index,
+                         image_dir, category, sess, jpeg_data_tensor,
+                         decoded_image_tensor, resized_input_tensor,
+                         bottleneck_tensor, bottleneck_dtype)
+  # Allow exceptions to propagate here, since they shouldn't happen after a
+  # fresh creation
+  return load_bottleneck(bottleneck_path)
+
+
+def load_packed_bottlenecks(image_lists, category, bottleneck_dir,
+                            module_name, bottleneck_dtype=None,
+                            variants=None):
+  """Memory-maps the packed bottlenecks of a set of images.
+
+  Args:
+    image_lists: OrderedDict of training images for each label.
+    category: Name string of the set - training, testing, or validation.
+    bottleneck_dir: Folder string holding cached files of bottleneck values.
+    module_name: The name of the image module being used.
+    bottleneck_dtype: If set, the type the values must be packed as.
+    variants: The Variants packed for each image, or None.
+
+  Returns:
+    A read-only [image count, bottleneck size] Numpy memmap, with the rows in
+    get_bottleneck_keys() order, or None if the set hasn't been packed or has
+    changed since it was packed.
+  """
+  packed_path = get_packed_bottleneck_path(bottleneck_dir, category,
+                                           module_name, variants)
+  try:
+    with open(get_packed_index_path(packed_path), 'r') as index_file:
+      index = json.load(index_file)
+    packed = np.load(packed_path, mmap_mode='r')
+  except (IOError, OSError, ValueError):
+    return None
+  if (index.get('keys') != get_bottleneck_keys(image_lists, category,
+                                               variants) or
+      packed.shape[0] != len(index['keys']) or
+      (bottleneck_dtype and packed.dtype != np.dtype(bottleneck_dtype))):
+    return None
+  return packed
+
+
+def add_bottleneck_input_pipeline(resized_input_tensor, batch_size,
+                                  decode_threads, distortions=None):
+  """Adds a tf.data pipeline that reads and decodes batches of images.
+
+  Files are read and decoded on decode_threads threads, gathered into batches
+  and the next batch is prefetched while the module runs on the current one.
+  Images that can't be read or decoded are dropped, so each image comes with
+  its position in the list of paths the pipeline was initialized with.
+
+  Args:
+    resized_input_tensor: The input node of the recognition graph, whose shape
+    sets the size images are resized to.
+    batch_size: Integer number of images per batch.
+    decode_threads: Integer number of images to decode in parallel.
+    distortions: If set, a (flip_left_right, random_crop, random_scale,
+    random_brightness) tuple of the random distortions to apply to every
+    image, as in distort_jpeg().
+
+  Returns:
+    The image paths placeholder to initialize the pipeline with, the
+    pipeline's initializer and the tensors for the next batch of indexes and
+    images.
+  """
+  input_height, input_width, input_depth = (
+      resized_input_tensor.get_shape().as_list()[1:])
+  image_paths = tf.placeholder(tf.string, [None], name='BottleneckImagePaths')
+
+  def load_image(index, image_path):
+    if distortions:
+      flip_left_right, random_crop, random_scale, random_brightness = (
+          distortions)
+      return index, distort_jpeg(tf.read_file(image_path), flip_left_right,
+                                 random_crop, random_scale, random_brightness,
+                                 input_height, input_width, input_depth)
+    resized_image = decode_and_resize_jpeg(tf.read_file(image_path),
+                                           input_height, input_width,
+                                           input_depth)
+    return index, tf.squeeze(resized_image, axis=[0])
+
+  dataset = tf.data.Dataset.from_tensor_slices(
+      (tf.range(tf.size(image_paths)), image_paths))
+  dataset = dataset.map(load_image, num_parallel_calls=decode_threads)
+  dataset = dataset.apply(tf.contrib.data.ignore_errors())
+  dataset = dataset.batch(batch_size).prefetch(1)
+  iterator = dataset.make_initializable_iterator()
+  indexes, images = iterator.get_next()
+  return image_paths, iterator.initializer, indexes, images
+
+
+def extract_bottlenecks(sess, jobs, input_pipeline, resized_input_tensor,
+                        bottleneck_tensor, bottleneck_dtype='float32'):
+  """Calculates and saves the bottlenecks of many images in batches.
+
+  Args:
+    sess: The current active TensorFlow Session.
+    jobs: List of (image path, bottleneck path) string pairs.
+    input_pipeline: The tensors returned by add_bottleneck_input_pipeline().
+    resized_input_tensor: The input node of the recognition graph.
+    bottleneck_tensor: The bottleneck output layer of the CNN graph.
+    bottleneck_dtype: Name string of the type to store the bottlenecks as.
+
+  Returns:
+    The jobs whose images could not be decoded.
+  """
+  image_paths, initializer, indexes_tensor, images_tensor = input_pipeline
+  sess.run(initializer, {image_paths: [image_path for image_path, _ in jobs]})
+  done = set()
+  start = time.time()
+  last_report = 0
+  while True:
+    try:
+      indexes, images = sess.run([indexes_tensor, images_tensor])
+    except tf.errors.OutOfRangeError:
+      break
+    bottlenecks = sess.run(bottleneck_tensor, {resized_input_tensor: images})
+    for index, bottleneck_values in zip(indexes, bottlenecks):
+      save_bottleneck(jobs[index][1], bottleneck_values, bottleneck_dtype)
+      done.add(index)
+    if len(done) - last_report >= 1000:
+      last_report = len(done)
+      tf.logging.info('%d of %d bottlenecks created (%.1f images/sec)' %
+                      (len(done), len(jobs), len(done) / (time.time() - start)))
+  tf.logging.info('Created %d bottlenecks in %.1fs (%.1f images/sec)' %
+                  (len(done), time.time() - start,
+                   len(done) / max(time.time() - start, 1e-6)))
+  return [job for index, job in enumerate(jobs) if index not in done]
+
+
+def in_shard(key, num_shards, shard_index):
+  """Whether an image belongs to a shard of the bottleneck caching work.
+
+  Args:
+    key: The image's 'label_dir/file_name' key.
+    num_shards: Integer number of shards the work is split into.
+    shard_index: Integer index of the shard, from 0 to num_shards - 1.
+
+  Returns:
+    Boolean, the same for the same image on every machine.
+  """
+  key_hashed = hashlib.sha1(tf.compat.as_bytes(key)).hexdigest()
+  return int(key_hashed, 16) % num_shards == shard_index
+
+
+def load_packed_rows(bottleneck_dir, category, module_name, variants=None):
+  """Memory-maps a packed bottleneck array, whatever images it was packed for.
+
+  Unlike load_packed_bottlenecks(), the array doesn't have to match the current
+  image lists, so the rows of the images that are still there can be reused
+  when the set is packed again.
+
+  Args:
+    bottleneck_dir: Folder string holding cached files of bottleneck values.
+    category: Name string of the set - training, testing, or validation.
+    module_name: The name of the image module being used.
+    variants: The Variants packed for each image, or None.
+
+  Returns:
+    A read-only Numpy memmap and a dict of (row, creation time) tuples keyed by
+    the bottleneck keys in it, or None and an empty dict if there is no usable
+    array.
+  """
+  packed_path = get_packed_bottleneck_path(bottleneck_dir, category,
+                                           module_name, variants)
+  try:
+    with open(get_packed_index_path(packed_path), 'r') as index_file:
+      index = json.load(index_file)
+    packed = np.load(packed_path, mmap_mode='r')
+    packed_mtime = os.path.getmtime(packed_path)
+  except (IOError, OSError, ValueError):
+    return None, {}
+  keys = index.get('keys') or []
+  # Indexes written before creation times were kept are dated by the array.
+  times = index.get('times') or [packed_mtime] * len(keys)
+  if (packed.ndim != 2 or packed.shape[0] != len(keys) or
+      len(times) != len(keys)):
+    return None, {}
+  return packed, dict((key, (row, times[row]))
+                      for row, key in enumerate(keys) if key is not None)
+
+
+def write_packed_index(packed_path, module_name, keys, times):
+  """Writes the index of a packed bottleneck array.
+
+  Args:
+    packed_path: Path string of the packed array.
+    module_name: The name of the image module being used.
+    keys: The bottleneck key of every row, or None for rows to create again.
+    times: The time every row's bottleneck was created, in seconds.
+  """
+  index_path = get_packed_index_path(packed_path)
+  tmp_path = '%s.%s-%d.tmp' % (index_path, socket.gethostname(), os.getpid())
+  with open(tmp_path, 'w') as index_file:
+    json.dump({'module': module_name, 'keys': keys, 'times': times},
+              index_file)
+  tf.gfile.Rename(tmp_path, index_path, overwrite=True)
+
+
+def remove_cached_bottleneck(bottleneck_path):
+  """Removes an image's own bottleneck file, and any text one left over."""
+  for cached_path in (bottleneck_path,
+                      bottleneck_path[:-len('.npy')] + '.txt'):
+    try:
+      os.remove(cached_path)
+    except OSError:
+      pass  # Not cached, or removed by another process.
+
+
+def verify_bottlenecks(image_lists, bottleneck_dir, module_name):
+  """Removes the invalid bottlenecks left behind by interrupted workers.
+
+  Every bottleneck file not packed yet is read back. Bottlenecks that can't be
+  read, or that are a different size to the rest, are deleted so they are
+  created again. Temporary files abandoned more than an hour ago are deleted
+  too.
+
+  Args:
+    image_lists: OrderedDict of training images for each label.
+    bottleneck_dir: Folder string holding cached files of bottleneck values.
+    module_name: The name of the image module being used.
+  """
+  module_suffix = '_' + get_module_path_name(module_name)
+  sizes = collections.Counter()
+  unreadable = []
+  valid = []
+  for label_lists in image_lists.values():
+    sub_dir_path = os.path.join(bottleneck_dir, label_lists['dir'])
+    if not os.path.isdir(sub_dir_path):
+      continue
+    for entry in os.listdir(sub_dir_path):
+      bottleneck_path = os.path.join(sub_dir_path, entry)
+      if entry.endswith('.tmp'):
+        if os.path.getmtime(bottleneck_path) < time.time() - 3600:
+          os.remove(bottleneck_path)
+        continue
+      if not entry.endswith('.npy') or module_suffix not in entry:
+        continue
+      try:
+        size = load_bottleneck(bottleneck_path).size
+      except ValueError:
+        unreadable.append(bottleneck_path)
+        continue
+      sizes[size] += 1
+      valid.append((bottleneck_path, size))
+  invalid = list(unreadable)
+  if sizes:
+    expected_size = sizes.most_common(1)[0][0]
+    invalid.extend(path for path, size in valid if size != expected_size)
+  for bottleneck_path in invalid:
+    tf.logging.warning('Invalid bottleneck found, removing ' + bottleneck_path)
+    os.remove(bottleneck_path)
+  tf.logging.info('Verified %d unpacked bottlenecks: %d invalid' %
+                  (len(valid) + len(unreadable), len(invalid)))
+
+
+def remove_modified_bottlenecks(image_lists, image_dir, bottleneck_dir,
+                                module_name, categories, variants=None):
+  """Removes the bottlenecks of images modified since they were cached.
+
+  Their rows are dropped from the index of the set's packed array, so the set
+  no longer matches it and they are created again when it is packed again.
+
+  Args:
+    image_lists: OrderedDict of training images for each label.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    bottleneck_dir: Folder string holding cached files of bottleneck values.
+    module_name: The name of the image module being used.
+    categories: The names of the sets to check.
+    variants: The Variants cached for each image, or None.
+  """
+  for category in categories:
+    packed, packed_rows = load_packed_rows(bottleneck_dir, category,
+                                           module_name, variants)
+    keys = [None] * (0 if packed is None else packed.shape[0])
+    times = list(keys)
+    for key, (row, created) in packed_rows.items():
+      keys[row] = key
+      times[row] = created
+    del packed
+    modified = 0
+    for label_name, label_lists in image_lists.items():
+      for index, base_name in enumerate(label_lists[category]):
+        try:
+          image_mtime = os.path.getmtime(get_image_path(
+              image_lists, label_name, index, image_dir, category))
+        except OSError:
+          continue  # Removed since the image lists were made.
+        for variant in variants.suffixes if variants else [None]:
+          key = label_lists['dir'] + '/' + base_name
+          if variant:
+            key += '#' + variant
+          if key in packed_rows and image_mtime > packed_rows[key][1]:
+            keys[packed_rows[key][0]] = None
+            modified += 1
+          # Bottlenecks created since the set was last packed.
+          bottleneck_path = get_bottleneck_path(image_lists, label_name, index,
+                                                bottleneck_dir, category,
+                                                module_name, variant)
+          for cached_path in (bottleneck_path,
+                              bottleneck_path[:-len('.npy')] + '.txt'):
+            try:
+              if image_mtime > os.path.getmtime(cached_path):
+                os.remove(cached_path)
+                modified += 1
+            except OSError:
+              pass  # Not cached, or removed by another process.
+    if modified:
+      tf.logging.info('Recreating %d %s bottlenecks of modified images' %
+                      (modified, category))
+      if packed_rows:
+        write_packed_index(get_packed_bottleneck_path(
+            bottleneck_dir, category, module_name, variants), module_name,
+                           keys, times)
 
 
 def cache_bottlenecks(sess, image_lists, image_dir, bottleneck_dir,
                       jpeg_data_tensor, decoded_image_tensor,
-                      resized_input_tensor, bottleneck_tensor, module_name):
+                      resized_input_tensor, bottleneck_tensor, module_name,
+                      bottleneck_dtype='float32', batch_size=32,
+                      decode_threads=4, num_shards=1, shard_index=0,
+                      categories=CATEGORIES, variants=None,
+                      distortions=None, recreate_modified=False):
   """Ensures all the training, testing, and validation bottlenecks are cached.
 
   Because we're likely to read the same image multiple times (if there are no
@@ -443,6 +1025,22 @@ def cache_bottlenecks(sess, image_lists, image_dir, bottleneck_dir,
   training. Here we go through all the images we've found, calculate those
   values, and save them off.
 
+  Every set is stored as a single packed array that load_packed_bottlenecks()
+  can memory-map, along with an index of the image in every row. Only the
+  bottlenecks of images the array doesn't hold yet are calculated, in batches,
+  with the images decoded in parallel. They are written to .npy files of their
+  own, which are removed once their rows have been added to the array. Sets
+  that are already packed and haven't changed are skipped.
+
+  The work can be split between processes or machines sharing a bottleneck
+  directory by running each with its own shard_index. Shards only create
+  their own bottlenecks. Run once more without shards to verify the
+  bottlenecks, create any the shards missed and pack them.
+
+  With variants, every image is instead cached as several randomly distorted
+  variants, packed together, variant after variant, into an array of their
+  own.
+
   Args:
     sess: The current active TensorFlow Session.
     image_lists: OrderedDict of training images for each label.
@@ -454,31 +1052,143 @@ def cache_bottlenecks(sess, image_lists, image_dir, bottleneck_dir,
     resized_input_tensor: The input node of the recognition graph.
     bottleneck_tensor: The penultimate output layer of the graph.
     module_name: The name of the image module being used.
+    bottleneck_dtype: Name string of the type to store the bottlenecks as,
+    float16 or float32.
+    batch_size: Integer number of images to run through the module at once.
+    decode_threads: Integer number of images to decode in parallel.
+    num_shards: Integer number of shards the work is split into.
+    shard_index: Integer index of this process' shard.
+    categories: The names of the sets to cache.
+    variants: The Variants to cache for each image, or None to cache the
+    images as they are.
+    distortions: The (flip_left_right, random_crop, random_scale,
+    random_brightness) distortions the variants are made with.
+    recreate_modified: Whether to create the bottlenecks of images modified
+    since they were cached again.
 
   Returns:
     Nothing.
   """
-  how_many_bottlenecks = 0
   ensure_dir_exists(bottleneck_dir)
+  if recreate_modified and num_shards == 1:
+    remove_modified_bottlenecks(image_lists, image_dir, bottleneck_dir,
+                                module_name, categories, variants)
+  categories = [
+      category for category in categories
+      if get_bottleneck_keys(image_lists, category) and load_packed_bottlenecks(
+          image_lists, category, bottleneck_dir, module_name,
+          bottleneck_dtype, variants) is None]
+  if not categories:
+    return
+  if num_shards == 1:
+    verify_bottlenecks(image_lists, bottleneck_dir, module_name)
+  old_packs = dict(
+      (category, load_packed_rows(bottleneck_dir, category, module_name,
+                                  variants))
+      for category in categories)
+
+  # Calculate the bottlenecks we don't have yet in batches.
+  jobs = []
   for label_name, label_lists in image_lists.items():
-    for category in ['training', 'testing', 'validation']:
-      category_list = label_lists[category]
-      for index, unused_base_name in enumerate(category_list):
-        get_or_create_bottleneck(
-            sess, image_lists, label_name, index, image_dir, category,
-            bottleneck_dir, jpeg_data_tensor, decoded_image_tensor,
-            resized_input_tensor, bottleneck_tensor, module_name)
+    ensure_dir_exists(os.path.join(bottleneck_dir, label_lists['dir']))
+    for category in categories:
+      packed_rows = old_packs[category][1]
+      for index, base_name in enumerate(label_lists[category]):
+        for variant in variants.suffixes if variants else [None]:
+          key = label_lists['dir'] + '/' + base_name
+          if variant:
+            key += '#' + variant
+          if key in packed_rows or not in_shard(key, num_shards, shard_index):
+            continue
+          bottleneck_path = get_bottleneck_path(image_lists, label_name, index,
+                                                bottleneck_dir, category,
+                                                module_name, variant)
+          if not (os.path.exists(bottleneck_path) or
+                  os.path.exists(bottleneck_path[:-len('.npy')] + '.txt')):
+            jobs.append((get_image_path(image_lists, label_name, index,
+                                        image_dir, category), bottleneck_path))
+  if jobs:
+    tf.logging.info('Creating %d bottlenecks' % len(jobs))
+    with sess.graph.as_default():
+      input_pipeline = add_bottleneck_input_pipeline(
+          resized_input_tensor, batch_size, decode_threads,
+          distortions if variants else None)
+    failed = extract_bottlenecks(sess, jobs, input_pipeline,
+                                 resized_input_tensor, bottleneck_tensor,
+                                 bottleneck_dtype)
+    for image_path, _ in failed:
+      tf.logging.warning('Could not decode %s' % image_path)
+  if num_shards > 1:
+    return  # Packing waits for every shard to finish.
+
+  # Pack every set, reusing the rows of the old array, this also creates any
+  # bottleneck that failed above. Distorted variants are only made by the
+  # pipeline, so they can't be.
+  how_many_bottlenecks = 0
+  for category in categories:
+    keys = get_bottleneck_keys(image_lists, category, variants)
+    packed_path = get_packed_bottleneck_path(bottleneck_dir, category,
+                                             module_name, variants)
+    old_packed, packed_rows = old_packs.pop(category)
+    packed = None
+    times = []
+    unpacked_paths = []
+    for label_name, label_lists in image_lists.items():
+      for index, variant in itertools.product(
+          range(len(label_lists[category])),
+          variants.suffixes if variants else [None]):
+        key = keys[len(times)]
+        if key in packed_rows:
+          old_row, created = packed_rows[key]
+          bottleneck_values = old_packed[old_row]
+        else:
+          bottleneck_path = get_bottleneck_path(
+              image_lists, label_name, index, bottleneck_dir, category,
+              module_name, variant)
+          if variant:
+            try:
+              bottleneck_values = load_bottleneck(bottleneck_path)
+            except ValueError as e:
+              raise RuntimeError('Could not create bottleneck %s (%s)' %
+                                 (bottleneck_path, str(e)))
+          else:
+            bottleneck_values = get_or_create_bottleneck(
+                sess, image_lists, label_name, index, image_dir, category,
+                bottleneck_dir, jpeg_data_tensor, decoded_image_tensor,
+                resized_input_tensor, bottleneck_tensor, module_name,
+                bottleneck_dtype)
+          created = os.path.getmtime(bottleneck_path)
+          unpacked_paths.append(bottleneck_path)
+        if packed is None:
+          packed = np.lib.format.open_memmap(
+              packed_path + '.tmp', mode='w+', dtype=bottleneck_dtype,
+              shape=(len(keys), bottleneck_values.size))
+        packed[len(times)] = bottleneck_values
+        times.append(created)
 
         how_many_bottlenecks += 1
-        if how_many_bottlenecks % 100 == 0:
-          tf.logging.info(
-              str(how_many_bottlenecks) + ' bottleneck files created.')
+        if how_many_bottlenecks % 10000 == 0:
+          tf.logging.info(str(how_many_bottlenecks) + ' bottlenecks packed.')
+    packed.flush()
+    del packed, old_packed
+    # Drop the old index first, so the new array is never read with it.
+    index_path = get_packed_index_path(packed_path)
+    if tf.gfile.Exists(index_path):
+      tf.gfile.Remove(index_path)
+    tf.gfile.Rename(packed_path + '.tmp', packed_path, overwrite=True)
+    write_packed_index(packed_path, module_name, keys, times)
+    # The array is the store now, the bottlenecks' own files aren't needed.
+    for bottleneck_path in unpacked_paths:
+      remove_cached_bottleneck(bottleneck_path)
+    tf.logging.info('Packed %d %s bottlenecks into %s (%d new)' %
+                    (len(keys), category, packed_path, len(unpacked_paths)))
 
 
 def get_random_cached_bottlenecks(sess, image_lists, how_many, category,
                                   bottleneck_dir, image_dir, jpeg_data_tensor,
                                   decoded_image_tensor, resized_input_tensor,
-                                  bottleneck_tensor, module_name):
+                                  bottleneck_tensor, module_name,
+                                  bottleneck_dtype='float32'):
   """Retrieves bottleneck values for cached images.
 
   If no distortions are being applied, this function can retrieve the cached
@@ -500,32 +1210,56 @@ def get_random_cached_bottlenecks(sess, image_lists, how_many, category,
     resized_input_tensor: The input node of the recognition graph.
     bottleneck_tensor: The bottleneck output layer of the CNN graph.
     module_name: The name of the image module being used.
+    bottleneck_dtype: Name string of the type to store new bottlenecks as.
 
   Returns:
     List of bottleneck arrays, their corresponding ground truths, and the
-    relevant filenames.
+    relevant filenames. When all the bottlenecks of a packed set are retrieved
+    they are returned as a single [image count, bottleneck size] array.
   """
-  class_count = len(image_lists.keys())
+  label_names = list(image_lists.keys())
+  class_count = len(label_names)
   bottlenecks = []
   ground_truths = []
   filenames = []
   if how_many >= 0:
-    # Retrieve a random sample of bottlenecks.
+    # Retrieve a random sample of bottlenecks, from the packed array if we have
+    # one, since the bottlenecks in it have no files of their own.
+    packed = load_packed_bottlenecks(image_lists, category, bottleneck_dir,
+                                     module_name)
+    class_counts = [len(image_lists[label_name][category])
+                    for label_name in label_names]
+    class_starts = np.cumsum(class_counts) - class_counts
     for unused_i in range(how_many):
       label_index = random.randrange(class_count)
-      label_name = list(image_lists.keys())[label_index]
+      label_name = label_names[label_index]
       image_index = random.randrange(MAX_NUM_IMAGES_PER_CLASS + 1)
       image_name = get_image_path(image_lists, label_name, image_index,
                                   image_dir, category)
-      bottleneck = get_or_create_bottleneck(
-          sess, image_lists, label_name, image_index, image_dir, category,
-          bottleneck_dir, jpeg_data_tensor, decoded_image_tensor,
-          resized_input_tensor, bottleneck_tensor, module_name)
+      if packed is not None:
+        bottleneck = np.asarray(packed[class_starts[label_index] + image_index %
+                                       class_counts[label_index]],
+                                dtype=np.float32)
+      else:
+        bottleneck = get_or_create_bottleneck(
+            sess, image_lists, label_name, image_index, image_dir, category,
+            bottleneck_dir, jpeg_data_tensor, decoded_image_tensor,
+            resized_input_tensor, bottleneck_tensor, module_name,
+            bottleneck_dtype)
       bottlenecks.append(bottleneck)
       ground_truths.append(label_index)
       filenames.append(image_name)
   else:
-    # Retrieve all bottlenecks.
+    # Retrieve all bottlenecks, straight from the packed array if we have one.
+    packed = load_packed_bottlenecks(image_lists, category, bottleneck_dir,
+                                     module_name)
+    if packed is not None:
+      for label_index, label_name in enumerate(image_lists.keys()):
+        for image_index in range(len(image_lists[label_name][category])):
+          ground_truths.append(label_index)
+          filenames.append(get_image_path(image_lists, label_name, image_index,
+                                          image_dir, category))
+      return packed.astype(np.float32), ground_truths, filenames
     for label_index, label_name in enumerate(image_lists.keys()):
       for image_index, image_name in enumerate(
           image_lists[label_name][category]):
@@ -534,63 +1268,83 @@ def get_random_cached_bottlenecks(sess, image_lists, how_many, category,
         bottleneck = get_or_create_bottleneck(
             sess, image_lists, label_name, image_index, image_dir, category,
             bottleneck_dir, jpeg_data_tensor, decoded_image_tensor,
-            resized_input_tensor, bottleneck_tensor, module_name)
+            resized_input_tensor, bottleneck_tensor, module_name,
+            bottleneck_dtype)
         bottlenecks.append(bottleneck)
         ground_truths.append(label_index)
         filenames.append(image_name)
   return bottlenecks, ground_truths, filenames
 
 
-def get_random_distorted_bottlenecks(
-    sess, image_lists, how_many, category, image_dir, input_jpeg_tensor,
-    distorted_image, resized_input_tensor, bottleneck_tensor):
-  """Retrieves bottleneck values for training images, after distortions.
+def load_bottleneck_set(image_lists, category, bottleneck_dir, image_dir,
+                        module_name, variants=None):
+  """Loads the packed bottlenecks of a set of images into memory.
 
-  If we're training with distortions like crops, scales, or flips, we have to
-  recalculate the full model for every image, and so we can't use cached
-  bottleneck values. Instead we find random images for the requested category,
-  run them through the distortion graph, and then the full graph to get the
-  bottleneck results for each.
+  With variants, each of an image's distorted variants is an example of its
+  own, so sampling the set picks one of them at random.
 
   Args:
-    sess: Current TensorFlow Session.
     image_lists: OrderedDict of training images for each label.
-    how_many: The integer number of bottleneck values to return.
-    category: Name string of which set of images to fetch - training, testing,
-    or validation.
+    category: Name string of the set - training, testing, or validation.
+    bottleneck_dir: Folder string holding cached files of bottleneck values.
     image_dir: Root folder string of the subfolders containing the training
     images.
-    input_jpeg_tensor: The input layer we feed the image data to.
-    distorted_image: The output node of the distortion graph.
-    resized_input_tensor: The input node of the recognition graph.
-    bottleneck_tensor: The bottleneck output layer of the CNN graph.
+    module_name: The name of the image module being used.
+    variants: The Variants cached for each image, or None.
+
+  Returns:
+    A BottleneckSet with a contiguous float32 array of bottlenecks and an int64
+    array of their ground truths.
+
+  Raises:
+    RuntimeError: If the set is empty or hasn't been cached.
+  """
+  variant_count = len(variants.suffixes) if variants else 1
+  class_counts = np.array([len(label_lists[category]) * variant_count
+                           for label_lists in image_lists.values()],
+                          dtype=np.int64)
+  if not class_counts.sum():
+    raise RuntimeError('There are no %s images.' % category)
+  packed = load_packed_bottlenecks(image_lists, category, bottleneck_dir,
+                                   module_name, variants=variants)
+  if packed is None:
+    raise RuntimeError('The %s bottlenecks have not been cached.' % category)
+  filenames = [
+      os.path.join(image_dir, label_lists['dir'], base_name)
+      for label_lists in image_lists.values()
+      for base_name in label_lists[category]
+      for unused_variant in range(variant_count)]
+  return BottleneckSet(
+      bottlenecks=np.ascontiguousarray(packed, dtype=np.float32),
+      ground_truth=np.repeat(np.arange(len(class_counts)), class_counts),
+      filenames=filenames,
+      class_starts=np.cumsum(class_counts) - class_counts,
+      class_counts=class_counts)
+
+
+def sample_bottlenecks(bottleneck_set, how_many):
+  """Draws a random mini-batch from a set of bottlenecks held in memory.
+
+  Like get_random_cached_bottlenecks(), a class is picked at random for every
+  example and then an image of that class, so every class is equally likely
+  however many images it has. Classes without any images are never picked.
+
+  Args:
+    bottleneck_set: The BottleneckSet from load_bottleneck_set().
+    how_many: If positive, a random sample of this size will be chosen.
+    If negative, the whole set is returned.
 
   Returns:
-    List of bottleneck arrays and their corresponding ground truths.
+    Arrays of the bottlenecks and their corresponding ground truths.
   """
-  class_count = len(image_lists.keys())
-  bottlenecks = []
-  ground_truths = []
-  for unused_i in range(how_many):
-    label_index = random.randrange(class_count)
-    label_name = list(image_lists.keys())[label_index]
-    image_index = random.randrange(MAX_NUM_IMAGES_PER_CLASS + 1)
-    image_path = get_image_path(image_lists, label_name, image_index, image_dir,
-                                category)
-    if not tf.gfile.Exists(image_path):
-      tf.logging.fatal('File does not exist %s', image_path)
-    jpeg_data = tf.gfile.FastGFile(image_path, 'rb').read()
-    # Note that we materialize the distorted_image_data as a numpy array before
-    # sending running inference on the image. This involves 2 memory copies and
-    # might be optimized in other implementations.
-    distorted_image_data = sess.run(distorted_image,
-                                    {input_jpeg_tensor: jpeg_data})
-    bottleneck_values = sess.run(bottleneck_tensor,
-                                 {resized_input_tensor: distorted_image_data})
-    bottleneck_values = np.squeeze(bottleneck_values)
-    bottlenecks.append(bottleneck_values)
-    ground_truths.append(label_index)
-  return bottlenecks, ground_truths
+  if how_many < 0:
+    return bottleneck_set.bottlenecks, bottleneck_set.ground_truth
+  labels = np.flatnonzero(bottleneck_set.class_counts)
+  labels = labels[np.random.randint(len(labels), size=how_many)]
+  offsets = (np.random.random_sample(how_many) *
+             bottleneck_set.class_counts[labels]).astype(np.int64)
+  rows = bottleneck_set.class_starts[labels] + offsets
+  return bottleneck_set.bottlenecks[rows], bottleneck_set.ground_truth[rows]
 
 
 def should_distort_images(flip_left_right, random_crop, random_scale,
@@ -668,6 +1422,33 @@ def add_input_distortions(flip_left_right, random_crop, random_scale,
   input_height, input_width = hub.get_expected_image_size(module_spec)
   input_depth = hub.get_num_image_channels(module_spec)
   jpeg_data = tf.placeholder(tf.string, name='DistortJPGInput')
+  distorted_image = distort_jpeg(jpeg_data, flip_left_right, random_crop,
+                                 random_scale, random_brightness, input_height,
+                                 input_width, input_depth)
+  distort_result = tf.expand_dims(distorted_image, 0, name='DistortResult')
+  return jpeg_data, distort_result
+
+
+def distort_jpeg(jpeg_data, flip_left_right, random_crop, random_scale,
+                 random_brightness, input_height, input_width, input_depth):
+  """Adds operations that decode a JPEG and apply random distortions to it.
+
+  See add_input_distortions() for what the distortions do.
+
+  Args:
+    jpeg_data: String tensor of raw JPEG data.
+    flip_left_right: Boolean whether to randomly mirror images horizontally.
+    random_crop: Integer percentage setting the total margin used around the
+    crop box.
+    random_scale: Integer percentage of how much to vary the scale by.
+    random_brightness: Integer range to randomly multiply the pixel values by.
+    input_height: Integer height the module expects.
+    input_width: Integer width the module expects.
+    input_depth: Integer number of channels the module expects.
+
+  Returns:
+    The distorted [input_height, input_width, input_depth] float32 image.
+  """
   decoded_image = tf.image.decode_jpeg(jpeg_data, channels=input_depth)
   # Convert from full range of uint8 to range [0,1] of float32.
   decoded_image_as_float = tf.image.convert_image_dtype(decoded_image,
@@ -698,9 +1479,72 @@ def add_input_distortions(flip_left_right, random_crop, random_scale,
   brightness_value = tf.random_uniform(shape=[],
                                        minval=brightness_min,
                                        maxval=brightness_max)
-  brightened_image = tf.multiply(flipped_image, brightness_value)
-  distort_result = tf.expand_dims(brightened_image, 0, name='DistortResult')
-  return jpeg_data, distort_result
+  return tf.multiply(flipped_image, brightness_value)
+
+
+def add_distorted_input_pipeline(image_lists, category, image_dir, batch_size,
+                                 decode_threads, flip_left_right, random_crop,
+                                 random_scale, random_brightness, module_spec):
+  """Adds a tf.data pipeline that produces batches of distorted images.
+
+  Like get_random_cached_bottlenecks(), every example is drawn from a class
+  picked at random, so all classes are equally likely. Each class's files are
+  shuffled and cycled through. Files are read, decoded and distorted on
+  decode_threads threads, batched inside the graph, and the next batches are
+  prefetched while the current training step runs.
+
+  Args:
+    image_lists: OrderedDict of training images for each label.
+    category: Name string of the set to draw images from.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    batch_size: Integer number of images per batch.
+    decode_threads: Integer number of images to decode in parallel.
+    flip_left_right: Boolean whether to randomly mirror images horizontally.
+    random_crop: Integer percentage setting the total margin used around the
+    crop box.
+    random_scale: Integer percentage of how much to vary the scale by.
+    random_brightness: Integer range to randomly multiply the pixel values by.
+    module_spec: The hub.ModuleSpec for the image module being used.
+
+  Returns:
+    The pipeline's initializer, the feed dict to run it with, and the tensors
+    for the next batch of distorted images and their ground truths.
+  """
+  input_height, input_width = hub.get_expected_image_size(module_spec)
+  input_depth = hub.get_num_image_channels(module_spec)
+  # The paths are fed in rather than baked into the graph as constants.
+  feed_dict = {}
+  datasets = []
+  for label_index, label_lists in enumerate(image_lists.values()):
+    if not label_lists[category]:
+      continue
+    image_paths = tf.placeholder(tf.string, [None])
+    feed_dict[image_paths] = [
+        os.path.join(image_dir, label_lists['dir'], base_name)
+        for base_name in label_lists[category]]
+    dataset = tf.data.Dataset.from_tensor_slices(image_paths)
+    dataset = dataset.shuffle(tf.cast(tf.size(image_paths), tf.int64))
+    dataset = dataset.repeat()
+    dataset = dataset.map(
+        lambda image_path, label_index=label_index: (
+            image_path, tf.constant(label_index, dtype=tf.int64)))
+    datasets.append(dataset)
+
+  def load_image(image_path, label_index):
+    distorted_image = distort_jpeg(tf.read_file(image_path), flip_left_right,
+                                   random_crop, random_scale,
+                                   random_brightness, input_height,
+                                   input_width, input_depth)
+    return distorted_image, label_index
+
+  dataset = tf.contrib.data.sample_from_datasets(datasets)
+  dataset = dataset.map(load_image, num_parallel_calls=decode_threads)
+  dataset = dataset.apply(tf.contrib.data.ignore_errors())
+  dataset = dataset.batch(batch_size).prefetch(2)
+  iterator = dataset.make_initializable_iterator()
+  images, ground_truths = iterator.get_next()
+  return iterator.initializer, feed_dict, images, ground_truths
 
 
 def variable_summaries(var):
@@ -717,7 +1561,8 @@ def variable_summaries(var):
 
 
 def add_final_retrain_ops(class_count, final_tensor_name, bottleneck_tensor,
-                          quantize_layer, is_training):
+                          quantize_layer, is_training,
+                          default_ground_truth=None):
   """Adds a new softmax and fully-connected layer for training and eval.
 
   We need to retrain the top layer to identify our new classes, so this function
@@ -736,6 +1581,8 @@ def add_final_retrain_ops(class_count, final_tensor_name, bottleneck_tensor,
         instrumented for quantization with TF-Lite.
     is_training: Boolean, specifying whether the newly add layer is for training
         or eval.
+    default_ground_truth: Tensor of the ground truths of the images the module
+        reads when no bottlenecks are fed, or None to always feed them.
 
   Returns:
     The tensors for the training and cross entropy results, and tensors for the
@@ -749,8 +1596,12 @@ def add_final_retrain_ops(class_count, final_tensor_name, bottleneck_tensor,
         shape=[batch_size, bottleneck_tensor_size],
         name='BottleneckInputPlaceholder')
 
-    ground_truth_input = tf.placeholder(
-        tf.int64, [batch_size], name='GroundTruthInput')
+    if default_ground_truth is None:
+      ground_truth_input = tf.placeholder(
+          tf.int64, [batch_size], name='GroundTruthInput')
+    else:
+      ground_truth_input = tf.placeholder_with_default(
+          default_ground_truth, [batch_size], name='GroundTruthInput')
 
   # Organizing the following ops so they are easier to see in TensorBoard.
   layer_name = 'final_retrain_ops'
@@ -801,6 +1652,59 @@ def add_final_retrain_ops(class_count, final_tensor_name, bottleneck_tensor,
           final_tensor)
 
 
+def warm_start_final_retrain_ops(sess, checkpoint_name, previous_labels,
+                                 labels):
+  """Starts the new layer from the weights of an earlier training run.
+
+  Every class that was trained before gets its weights and bias back, so
+  only the classes added since have to be learned from scratch. They keep
+  their random initial values.
+
+  Args:
+    sess: The current active TensorFlow Session, with its variables
+    initialized.
+    checkpoint_name: Path prefix string of the earlier run's checkpoint.
+    previous_labels: List of the label strings of the earlier run, in class
+    index order.
+    labels: List of the label strings being trained now, in class index order.
+
+  Returns:
+    Integer number of classes warm started.
+
+  Raises:
+    RuntimeError: If the checkpoint can't be read or doesn't match the earlier
+    labels or the current module.
+  """
+  variables = {variable.op.name: variable
+               for variable in sess.graph.get_collection(
+                   tf.GraphKeys.GLOBAL_VARIABLES)}
+  weights = variables['final_retrain_ops/weights/final_weights']
+  biases = variables['final_retrain_ops/biases/final_biases']
+  try:
+    reader = tf.train.NewCheckpointReader(checkpoint_name)
+    previous_weights = reader.get_tensor(weights.op.name)
+    previous_biases = reader.get_tensor(biases.op.name)
+  except tf.errors.OpError as e:
+    raise RuntimeError('Could not read checkpoint %s (%s)' %
+                       (checkpoint_name, str(e)))
+  new_weights, new_biases = sess.run([weights, biases])
+  if (previous_weights.shape != (new_weights.shape[0], len(previous_labels)) or
+      previous_biases.shape != (len(previous_labels),)):
+    raise RuntimeError('Checkpoint %s was not trained on these labels with '
+                       'this module' % checkpoint_name)
+  previous_indexes = {label: index
+                      for index, label in enumerate(previous_labels)}
+  warm_started = 0
+  for index, label in enumerate(labels):
+    if label in previous_indexes:
+      new_weights[:, index] = previous_weights[:, previous_indexes[label]]
+      new_biases[index] = previous_biases[previous_indexes[label]]
+      warm_started += 1
+  weights.load(new_weights, sess)
+  biases.load(new_biases, sess)
+  return warm_started
+
+
 def add_evaluation_step(result_tensor, ground_truth_tensor):
   """Inserts the operations we need to evaluate the accuracy of our results.
 
@@ -822,10 +1726,115 @@ def add_evaluation_step(result_tensor, ground_truth_tensor):
   return evaluation_step, prediction
 
 
+def iterate_packed_bottlenecks(image_lists, category, bottleneck_dir,
+                               image_dir, module_name, chunk_size):
+  """Reads the packed bottlenecks of a set of images a chunk at a time.
+
+  Only one chunk is held in memory at once, however large the set is.
+
+  Args:
+    image_lists: OrderedDict of training images for each label.
+    category: Name string of the set - training, testing, or validation.
+    bottleneck_dir: Folder string holding cached files of bottleneck values.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    module_name: The name of the image module being used.
+    chunk_size: Integer number of bottlenecks per chunk.
+
+  Yields:
+    A float32 array of up to chunk_size bottlenecks, an int64 array of their
+    ground truths and a list of their filenames.
+
+  Raises:
+    RuntimeError: If the set hasn't been cached.
+  """
+  label_lists = list(image_lists.values())
+  class_ends = np.cumsum([len(lists[category]) for lists in label_lists])
+  if not class_ends[-1]:
+    return
+  packed = load_packed_bottlenecks(image_lists, category, bottleneck_dir,
+                                   module_name)
+  if packed is None:
+    raise RuntimeError('The %s bottlenecks have not been cached.' % category)
+  for chunk_start in range(0, packed.shape[0], chunk_size):
+    rows = np.arange(chunk_start, min(chunk_start + chunk_size,
+                                      packed.shape[0]))
+    ground_truth = np.searchsorted(class_ends, rows, side='right')
+    filenames = []
+    for row, label_index in zip(rows, ground_truth):
+      lists = label_lists[label_index]
+      index = row - (class_ends[label_index] - len(lists[category]))
+      filenames.append(os.path.join(image_dir, lists['dir'],
+                                    lists[category][index]))
+    yield (np.asarray(packed[rows[0]:rows[-1] + 1], dtype=np.float32),
+           ground_truth.astype(np.int64), filenames)
+
+
+def write_eval_report(report_path, confusion, label_names, module_name):
+  """Logs the per-class results of an evaluation and saves them as JSON.
+
+  Args:
+    report_path: Path string of the JSON report to write, or empty to only
+    log the results.
+    confusion: [class count, class count] Numpy array counting the images of
+    each class (rows) predicted as each class (columns).
+    label_names: List of the label strings, in class index order.
+    module_name: The name of the image module being used.
+
+  Returns:
+    The report dictionary.
+  """
+  def ratio(count, total):
+    return float(count) / total if total else None
+
+  def percentage(value):
+    return 'n/a' if value is None else '%.1f%%' % (value * 100)
+
+  correct = np.diag(confusion)
+  predicted = confusion.sum(axis=0)
+  support = confusion.sum(axis=1)
+  per_class = collections.OrderedDict()
+  for label_index, label_name in enumerate(label_names):
+    precision = ratio(correct[label_index], predicted[label_index])
+    recall = ratio(correct[label_index], support[label_index])
+    per_class[label_name] = {
+        'precision': precision,
+        'recall': recall,
+        'support': int(support[label_index]),
+    }
+    tf.logging.info('%30s: precision %s, recall %s (N=%d)' %
+                    (label_name, percentage(precision), percentage(recall),
+                     support[label_index]))
+  report = collections.OrderedDict([
+      ('module', module_name),
+      ('count', int(confusion.sum())),
+      ('accuracy', ratio(correct.sum(), confusion.sum())),
+      ('labels', list(label_names)),
+      ('per_class', per_class),
+      ('confusion_matrix', confusion.tolist()),
+  ])
+  if report_path:
+    with tf.gfile.GFile(report_path, 'w') as report_file:
+      json.dump(report, report_file, indent=2)
+    tf.logging.info('Wrote evaluation report to ' + report_path)
+  return report
+
+
 def run_final_eval(train_session, module_spec, class_count, image_lists,
                    jpeg_data_tensor, decoded_image_tensor,
-                   resized_image_tensor, bottleneck_tensor):
-  """Runs a final evaluation on an eval graph using the test data set.
+                   resized_image_tensor, bottleneck_tensor,
+                   bottleneck_input=None, prediction=None):
+  """Runs a final evaluation on the test data set.
+
+  The whole test set is streamed from the packed bottlenecks in chunks of
+  --eval_chunk_size, so memory use doesn't grow with the size of the test set.
+  The accuracy, a confusion matrix and each class's precision and recall are
+  written to --eval_report.
+
+  The new layer is evaluated in the train session when its bottleneck input and
+  prediction tensors are given, since it behaves the same there. Otherwise, as
+  for quantized layers, an eval graph is built and restored from the
+  checkpoint.
 
   Args:
     train_session: Session for the train graph with the tensors below.
@@ -836,32 +1845,57 @@ def run_final_eval(train_session, module_spec, class_count, image_lists,
     decoded_image_tensor: The output of decoding and resizing the image.
     resized_image_tensor: The input node of the recognition graph.
     bottleneck_tensor: The bottleneck output layer of the CNN graph.
+    bottleneck_input: The train graph's bottleneck input, or None.
+    prediction: The train graph's prediction tensor, or None.
   """
-  test_bottlenecks, test_ground_truth, test_filenames = (
-      get_random_cached_bottlenecks(train_session, image_lists,
-                                    FLAGS.test_batch_size,
-                                    'testing', FLAGS.bottleneck_dir,
-                                    FLAGS.image_dir, jpeg_data_tensor,
-                                    decoded_image_tensor, resized_image_tensor,
-                                    bottleneck_tensor, FLAGS.tfhub_module))
-
-  (eval_session, _, bottleneck_input, ground_truth_input, evaluation_step,
-   prediction) = build_eval_session(module_spec, class_count)
-  test_accuracy, predictions = eval_session.run(
-      [evaluation_step, prediction],
-      feed_dict={
-          bottleneck_input: test_bottlenecks,
-          ground_truth_input: test_ground_truth
-      })
-  tf.logging.info('Final test accuracy = %.1f%% (N=%d)' %
-                  (test_accuracy * 100, len(test_bottlenecks)))
-
+  if FLAGS.test_batch_size < 0:
+    chunks = iterate_packed_bottlenecks(image_lists, 'testing',
+                                        FLAGS.bottleneck_dir, FLAGS.image_dir,
+                                        FLAGS.tfhub_module,
+                                        FLAGS.eval_chunk_size)
+  else:
+    test_bottlenecks, test_ground_truth, test_filenames = (
+        get_random_cached_bottlenecks(train_session, image_lists,
+                                      FLAGS.test_batch_size,
+                                      'testing', FLAGS.bottleneck_dir,
+                                      FLAGS.image_dir, jpeg_data_tensor,
+                                      decoded_image_tensor,
+                                      resized_image_tensor, bottleneck_tensor,
+                                      FLAGS.tfhub_module,
+                                      FLAGS.bottleneck_dtype))
+    chunks = [(np.asarray(test_bottlenecks, dtype=np.float32),
+               np.asarray(test_ground_truth, dtype=np.int64), test_filenames)]
+
+  eval_session = None
+  if bottleneck_input is None or prediction is None:
+    (eval_session, _, bottleneck_input, _, _,
+     prediction) = build_eval_session(module_spec, class_count)
+  label_names = list(image_lists.keys())
+  confusion = np.zeros([class_count, class_count], dtype=np.int64)
   if FLAGS.print_misclassified_test_images:
     tf.logging.info('=== MISCLASSIFIED TEST IMAGES ===')
-    for i, test_filename in enumerate(test_filenames):
-      if predictions[i] != test_ground_truth[i]:
-        tf.logging.info('%70s  %s' % (test_filename,
-                                      list(image_lists.keys())[predictions[i]]))
+  for test_bottlenecks, test_ground_truth, test_filenames in chunks:
+    if not len(test_ground_truth):
+      continue
+    predictions = (eval_session or train_session).run(
+        prediction, feed_dict={bottleneck_input: test_bottlenecks})
+    confusion += np.bincount(test_ground_truth * class_count + predictions,
+                             minlength=class_count ** 2).reshape(
+                                 [class_count, class_count])
+    if FLAGS.print_misclassified_test_images:
+      for i in np.flatnonzero(predictions != test_ground_truth):
+        tf.logging.info('%70s  %s' % (test_filenames[i],
+                                      label_names[predictions[i]]))
+  if eval_session:
+    eval_session.close()
+
+  report = write_eval_report(FLAGS.eval_report, confusion, label_names,
+                             FLAGS.tfhub_module)
+  if report['accuracy'] is None:
+    tf.logging.warning('There are no test images to evaluate.')
+    return
+  tf.logging.info('Final test accuracy = %.1f%% (N=%d)' %
+                  (report['accuracy'] * 100, report['count']))
 
 
 def build_eval_session(module_spec, class_count):
@@ -920,6 +1954,29 @@ def prepare_file_system():
   return
 
 
+def decode_and_resize_jpeg(jpeg_data, input_height, input_width, input_depth):
+  """Adds operations that decode a JPEG and resize it for the module.
+
+  Args:
+    jpeg_data: String tensor of raw JPEG data.
+    input_height: Integer height the module expects.
+    input_width: Integer width the module expects.
+    input_depth: Integer number of channels the module expects.
+
+  Returns:
+    The [1, input_height, input_width, input_depth] float32 image tensor, with
+    values in the range [0, 1].
+  """
+  decoded_image = tf.image.decode_jpeg(jpeg_data, channels=input_depth)
+  # Convert from full range of uint8 to range [0,1] of float32.
+  decoded_image_as_float = tf.image.convert_image_dtype(decoded_image,
+                                                        tf.float32)
+  decoded_image_4d = tf.expand_dims(decoded_image_as_float, 0)
+  resize_shape = tf.stack([input_height, input_width])
+  resize_shape_as_int = tf.cast(resize_shape, dtype=tf.int32)
+  return tf.image.resize_bilinear(decoded_image_4d, resize_shape_as_int)
+
+
 def add_jpeg_decoding(module_spec):
   """Adds operations that perform JPEG decoding and resizing to the graph..
 
@@ -933,15 +1990,8 @@ def add_jpeg_decoding(module_spec):
   input_height, input_width = hub.get_expected_image_size(module_spec)
   input_depth = hub.get_num_image_channels(module_spec)
   jpeg_data = tf.placeholder(tf.string, name='DecodeJPGInput')
-  decoded_image = tf.image.decode_jpeg(jpeg_data, channels=input_depth)
-  # Convert from full range of uint8 to range [0,1] of float32.
-  decoded_image_as_float = tf.image.convert_image_dtype(decoded_image,
-                                                        tf.float32)
-  decoded_image_4d = tf.expand_dims(decoded_image_as_float, 0)
-  resize_shape = tf.stack([input_height, input_width])
-  resize_shape_as_int = tf.cast(resize_shape, dtype=tf.int32)
-  resized_image = tf.image.resize_bilinear(decoded_image_4d,
-                                           resize_shape_as_int)
+  resized_image = decode_and_resize_jpeg(jpeg_data, input_height, input_width,
+                                         input_depth)
   return jpeg_data, resized_image
 
 
@@ -965,6 +2015,29 @@ def export_model(module_spec, class_count, saved_model_dir):
     )
 
 
+def run_bottleneck_workers(num_workers):
+  """Caches bottlenecks in parallel worker processes.
+
+  Each worker runs this script with the same flags on its own shard of the
+  images, and exits once its bottlenecks are cached.
+
+  Args:
+    num_workers: Integer number of processes to start.
+
+  Returns:
+    Boolean, whether every worker succeeded.
+  """
+  workers = [
+      subprocess.Popen([sys.executable, sys.argv[0]] + sys.argv[1:] + [
+          '--bottleneck_workers=0', '--cache_only',
+          '--num_shards=%d' % num_workers, '--shard_index=%d' % shard_index])
+      for shard_index in range(num_workers)]
+  failed = [worker.args for worker in workers if worker.wait() != 0]
+  for args in failed:
+    tf.logging.error('Bottleneck worker failed: ' + ' '.join(args))
+  return not failed
+
+
 def main(_):
   # Needed to make sure the logging output is visible.
   # See https://github.com/tensorflow/tensorflow/issues/3047
@@ -974,12 +2047,17 @@ def main(_):
     tf.logging.error('Must set flag --image_dir.')
     return -1
 
+  # Shards and workers only cache bottlenecks, they don't train.
+  cache_only = FLAGS.cache_only or FLAGS.num_shards > 1
+
   # Prepare necessary directories that can be used during training
-  prepare_file_system()
+  if not cache_only:
+    prepare_file_system()
 
   # Look at the folder structure, and create lists of all the images.
   image_lists = create_image_lists(FLAGS.image_dir, FLAGS.testing_percentage,
-                                   FLAGS.validation_percentage)
+                                   FLAGS.validation_percentage,
+                                   FLAGS.image_manifest)
   class_count = len(image_lists.keys())
   if class_count == 0:
     tf.logging.error('No valid folders of images found at ' + FLAGS.image_dir)
@@ -990,22 +2068,58 @@ def main(_):
                      ' - multiple classes are needed for classification.')
     return -1
 
+  # An incremental run picks up from the labels and checkpoint of the last one.
+  previous_labels = None
+  if FLAGS.incremental and not cache_only:
+    if not (tf.gfile.Exists(FLAGS.output_labels) and
+            tf.train.checkpoint_exists(CHECKPOINT_NAME)):
+      tf.logging.error('--incremental needs the labels and checkpoint of an '
+                       'earlier run at ' + FLAGS.output_labels + ' and ' +
+                       CHECKPOINT_NAME)
+      return -1
+    with tf.gfile.GFile(FLAGS.output_labels, 'r') as f:
+      previous_labels = [line.strip() for line in f if line.strip()]
+
   # See if the command-line flags mean we're applying any distortions.
-  do_distort_images = should_distort_images(
-      FLAGS.flip_left_right, FLAGS.random_crop, FLAGS.random_scale,
-      FLAGS.random_brightness)
+  distortions = (FLAGS.flip_left_right, FLAGS.random_crop, FLAGS.random_scale,
+                 FLAGS.random_brightness)
+  do_distort_images = should_distort_images(*distortions)
+  variants = None
+  if do_distort_images and FLAGS.distorted_variants > 0:
+    # Rather than distorting every image again at every step, cache the
+    # bottlenecks of a fixed number of distorted variants of each image.
+    variants = get_distortion_variants(
+        *(distortions + (FLAGS.distorted_variants,)))
+    do_distort_images = False
+
+  if FLAGS.bottleneck_workers > 1 and FLAGS.num_shards == 1:
+    if not run_bottleneck_workers(FLAGS.bottleneck_workers):
+      return -1
 
   # Set up the pre-trained graph.
   module_spec = hub.load_module_spec(FLAGS.tfhub_module)
+  graph = tf.Graph()
+  distorted_images = distorted_ground_truths = None
+  if do_distort_images:
+    # We will be applying distortions, so set up the pipeline we'll need. The
+    # module reads its batches straight from it, so a training step is a single
+    # session run rather than a round trip of the images through Python.
+    with graph.as_default():
+      (distort_initializer, distort_feed_dict, distorted_images,
+       distorted_ground_truths) = add_distorted_input_pipeline(
+           image_lists, 'training', FLAGS.image_dir, FLAGS.train_batch_size,
+           FLAGS.decode_threads, FLAGS.flip_left_right, FLAGS.random_crop,
+           FLAGS.random_scale, FLAGS.random_brightness, module_spec)
   graph, bottleneck_tensor, resized_image_tensor, wants_quantization = (
-      create_module_graph(module_spec))
+      create_module_graph(module_spec, graph, distorted_images))
 
   # Add the new layer that we'll be training.
   with graph.as_default():
     (train_step, cross_entropy, bottleneck_input,
      ground_truth_input, final_tensor) = add_final_retrain_ops(
          class_count, FLAGS.final_tensor_name, bottleneck_tensor,
-         wants_quantization, is_training=True)
+         wants_quantization, is_training=True,
+         default_ground_truth=distorted_ground_truths)
 
   with tf.Session(graph=graph) as sess:
     # Initialize all weights: for the module to their pretrained values,
@@ -1016,22 +2130,54 @@ def main(_):
     # Set up the image decoding sub-graph.
     jpeg_data_tensor, decoded_image_tensor = add_jpeg_decoding(module_spec)
 
-    if do_distort_images:
-      # We will be applying distortions, so set up the operations we'll need.
-      (distorted_jpeg_data_tensor,
-       distorted_image_tensor) = add_input_distortions(
-           FLAGS.flip_left_right, FLAGS.random_crop, FLAGS.random_scale,
-           FLAGS.random_brightness, module_spec)
-    else:
-      # We'll make sure we've calculated the 'bottleneck' image summaries and
-      # cached them on disk.
+    # We'll make sure we've calculated the 'bottleneck' image summaries and
+    # cached them on disk. With distortions the training images go through the
+    # whole module every step, so only their testing and validation sets are,
+    # unless distorted variants of the training images are cached instead.
+    cache_bottlenecks(sess, image_lists, FLAGS.image_dir,
+                      FLAGS.bottleneck_dir, jpeg_data_tensor,
+                      decoded_image_tensor, resized_image_tensor,
+                      bottleneck_tensor, FLAGS.tfhub_module,
+                      FLAGS.bottleneck_dtype, FLAGS.bottleneck_batch_size,
+                      FLAGS.decode_threads, FLAGS.num_shards,
+                      FLAGS.shard_index,
+                      ('testing', 'validation')
+                      if do_distort_images or variants else CATEGORIES,
+                      recreate_modified=FLAGS.incremental)
+    if variants:
       cache_bottlenecks(sess, image_lists, FLAGS.image_dir,
                         FLAGS.bottleneck_dir, jpeg_data_tensor,
                         decoded_image_tensor, resized_image_tensor,
-                        bottleneck_tensor, FLAGS.tfhub_module)
+                        bottleneck_tensor, FLAGS.tfhub_module,
+                        FLAGS.bottleneck_dtype, FLAGS.bottleneck_batch_size,
+                        FLAGS.decode_threads, FLAGS.num_shards,
+                        FLAGS.shard_index, ('training',), variants,
+                        distortions, FLAGS.incremental)
+    if cache_only:
+      tf.logging.info('Bottlenecks cached, not training (--cache_only)')
+      return 0
+
+    if previous_labels:
+      warm_started = warm_start_final_retrain_ops(
+          sess, CHECKPOINT_NAME, previous_labels, list(image_lists.keys()))
+      tf.logging.info('Warm started %d of %d classes from %s' %
+                      (warm_started, class_count, CHECKPOINT_NAME))
+
+    # Load the cached sets we train and validate on into memory once, so a
+    # training step doesn't have to touch the disk.
+    validation_set = load_bottleneck_set(image_lists, 'validation',
+                                         FLAGS.bottleneck_dir, FLAGS.image_dir,
+                                         FLAGS.tfhub_module)
+    if do_distort_images:
+      sess.run(distort_initializer, distort_feed_dict)
+    else:
+      training_set = load_bottleneck_set(image_lists, 'training',
+                                         FLAGS.bottleneck_dir, FLAGS.image_dir,
+                                         FLAGS.tfhub_module, variants)
 
     # Create the operations we need to evaluate the accuracy of our new layer.
-    evaluation_step, _ = add_evaluation_step(final_tensor, ground_truth_input)
+    evaluation_step, prediction = add_evaluation_step(final_tensor,
+                                                      ground_truth_input)
 
     # Merge all the summaries and write them out to the summaries_dir
     merged = tf.summary.merge_all()
@@ -1047,32 +2193,32 @@ def main(_):
 
     # Run the training for as many cycles as requested on the command line.
     for i in range(FLAGS.how_many_training_steps):
-      # Get a batch of input bottleneck values, either calculated fresh every
-      # time with distortions applied, or from the cache stored on disk.
+      is_last_step = (i + 1 == FLAGS.how_many_training_steps)
+      is_eval_step = (i % FLAGS.eval_step_interval) == 0 or is_last_step
       if do_distort_images:
-        (train_bottlenecks,
-         train_ground_truth) = get_random_distorted_bottlenecks(
-             sess, image_lists, FLAGS.train_batch_size, 'training',
-             FLAGS.image_dir, distorted_jpeg_data_tensor,
-             distorted_image_tensor, resized_image_tensor, bottleneck_tensor)
+        # Run a training step on the next batch of distorted images, calculated
+        # fresh by the module. On eval steps the batch's bottlenecks and ground
+        # truth are fetched too, to measure the train accuracy on below.
+        if is_eval_step:
+          (train_summary, _, train_bottlenecks,
+           train_ground_truth) = sess.run(
+               [merged, train_step, bottleneck_input, ground_truth_input])
+        else:
+          train_summary, _ = sess.run([merged, train_step])
       else:
-        (train_bottlenecks,
-         train_ground_truth, _) = get_random_cached_bottlenecks(
-             sess, image_lists, FLAGS.train_batch_size, 'training',
-             FLAGS.bottleneck_dir, FLAGS.image_dir, jpeg_data_tensor,
-             decoded_image_tensor, resized_image_tensor, bottleneck_tensor,
-             FLAGS.tfhub_module)
-      # Feed the bottlenecks and ground truth into the graph, and run a training
-      # step. Capture training summaries for TensorBoard with the `merged` op.
-      train_summary, _ = sess.run(
-          [merged, train_step],
-          feed_dict={bottleneck_input: train_bottlenecks,
-                     ground_truth_input: train_ground_truth})
+        # Feed a batch of bottlenecks from the cache loaded into memory, and
+        # their ground truth, into the graph, and run a training step.
+        train_bottlenecks, train_ground_truth = sample_bottlenecks(
+            training_set, FLAGS.train_batch_size)
+        train_summary, _ = sess.run(
+            [merged, train_step],
+            feed_dict={bottleneck_input: train_bottlenecks,
+                       ground_truth_input: train_ground_truth})
+      # Capture training summaries for TensorBoard with the `merged` op.
       train_writer.add_summary(train_summary, i)
 
       # Every so often, print out how well the graph is training.
-      is_last_step = (i + 1 == FLAGS.how_many_training_steps)
-      if (i % FLAGS.eval_step_interval) == 0 or is_last_step:
+      if is_eval_step:
         train_accuracy, cross_entropy_value = sess.run(
             [evaluation_step, cross_entropy],
             feed_dict={bottleneck_input: train_bottlenecks,
@@ -1084,12 +2230,8 @@ def main(_):
         # TODO: Make this use an eval graph, to avoid quantization
         # moving averages being updated by the validation set, though in
         # practice this makes a negligable difference.
-        validation_bottlenecks, validation_ground_truth, _ = (
-            get_random_cached_bottlenecks(
-                sess, image_lists, FLAGS.validation_batch_size, 'validation',
-                FLAGS.bottleneck_dir, FLAGS.image_dir, jpeg_data_tensor,
-                decoded_image_tensor, resized_image_tensor, bottleneck_tensor,
-                FLAGS.tfhub_module))
+        validation_bottlenecks, validation_ground_truth = sample_bottlenecks(
+            validation_set, FLAGS.validation_batch_size)
         # Run a validation step and capture training summaries for TensorBoard
         # with the `merged` op.
         validation_summary, validation_accuracy = sess.run(
@@ -1121,9 +2263,17 @@ def main(_):
 
     # We've completed all our training, so run a final test evaluation on
     # some new images we haven't used before.
-    run_final_eval(sess, module_spec, class_count, image_lists,
-                   jpeg_data_tensor, decoded_image_tensor, resized_image_tensor,
-                   bottleneck_tensor)
+    # A quantized layer is evaluated in its own eval graph, anything else can
+    # be evaluated right here.
+    if wants_quantization:
+      run_final_eval(sess, module_spec, class_count, image_lists,
+                     jpeg_data_tensor, decoded_image_tensor,
+                     resized_image_tensor, bottleneck_tensor)
+    else:
+      run_final_eval(sess, module_spec, class_count, image_lists,
+                     jpeg_data_tensor, decoded_image_tensor,
+                     resized_image_tensor, bottleneck_tensor, bottleneck_input,
+                     prediction)
 
     # Write out the trained graph and labels with the weights stored as
     # constants.
@@ -1146,6 +2296,15 @@ if __name__ == '__main__':
       default='',
       help='Path to folders of labeled images.'
   )
+  parser.add_argument(
+      '--image_manifest',
+      type=str,
+      default='./image_manifest.json',
+      help="""\
+      Where to record the images found in --image_dir, so later runs only scan
+      the folders that changed. Set to an empty string to scan every folder.\
+      """
+  )
   parser.add_argument(
       '--output_graph',
       type=str,
@@ -1226,6 +2385,25 @@ if __name__ == '__main__':
       stable results across runs.\
       """
   )
+  parser.add_argument(
+      '--eval_chunk_size',
+      type=int,
+      default=1024,
+      help="""\
+      How many test images to evaluate at once when the entire test set is used.
+      Only this many bottlenecks are held in memory at a time.\
+      """
+  )
+  parser.add_argument(
+      '--eval_report',
+      type=str,
+      default='./eval_report.json',
+      help="""\
+      Where to write the final accuracy, confusion matrix and per-class
+      precision and recall on the test set as JSON. Set to an empty string to
+      only log them.\
+      """
+  )
   parser.add_argument(
       '--validation_batch_size',
       type=int,
@@ -1253,6 +2431,72 @@ if __name__ == '__main__':
       default='./bottleneck',
       help='Path to cache bottleneck layer values as files.'
   )
+  parser.add_argument(
+      '--bottleneck_dtype',
+      type=str,
+      default='float32',
+      choices=['float16', 'float32'],
+      help="""\
+      The type to cache bottleneck values as. float16 halves the size of the
+      cache, at a small loss of precision.\
+      """
+  )
+  parser.add_argument(
+      '--bottleneck_batch_size',
+      type=int,
+      default=32,
+      help='How many images to calculate bottlenecks for at a time.'
+  )
+  parser.add_argument(
+      '--decode_threads',
+      type=int,
+      default=4,
+      help='How many images to read and decode in parallel.'
+  )
+  parser.add_argument(
+      '--bottleneck_workers',
+      type=int,
+      default=0,
+      help="""\
+      How many processes to cache bottlenecks with. Each worker caches its own
+      shard of the images before training starts.\
+      """
+  )
+  parser.add_argument(
+      '--num_shards',
+      type=int,
+      default=1,
+      help="""\
+      How many shards to split bottleneck caching into, to cache on several
+      machines sharing --bottleneck_dir. With more than one shard only this
+      machine's shard is cached and no training is done.\
+      """
+  )
+  parser.add_argument(
+      '--shard_index',
+      type=int,
+      default=0,
+      help='Which shard to cache, from 0 to --num_shards - 1.'
+  )
+  parser.add_argument(
+      '--incremental',
+      default=False,
+      help="""\
+      Whether to start the new layer from the checkpoint and --output_labels of
+      the last run, so the classes it was trained on don't have to be learned
+      again. Bottlenecks of images modified since they were cached are created
+      again. Train for fewer steps than a full run, e.g. 500.\
+      """,
+      action='store_true'
+  )
+  parser.add_argument(
+      '--cache_only',
+      default=False,
+      help="""\
+      Whether to stop once the bottlenecks are cached, without training.\
+      """,
+      action='store_true'
+  )
   parser.add_argument(
       '--final_tensor_name',
       type=str,
@@ -1296,6 +2540,16 @@ if __name__ == '__main__':
       input pixels up or down by.\
       """
   )
+  parser.add_argument(
+      '--distorted_variants',
+      type=int,
+      default=0,
+      help="""\
+      If distortions are on, how many distorted variants of each training image
+      to cache bottlenecks for. Training then samples the cached variants instead
+      of running every distorted image through the module at every step.\
+      """
+  )
   parser.add_argument(
       '--tfhub_module',
       type=str,